@@ -1,8 +1,11 @@
 from leapp.actors import Actor
 from leapp.libraries.common import dnfplugin
 from leapp.models import (
+    DNFDownloadReport,
     DNFPluginTask,
+    DNFPluginTimings,
     FilteredRpmTransactionTasks,
+    MemoryInfo,
     RHUIInfo,
     StorageInfo,
     TargetUserSpaceInfo,
@@ -24,17 +27,19 @@ class DnfPackageDownload(Actor):
     consumes = (
         DNFPluginTask,
         FilteredRpmTransactionTasks,
+        MemoryInfo,
         RHUIInfo,
         StorageInfo,
         TargetUserSpaceInfo,
         UsedTargetRepositories,
         XFSPresence,
     )
-    produces = ()
+    produces = (DNFDownloadReport, DNFPluginTimings)
     tags = (IPUWorkflowTag, DownloadPhaseTag)
 
     def process(self):
         xfs_info = next(self.consume(XFSPresence), XFSPresence())
+        memory_info = next(self.consume(MemoryInfo), None)
         storage_info = next(self.consume(StorageInfo), StorageInfo())
         used_repos = self.consume(UsedTargetRepositories)
         plugin_info = list(self.consume(DNFPluginTask))
@@ -45,5 +50,6 @@ class DnfPackageDownload(Actor):
 
         dnfplugin.perform_rpm_download(
             tasks=tasks, used_repos=used_repos, target_userspace_info=target_userspace_info,
-            xfs_info=xfs_info, storage_info=storage_info, plugin_info=plugin_info, on_aws=on_aws
+            xfs_info=xfs_info, storage_info=storage_info, plugin_info=plugin_info, on_aws=on_aws,
+            memory_info=memory_info
         )
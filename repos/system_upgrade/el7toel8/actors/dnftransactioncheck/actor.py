@@ -2,7 +2,9 @@ from leapp.actors import Actor
 from leapp.libraries.common import dnfplugin
 from leapp.models import (
     DNFPluginTask,
+    DNFPluginTimings,
     FilteredRpmTransactionTasks,
+    MemoryInfo,
     StorageInfo,
     TargetUserSpaceInfo,
     UsedTargetRepositories,
@@ -20,16 +22,18 @@ class DnfTransactionCheck(Actor):
     consumes = (
         DNFPluginTask,
         FilteredRpmTransactionTasks,
+        MemoryInfo,
         StorageInfo,
         TargetUserSpaceInfo,
         UsedTargetRepositories,
         XFSPresence,
     )
-    produces = ()
+    produces = (DNFPluginTimings,)
     tags = (IPUWorkflowTag, TargetTransactionChecksPhaseTag)
 
     def process(self):
         xfs_info = next(self.consume(XFSPresence), XFSPresence())
+        memory_info = next(self.consume(MemoryInfo), None)
         storage_info = next(self.consume(StorageInfo), StorageInfo())
         used_repos = self.consume(UsedTargetRepositories)
         plugin_info = list(self.consume(DNFPluginTask))
@@ -39,5 +43,6 @@ class DnfTransactionCheck(Actor):
         if target_userspace_info:
             dnfplugin.perform_transaction_check(
                 tasks=tasks, used_repos=used_repos, target_userspace_info=target_userspace_info,
-                xfs_info=xfs_info, storage_info=storage_info, plugin_info=plugin_info
+                xfs_info=xfs_info, storage_info=storage_info, plugin_info=plugin_info,
+                memory_info=memory_info
             )
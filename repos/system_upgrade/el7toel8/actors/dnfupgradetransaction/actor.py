@@ -5,6 +5,7 @@ from leapp.libraries.common import dnfplugin
 from leapp.libraries.stdlib import run
 from leapp.models import (
     DNFPluginTask,
+    DNFPluginTimings,
     FilteredRpmTransactionTasks,
     RHSMInfo,
     StorageInfo,
@@ -32,7 +33,7 @@ class DnfUpgradeTransaction(Actor):
         TargetUserSpaceInfo,
         UsedTargetRepositories,
     )
-    produces = (TransactionCompleted,)
+    produces = (DNFPluginTimings, TransactionCompleted)
     tags = (RPMUpgradePhaseTag, IPUWorkflowTag)
 
     def process(self):
@@ -31,7 +31,9 @@ def copy_dracut_modules(context, modules):
         pass
     for module in modules:
         try:
-            context.copytree_to(module.module_path, os.path.join('/dracut', os.path.basename(module.module_path)))
+            # the modules are just read in the userspace, so they can share the files with the installed ones
+            context.copytree_to(module.module_path, os.path.join('/dracut', os.path.basename(module.module_path)),
+                                mode=mounting.CopyMode.HARDLINK)
         except shutil.Error as e:
             api.current_logger().error('Failed to copy dracut module "{name}" from "{source}" to "{target}"'.format(
                 name=module.name, source=module.module_path, target=context.full_path('/dracut')), exc_info=True)
@@ -84,8 +86,7 @@ def install_multipath_files(context):
     if os.path.exists('/etc/multipath.conf'):
         context.copy_to('/etc/multipath.conf', '/etc/multipath.conf')
         if os.path.isdir('/etc/multipath'):
-            shutil.rmtree(context.full_path('/etc/multipath'))
-            context.copytree_to('/etc/multipath', '/etc/multipath')
+            context.copytree_to('/etc/multipath', '/etc/multipath', mode=mounting.CopyMode.REFLINK, sync=True)
 
 
 def generate_initram_disk(context):
@@ -1,5 +1,6 @@
 from leapp import reporting
 from leapp.actors import Actor
+from leapp.libraries.common.repofileutils import get_url_kind
 from leapp.models import TMPTargetRepositoriesFacts, UsedTargetRepositories
 from leapp.reporting import Report
 from leapp.tags import IPUWorkflowTag, TargetTransactionChecksPhaseTag
@@ -26,13 +27,13 @@ class LocalReposInhibit(Actor):
         """
         used_target_repos = next(self.consume(UsedTargetRepositories)).repos
         target_repos = next(self.consume(TMPTargetRepositoriesFacts)).repositories
-        target_repo_id_to_url_map = {
-            repo.repoid: repo.mirrorlist or repo.metalink or repo.baseurl or ""
+        target_repo_id_to_url_kind_map = {
+            repo.repoid: get_url_kind(repo)
             for repofile in target_repos
             for repo in repofile.data
         }
         return any(
-            target_repo_id_to_url_map[repo.repoid].startswith("file:")
+            target_repo_id_to_url_kind_map[repo.repoid] == "local"
             for repo in used_target_repos
         )
 
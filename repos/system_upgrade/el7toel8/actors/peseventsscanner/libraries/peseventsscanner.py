@@ -1,15 +1,20 @@
+import hashlib
+import io
 import json
+import marshal
 import os
+import sys
 from collections import namedtuple, defaultdict
 from enum import IntEnum
 
 from leapp.exceptions import StopActorExecution, StopActorExecutionError
 from leapp import reporting
 from leapp.libraries.common.config import architecture, version
+from leapp.libraries.common.repomaputils import get_repositories_map_index
 from leapp.libraries.stdlib import api
 from leapp.libraries.stdlib.config import is_verbose
-from leapp.models import (InstalledRedHatSignedRPM, PESRpmTransactionTasks, RepositoriesMap,
-                          RepositoriesSetupTasks, RpmTransactionTasks, RepositoriesBlacklisted)
+from leapp.models import (InstalledRedHatSignedRPM, PESRpmTransactionTasks, RepositoriesSetupTasks,
+                          RpmTransactionTasks, RepositoriesBlacklisted)
 
 
 Event = namedtuple('Event', ['id',            # int
@@ -18,10 +23,16 @@ Event = namedtuple('Event', ['id',            # int
                              'out_pkgs',      # A dictionary with packages in format {<pkg_name>: <repository>}
                              'from_release',  # A tuple representing a release in format (major, minor)
                              'to_release',    # A tuple representing a release in format (major, minor)
-                             'architectures'  # A list of strings representing architectures
+                             'architectures'  # A list or tuple of strings representing architectures
                              ])
 
 
+PES_EVENTS_CACHE_FILE = '/var/lib/leapp/pes-events.cache'
+"""Path to the compiled form of the PES events file reused by repeated runs."""
+PES_EVENTS_CACHE_FORMAT = 2
+"""Version of the compiled form; bump it whenever the structure of the compiled data changes."""
+
+
 class Action(IntEnum):
     present = 0
     removed = 1
@@ -47,9 +58,12 @@ def pes_events_scanner(pes_json_filepath):
     installed_pkgs = get_installed_pkgs()
     transaction_configuration = get_transaction_configuration()
     arch = api.current_actor().configuration.architecture
-    events = get_events(pes_json_filepath)
-    releases = get_releases(events)
     target = version._version_to_tuple(api.current_actor().configuration.version.target)
+    # events for packages removed by the user configuration are needed to extend the configuration
+    relevant_pkgs = installed_pkgs.union(transaction_configuration.to_remove)
+    events = get_events(pes_json_filepath, relevant_pkgs=relevant_pkgs, arch=arch, target=target,
+                        cache_path=PES_EVENTS_CACHE_FILE)
+    releases = get_releases(events)
 
     filtered_releases = filter_releases_by_target(releases, target)
     filtered_events = filter_events_by_releases(events, filtered_releases)
@@ -88,23 +102,13 @@ def _get_repositories_mapping():
 
     :return: Dictionary with all repositories mapped.
     """
-    repositories_mapping = {}
-
-    repositories_map_msgs = api.consume(RepositoriesMap)
-    repositories_map_msg = next(repositories_map_msgs, None)
-    if list(repositories_map_msgs):
-        api.current_logger().warning('Unexpectedly received more than one RepositoriesMap message.')
-    if not repositories_map_msg:
+    repositories_map_index = get_repositories_map_index()
+    if repositories_map_index is None:
         raise StopActorExecutionError(
             'Cannot parse RepositoriesMap data properly',
             details={'Problem': 'Did not receive a message with mapped repositories'}
         )
-
-    for repository in repositories_map_msg.repositories:
-        if repository.arch == api.current_actor().configuration.architecture:
-            repositories_mapping[repository.to_pes_repo] = repository.to_repoid
-
-    return repositories_mapping
+    return repositories_map_index.pes_repo_mapping(api.current_actor().configuration.architecture)
 
 
 def get_transaction_configuration():
@@ -128,14 +132,28 @@ def filter_releases_by_target(releases, target):
     return [r for r in releases if version.matches_version(match_list, '{}.{}'.format(*r))]
 
 
-def get_events(pes_events_filepath):
+def get_events(pes_events_filepath, relevant_pkgs=None, arch=None, target=None, cache_path=None):
     """
     Get all the events from the source JSON file exported from PES.
 
+    When the cache_path is set, the compiled form of the file is stored there and reused
+    by further calls as long as the source file, arch and target are not changed.
+
+    :param relevant_pkgs: Set of package names; if set, only events which can be relevant
+                          for these packages are returned (see select_relevant_events)
+    :param arch: Architecture; if set, events not applicable to it are skipped
+    :param target: Target release tuple; if set, events with later target release are skipped
+    :param cache_path: Path to the compiled form of the events file
     :return: List of Event tuples, where each event contains event type and input/output pkgs
     """
     try:
-        return parse_pes_events_file(pes_events_filepath)
+        if cache_path:
+            compiled = load_compiled_pes_events(pes_events_filepath, cache_path, arch=arch, target=target)
+        else:
+            compiled = compile_pes_events(parse_pes_events_file(pes_events_filepath, arch=arch, target=target))
+        if relevant_pkgs is None:
+            return [_event_from_compiled(e) for e in compiled['events'] if target is None or e[5] <= target]
+        return select_relevant_events(compiled, relevant_pkgs, target)
     except (ValueError, KeyError):
         title = 'Missing/Invalid PES data file ({})'.format(pes_events_filepath)
         summary = 'Read documentation at: https://access.redhat.com/articles/3664871 for more information ' \
@@ -168,21 +186,283 @@ def filter_events_by_releases(events, releases):
     return [e for e in events if e.to_release in releases]
 
 
-def parse_pes_events_file(path):
+def parse_pes_events_file(path, arch=None, target=None):
     """
     Parse JSON file returning PES events
 
+    The file is read incrementally entry by entry, so the whole JSON tree is never held in memory.
+    Events not applicable to the given architecture or target release are dropped right away.
+
+    :param arch: Architecture; if set, events not applicable to it are skipped
+    :param target: Target release tuple; if set, events with later target release are skipped
     :return: List of Event tuples, where each event contains event type and input/output pkgs
     """
     if path is None or not os.path.isfile(path):
         raise ValueError('File {} not found'.format(path))
-    with open(path) as f:
-        data = json.load(f)
+    parser = PESEventsParser(arch=arch, target=target)
+    events = []
+    for entry in iter_pes_entries(path):
+        event = parser.parse(entry)
+        if event is not None:
+            events.append(event)
+    return events
+
 
-        if not isinstance(data, dict) or not data.get('packageinfo'):
+class PESEventsParser(object):
+    """
+    Parse PES entries into Event tuples, keeping just the events applicable to the given arch and target.
+
+    Equal package names, repositories, releases and architectures of all parsed events share a single object.
+    """
+
+    __slots__ = ('arch', 'target', '_values', '_wanted_releases')
+
+    def __init__(self, arch=None, target=None):
+        self.arch = arch
+        self.target = target
+        self._values = {}
+        self._wanted_releases = {}
+
+    def intern(self, value):
+        return self._values.setdefault(value, value)
+
+    def _intern_pkgs(self, pkgs):
+        return {self.intern(name): self.intern(repo) for name, repo in pkgs.items()}
+
+    def is_wanted(self, event):
+        """Apply the same rules as filter_events_by_architecture and filter_releases_by_target."""
+        if self.arch is not None and not filter_events_by_architecture([event], self.arch):
+            return False
+        if self.target is None:
+            return True
+        if event.to_release not in self._wanted_releases:
+            self._wanted_releases[event.to_release] = bool(filter_releases_by_target([event.to_release], self.target))
+        return self._wanted_releases[event.to_release]
+
+    def parse(self, entry):
+        """
+        Parse PES event data (see parse_entry)
+
+        :return: Event tuple or None when the event is not wanted
+        """
+        event = parse_entry(entry)
+        if not self.is_wanted(event):
+            return None
+        return event._replace(in_pkgs=self._intern_pkgs(event.in_pkgs),
+                              out_pkgs=self._intern_pkgs(event.out_pkgs),
+                              from_release=self.intern(event.from_release),
+                              to_release=self.intern(event.to_release),
+                              architectures=self.intern(tuple(self.intern(a) for a in event.architectures)))
+
+
+class _JSONStreamReader(object):
+    """Decode JSON values from a text file one by one, holding only the not yet decoded part in memory."""
+
+    __slots__ = ('_file', '_chunk_size', '_buffer', '_pos', '_eof', '_decoder')
+
+    def __init__(self, f, chunk_size):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self._file.read(self._chunk_size)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        self._eof = not chunk
+
+    def _skip_whitespace(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in ' \t\n\r':
+                self._pos += 1
+            if self._pos < len(self._buffer) or self._eof:
+                return
+            self._fill()
+
+    def expect(self, chars):
+        """Consume the next non-whitespace character, which has to be one of chars, and return it."""
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError('Unexpected end of PES data')
+        char = self._buffer[self._pos]
+        if char not in chars:
             raise ValueError('Found PES data with invalid structure')
+        self._pos += 1
+        return char
+
+    def peek(self):
+        self._skip_whitespace()
+        return self._buffer[self._pos:self._pos + 1]
+
+    def decode(self):
+        """Decode the next JSON value."""
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+                self._fill()
+                continue
+            # a number could continue in the next chunk
+            if end == len(self._buffer) and not self._eof:
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+
+def iter_pes_entries(path, chunk_size=1024 * 1024):
+    """
+    Yield entries of the 'packageinfo' list of the PES JSON file one by one.
+
+    :raises ValueError: When the file is not a valid JSON or has no 'packageinfo' entries
+    """
+    entries_count = 0
+    with io.open(path, encoding='utf-8') as f:
+        reader = _JSONStreamReader(f, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            raise ValueError('Found PES data with invalid structure')
+        while True:
+            key = reader.decode()
+            reader.expect(':')
+            if key == 'packageinfo':
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.expect(']')
+                else:
+                    while True:
+                        entry = reader.decode()
+                        if not isinstance(entry, dict):
+                            raise ValueError('Found PES data with invalid structure')
+                        entries_count += 1
+                        yield entry
+                        if reader.expect(',]') == ']':
+                            break
+            else:
+                reader.decode()
+            if reader.expect(',}') == '}':
+                break
+        if reader.peek():
+            raise ValueError('Found PES data with invalid structure')
+    if not entries_count:
+        raise ValueError('Found PES data with invalid structure')
+
+
+def _get_file_stat_key(path, arch=None, target=None):
+    stat = os.stat(path)
+    return [PES_EVENTS_CACHE_FORMAT, sys.version_info[0], stat.st_size, stat.st_mtime,
+            arch, list(target) if target else None]
+
+
+def _get_file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compile_pes_events(events):
+    """
+    Convert Event tuples into the compiled form indexed by input packages.
+
+    The compiled form holds just builtin types so it can be stored by the marshal module.
+
+    :return: A dict with the following items:
+             'events': list of tuples with fields of the Event tuple, the action is stored as int
+             'by_in_pkg': {<pkg_name>: [<positions of events with the package among input packages>]}
+             'no_in_pkgs': [<positions of events without input packages>]
+    """
+    compiled_events = []
+    by_in_pkg = {}
+    no_in_pkgs = []
+    for position, event in enumerate(events):
+        compiled_events.append((event.id, int(event.action), event.in_pkgs, event.out_pkgs,
+                                event.from_release, event.to_release, event.architectures))
+        for pkg in event.in_pkgs:
+            by_in_pkg.setdefault(pkg, []).append(position)
+        if not event.in_pkgs:
+            no_in_pkgs.append(position)
+    return {'events': compiled_events, 'by_in_pkg': by_in_pkg, 'no_in_pkgs': no_in_pkgs}
+
+
+def load_compiled_pes_events(path, cache_path, arch=None, target=None):
+    """
+    Load the compiled PES events, compiling and storing them if the cache is missing or outdated.
+
+    The cache is valid when size, mtime and sha256 digest of the source file, as well as arch
+    and target used to filter the events, match those recorded in the cache.
+    """
+    if path is None or not os.path.isfile(path):
+        raise ValueError('File {} not found'.format(path))
+    stat_key = _get_file_stat_key(path, arch, target)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = marshal.load(f)
+        if cached['stat_key'] == stat_key and cached['digest'] == _get_file_digest(path):
+            api.current_logger().debug('Using compiled PES events from {}'.format(cache_path))
+            return cached['compiled']
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        pass
+
+    compiled = compile_pes_events(parse_pes_events_file(path, arch=arch, target=target))
+    try:
+        tmp_path = '{}.tmp'.format(cache_path)
+        with open(tmp_path, 'wb') as f:
+            marshal.dump({'stat_key': stat_key, 'digest': _get_file_digest(path), 'compiled': compiled}, f,
+                         marshal.version)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as err:
+        api.current_logger().warning('Cannot store compiled PES events into {}: {}'.format(cache_path, err))
+    return compiled
+
+
+def select_relevant_events(compiled, pkgs, target=None):
+    """
+    Create Event tuples just for the events which can be relevant for the given packages.
+
+    An event can be relevant when any of its input packages is among the given packages or among
+    output packages of another relevant event, or when it has no input packages at all. The result
+    is a superset of the events process_events() needs, in their original order.
+
+    :param compiled: The compiled form of PES events (see compile_pes_events)
+    :param pkgs: Set of package names
+    :param target: Target release tuple; if set, events with later target release are skipped
+    :return: List of Event tuples
+    """
+    events = compiled['events']
+    selected = set()
+    reachable = set(pkgs)
+    queue = list(reachable)
+
+    def _select(position):
+        event = events[position]
+        if position in selected or (target is not None and event[5] > target):
+            return
+        selected.add(position)
+        for pkg in event[3]:
+            if pkg not in reachable:
+                reachable.add(pkg)
+                queue.append(pkg)
+
+    for position in compiled['no_in_pkgs']:
+        _select(position)
+    while queue:
+        for position in compiled['by_in_pkg'].get(queue.pop(), ()):
+            _select(position)
+
+    return [_event_from_compiled(events[position]) for position in sorted(selected)]
+
 
-        return [parse_entry(entry) for entry in data['packageinfo']]
+def _event_from_compiled(event):
+    event_id, action, in_pkgs, out_pkgs, from_release, to_release, architectures = event
+    return Event(event_id, Action(action), in_pkgs, out_pkgs, from_release, to_release, architectures)
 
 
 def parse_entry(entry):
@@ -308,6 +588,7 @@ def drop_conflicting_release_events(events):
     for event in events:
         input_packages_str = _packages_to_str(event.in_pkgs)
         events_by_input[(event.from_release, input_packages_str)].append(event)
+    dropped = set()
     for input_events in events_by_input.values():
         if len(input_events) > 1:
             input_events.sort(key=lambda e: (e.to_release, e.id))
@@ -315,7 +596,57 @@ def drop_conflicting_release_events(events):
                                        ', #'.join(str(e.id) for e in input_events))
             for event in input_events[:-1]:
                 api.current_logger().debug('Dropping event #{}'.format(event.id))
-                events.remove(event)
+                dropped.add(id(event))
+    if dropped:
+        events[:] = [e for e in events if id(e) not in dropped]
+
+
+class EventsIndex(object):
+    """
+    Events bucketed by their target release and indexed by their input packages.
+
+    Allows to visit just the events which input packages are installed or are going
+    to be installed instead of checking relevance of every event for each release.
+    """
+
+    def __init__(self, events):
+        self._events = events
+        self._by_release = defaultdict(lambda: {'by_in_pkg': defaultdict(list), 'no_in_pkgs': [], 'count': 0})
+        for position, event in enumerate(events):
+            bucket = self._by_release[event.to_release]
+            bucket['count'] += 1
+            for pkg in event.in_pkgs:
+                bucket['by_in_pkg'][pkg].append(position)
+            if not event.in_pkgs:
+                bucket['no_in_pkgs'].append(position)
+
+    def count(self, release):
+        """Get the number of all events with the given target release."""
+        bucket = self._by_release.get(release)
+        return bucket['count'] if bucket else 0
+
+    def get_candidates(self, release, *pkg_sets):
+        """
+        Get events of the release with at least one input package from the given sets, or without input packages.
+
+        The relevance of the returned events still needs to be checked (all input packages must be present).
+        Events are returned in their original order.
+        """
+        bucket = self._by_release.get(release)
+        if not bucket:
+            return []
+        by_in_pkg = bucket['by_in_pkg']
+        positions = set(bucket['no_in_pkgs'])
+        for pkgs in pkg_sets:
+            # iterate over the smaller collection
+            if len(pkgs) < len(by_in_pkg):
+                for pkg in pkgs:
+                    positions.update(by_in_pkg.get(pkg, ()))
+            else:
+                for pkg, pkg_positions in by_in_pkg.items():
+                    if pkg in pkgs:
+                        positions.update(pkg_positions)
+        return [self._events[position] for position in sorted(positions)]
 
 
 def process_events(releases, events, installed_pkgs):
@@ -329,12 +660,13 @@ def process_events(releases, events, installed_pkgs):
     """
     # subdicts in format {<pkg_name>: <repository>}
     tasks = {t: {} for t in Task}  # noqa: E1133; pylint: disable=not-an-iterable
+    events_index = EventsIndex(events)
 
     for release in releases:
         current = {t: {} for t in Task}  # noqa: E1133; pylint: disable=not-an-iterable
-        release_events = [e for e in events if e.to_release == release]
+        release_events = events_index.get_candidates(release, installed_pkgs, tasks[Task.install])
         api.current_logger().debug('---- Processing {n} eligible events for release {r}'.format(
-            n=len(release_events), r=release))
+            n=events_index.count(release), r=release))
 
         for event in release_events:
             if is_event_relevant(event, installed_pkgs, tasks):
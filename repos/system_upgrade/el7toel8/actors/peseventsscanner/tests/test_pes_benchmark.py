@@ -0,0 +1,216 @@
+"""
+Benchmark of the PES events processing on synthetic data.
+
+By default just a small dataset is used so the benchmark runs as a part of the regular tests.
+The size of the dataset can be changed by the following environment variables:
+
+    PES_BENCHMARK_EVENTS       number of generated PES events (default: 2000)
+    PES_BENCHMARK_PACKAGES     number of distinct package names in the events (default: 1500)
+    PES_BENCHMARK_INSTALLED    number of installed packages (default: 500)
+    PES_BENCHMARK_MEMORY       set to 0 to skip measuring of the peak memory, which slows the stages down
+    PES_BENCHMARK_MAX_SECONDS  if set, the benchmark fails when all stages take longer in total
+"""
+import json
+import os
+import random
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from leapp import reporting
+from leapp.libraries.actor import peseventsscanner
+from leapp.libraries.actor.peseventsscanner import Action, map_repositories, Task
+from leapp.libraries.common.testutils import create_report_mocked
+from leapp.libraries.stdlib import api
+
+ARCHITECTURES = ['x86_64', 'aarch64', 'ppc64le', 's390x']
+SOURCE_REPOS = ['rhel7-base', 'rhel7-optional', 'rhel7-extras']
+TARGET_REPOS = ['rhel8-BaseOS', 'rhel8-AppStream', 'rhel8-CRB']
+TARGET_MINORS = [0, 1, 2, 3, 4]
+
+ACTION_WEIGHTS = [
+    (Action.present, 30),
+    (Action.removed, 15),
+    (Action.deprecated, 5),
+    (Action.replaced, 15),
+    (Action.split, 10),
+    (Action.merged, 5),
+    (Action.moved, 10),
+    (Action.renamed, 10),
+]
+"""Relative frequency of actions in the generated data."""
+
+STAGES = ['parse', 'filter', 'drop conflicts', 'process', 'map repos']
+
+
+def _release(major, minor):
+    return {'z_stream': None, 'major_version': major, 'tag': None, 'os_name': 'RHEL', 'minor_version': minor}
+
+
+def _packageset(set_id, names, repos, rng):
+    if not names:
+        return None
+    return {'set_id': set_id, 'package': [{'name': name, 'repository': rng.choice(repos)} for name in names]}
+
+
+def generate_pes_data(events_count, packages_count, seed=0):
+    """
+    Generate PES data in the format of the JSON file exported from PES.
+
+    Packages of events targeting RHEL 8.0 come from RHEL 7 repositories; later events work
+    with packages produced by the previous target releases. About two thirds of events apply
+    to all architectures, the rest to a random subset of them.
+    """
+    rng = random.Random(seed)
+    names = ['package{}'.format(i) for i in range(packages_count)]
+    actions = [action for action, weight in ACTION_WEIGHTS for dummy in range(weight)]
+    entries = []
+    for event_id in range(1, events_count + 1):
+        action = rng.choice(actions)
+        minor = rng.choice(TARGET_MINORS)
+        initial_release = _release(7, rng.choice([6, 7, 8, 9])) if minor == 0 else _release(8, minor - 1)
+        in_repos = SOURCE_REPOS if minor == 0 else TARGET_REPOS
+
+        in_pkgs = rng.sample(names, 1)
+        out_pkgs = []
+        if action == Action.split:
+            out_pkgs = rng.sample(names, rng.randint(2, 3))
+            if rng.random() < 0.5:
+                out_pkgs[0] = in_pkgs[0]
+        elif action == Action.merged:
+            in_pkgs = rng.sample(names, rng.randint(2, 3))
+            out_pkgs = [rng.choice(in_pkgs) if rng.random() < 0.5 else rng.choice(names)]
+        elif action in (Action.replaced, Action.renamed):
+            out_pkgs = rng.sample(names, 1)
+        elif action == Action.moved:
+            out_pkgs = list(in_pkgs)
+
+        architectures = []
+        if rng.random() < 0.3:
+            architectures = sorted(rng.sample(ARCHITECTURES, rng.randint(1, len(ARCHITECTURES) - 1)))
+
+        entries.append({
+            'id': event_id,
+            'action': int(action),
+            'in_packageset': _packageset(2 * event_id, in_pkgs, in_repos, rng),
+            'out_packageset': _packageset(2 * event_id + 1, out_pkgs, TARGET_REPOS, rng),
+            'initial_release': initial_release,
+            'release': _release(8, minor),
+            'architectures': architectures,
+        })
+    return {'packageinfo': entries}
+
+
+def generate_installed_pkgs(installed_count, packages_count, seed=0):
+    """Generate names of installed packages; names not used by any PES event are included as well."""
+    rng = random.Random(seed)
+    known = rng.sample(range(packages_count), min(installed_count * 3 // 4, packages_count))
+    installed = {'package{}'.format(i) for i in known}
+    installed.update('unknown-package{}'.format(i) for i in range(installed_count - len(installed)))
+    return installed
+
+
+def write_pes_file(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+class StageMeter(object):
+    """
+    Measure wall time and peak memory of the benchmark stages.
+
+    The peak memory is measured by tracemalloc (not available on Python 2) which makes the code
+    run several times slower; use trace_memory=False to get realistic times.
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.results = []
+
+    def measure(self, stage, func, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            peak = None
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.results.append((stage, elapsed, peak))
+
+    def total_time(self):
+        return sum(elapsed for dummy, elapsed, dummy in self.results)
+
+    def format(self):
+        lines = ['{:<16}{:>12}{:>16}'.format('stage', 'time [s]', 'peak mem [KiB]')]
+        for stage, elapsed, peak in self.results:
+            peak_str = '{:.0f}'.format(peak / 1024.0) if peak is not None else 'n/a'
+            lines.append('{:<16}{:>12.3f}{:>16}'.format(stage, elapsed, peak_str))
+        return '\n'.join(lines)
+
+
+def run_benchmark(pes_file, installed_pkgs, arch, target, meter):
+    """
+    Run the stages of pes_events_scanner() on the given data, measuring each of them with the meter.
+
+    Mapping of repositories is done by process_events() at its end; here it is measured as a separate
+    stage, so peseventsscanner.map_repositories is expected to be replaced by a no-op.
+    """
+    def _filter(events):
+        compiled = peseventsscanner.compile_pes_events(events)
+        events = peseventsscanner.select_relevant_events(compiled, installed_pkgs, target)
+        releases = peseventsscanner.filter_releases_by_target(peseventsscanner.get_releases(events), target)
+        events = peseventsscanner.filter_events_by_releases(events, releases)
+        return releases, peseventsscanner.filter_events_by_architecture(events, arch)
+
+    def _map_repositories(tasks):
+        map_repositories(tasks[Task.install])
+        map_repositories(tasks[Task.keep])
+
+    events = meter.measure('parse', peseventsscanner.parse_pes_events_file, pes_file, arch=arch, target=target)
+    releases, events = meter.measure('filter', _filter, events)
+    meter.measure('drop conflicts', peseventsscanner.drop_conflicting_release_events, events)
+    tasks = meter.measure('process', peseventsscanner.process_events, releases, events, installed_pkgs)
+    meter.measure('map repos', _map_repositories, tasks)
+    return tasks
+
+
+def _get_env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def test_pes_benchmark(monkeypatch, tmpdir):
+    events_count = _get_env_int('PES_BENCHMARK_EVENTS', 2000)
+    packages_count = _get_env_int('PES_BENCHMARK_PACKAGES', 1500)
+    installed_count = _get_env_int('PES_BENCHMARK_INSTALLED', 500)
+
+    pes_file = str(tmpdir.join('pes-events.json'))
+    write_pes_file(pes_file, generate_pes_data(events_count, packages_count))
+    installed_pkgs = generate_installed_pkgs(installed_count, packages_count)
+
+    # all but the CRB repository are mapped, so packages from unknown repositories are reported too
+    mapping = {repo.lower(): '{}-rpms'.format(repo.lower()) for repo in TARGET_REPOS[:-1]}
+    monkeypatch.setattr(peseventsscanner, '_get_repositories_mapping', lambda: mapping)
+    monkeypatch.setattr(peseventsscanner, 'map_repositories', lambda packages: None)
+    monkeypatch.setattr(peseventsscanner, 'get_repositories_blacklisted', set)
+    monkeypatch.setattr(reporting, 'create_report', create_report_mocked())
+    monkeypatch.setattr(api, 'show_message', lambda msg: None)
+
+    meter = StageMeter(trace_memory=bool(_get_env_int('PES_BENCHMARK_MEMORY', 1)))
+    tasks = run_benchmark(pes_file, installed_pkgs, 'x86_64', (8, 2), meter)
+
+    api.current_logger().info('PES benchmark: {} events, {} installed packages\n{}'.format(
+        events_count, installed_count, meter.format()))
+    assert [stage for stage, dummy, dummy in meter.results] == STAGES
+    assert tasks[Task.install] and tasks[Task.remove]
+    assert set(tasks[Task.install].values()).issubset(mapping.values())
+
+    max_seconds = os.environ.get('PES_BENCHMARK_MAX_SECONDS')
+    if max_seconds:
+        assert meter.total_time() <= float(max_seconds)
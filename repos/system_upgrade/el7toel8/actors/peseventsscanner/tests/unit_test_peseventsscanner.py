@@ -1,4 +1,6 @@
+import json
 import os.path
+import random
 
 import pytest
 
@@ -15,6 +17,7 @@ from leapp.libraries.actor.peseventsscanner import (
     filter_events_by_releases,
     filter_releases_by_target,
     get_events,
+    get_releases,
     map_repositories, parse_action,
     parse_entry, parse_packageset,
     parse_pes_events_file,
@@ -101,6 +104,49 @@ def test_parse_pes_events_file(current_actor_context):
     assert events[1].out_pkgs == {}
 
 
+def _pes_entry(event_id, to_release, architectures, in_pkg):
+    return {
+        'id': event_id,
+        'action': 1,
+        'in_packageset': {'set_id': event_id, 'package': [{'name': in_pkg, 'repository': 'Repo'}]},
+        'out_packageset': None,
+        'release': {'major_version': to_release[0], 'minor_version': to_release[1]},
+        'architectures': architectures,
+    }
+
+
+def test_parse_pes_events_file_streaming(tmpdir):
+    entries = [_pes_entry(i, (8, i % 4), [['x86_64'], ['s390x'], []][i % 3], 'pkg{}'.format(i % 5))
+               for i in range(1, 200)]
+    pes_file = tmpdir.join('pes-events.json')
+    pes_file.write(json.dumps({'timestamp': 12345, 'packageinfo': entries, 'other': [1.5, None]}, indent=2))
+
+    events = parse_pes_events_file(str(pes_file))
+    assert [e._replace(architectures=list(e.architectures)) for e in events] == [parse_entry(e) for e in entries]
+    # read in tiny chunks so values are split among chunks
+    assert [peseventsscanner.PESEventsParser().parse(e) for e in peseventsscanner.iter_pes_entries(
+        str(pes_file), chunk_size=7)] == events
+
+    filtered = parse_pes_events_file(str(pes_file), arch='x86_64', target=(8, 1))
+    expected = filter_events_by_architecture(events, 'x86_64')
+    expected = filter_events_by_releases(expected, filter_releases_by_target(get_releases(expected), (8, 1)))
+    assert filtered == expected
+    # equal values are shared among events
+    assert len({id(e.to_release) for e in filtered}) == 2
+    assert len({id(next(iter(e.in_pkgs.values()))) for e in filtered}) == 1
+
+
+@pytest.mark.parametrize('content', [
+    '', '[]', '{}', '{"packageinfo": []}', '{"packageinfo": null}', '{"packageinfo": [1]}',
+    '{"packageinfo": [{"id": 1}', '{"packageinfo": [{}]} garbage',
+])
+def test_parse_pes_events_file_invalid(tmpdir, content):
+    pes_file = tmpdir.join('pes-events.json')
+    pes_file.write(content)
+    with pytest.raises((ValueError, KeyError)):
+        parse_pes_events_file(str(pes_file))
+
+
 def test_report_skipped_packages(monkeypatch, caplog):
     monkeypatch.setattr(api, 'produce', produce_mocked())
     monkeypatch.setattr(api, 'show_message', show_message_mocked())
@@ -370,3 +416,95 @@ def drop_conflicting_release_events(events):
         assert event in events
     for event in [conflict1a, conflict1c, conflict2a, conflict3a]:
         assert event not in events
+
+
+def test_compiled_events_cache(monkeypatch, tmpdir):
+    with open(os.path.join(CUR_DIR, 'files/sample01.json')) as f:
+        sample = f.read()
+    pes_file = tmpdir.join('pes-events.json')
+    pes_file.write(sample)
+    cache_file = tmpdir.join('pes-events.cache')
+    parsed = []
+
+    def parse_pes_events_file_mocked(path, arch=None, target=None):
+        parsed.append(path)
+        return parse_pes_events_file(path, arch=arch, target=target)
+
+    monkeypatch.setattr(peseventsscanner, 'parse_pes_events_file', parse_pes_events_file_mocked)
+
+    events = get_events(str(pes_file), cache_path=str(cache_file))
+    assert cache_file.check()
+    assert get_events(str(pes_file), cache_path=str(cache_file)) == events
+    assert len(parsed) == 1
+    assert [e.action for e in events] == [Action.split, Action.removed]
+
+    # the cache is invalidated when the source file changes
+    pes_file.write(sample.replace('"removed"', '"deleted"'))
+    events = get_events(str(pes_file), cache_path=str(cache_file))
+    assert len(parsed) == 2
+    assert events[1].in_pkgs == {'deleted': 'repo'}
+
+
+def test_compiled_events_broken_cache(monkeypatch, tmpdir):
+    cache_file = tmpdir.join('pes-events.cache')
+    cache_file.write('garbage')
+
+    events = get_events(os.path.join(CUR_DIR, 'files/sample01.json'), cache_path=str(cache_file))
+    assert len(events) == 2
+
+
+def test_select_relevant_events():
+    events = [
+        Event(1, Action.split, {'original': 'repo'}, {'split01': 'repo', 'split02': 'repo'}, (7, 6), (8, 0), []),
+        Event(2, Action.renamed, {'split01': 'repo'}, {'renamed': 'repo'}, (8, 0), (8, 1), []),
+        Event(3, Action.removed, {'notinstalled': 'repo'}, {}, (7, 6), (8, 0), []),
+        Event(4, Action.present, {}, {'new': 'repo'}, (7, 6), (8, 0), []),
+        Event(5, Action.removed, {'new': 'repo'}, {}, (8, 0), (8, 1), []),
+        Event(6, Action.removed, {'original': 'repo'}, {}, (8, 1), (8, 2), []),
+    ]
+    compiled = peseventsscanner.compile_pes_events(events)
+
+    selected = peseventsscanner.select_relevant_events(compiled, {'original'})
+    assert [e.id for e in selected] == [1, 2, 4, 5, 6]
+    assert selected[0] == events[0]
+
+    selected = peseventsscanner.select_relevant_events(compiled, {'original'}, target=(8, 1))
+    assert [e.id for e in selected] == [1, 2, 4, 5]
+
+
+def test_events_index_candidates():
+    random.seed(42)
+    pkgs = ['pkg{}'.format(i) for i in range(50)]
+    releases = [(8, 0), (8, 1), (8, 2)]
+    events = []
+    for i in range(500):
+        in_pkgs = {p: 'repo' for p in random.sample(pkgs, random.randint(0, 3))}
+        out_pkgs = {p: 'repo' for p in random.sample(pkgs, random.randint(0, 3))}
+        events.append(Event(i, Action(random.randint(0, 7)), in_pkgs, out_pkgs, (7, 6), random.choice(releases), []))
+    installed_pkgs = set(random.sample(pkgs, 20))
+    tasks = {t: {} for t in Task}
+    tasks[Task.install] = {p: 'repo' for p in random.sample(pkgs, 5)}
+    tasks[Task.remove] = {p: 'repo' for p in random.sample(pkgs, 5)}
+
+    index = peseventsscanner.EventsIndex(events)
+    for release in releases:
+        expected = [e for e in events
+                    if e.to_release == release and peseventsscanner.is_event_relevant(e, installed_pkgs, tasks)]
+        candidates = index.get_candidates(release, installed_pkgs, tasks[Task.install])
+        assert [e for e in candidates if peseventsscanner.is_event_relevant(e, installed_pkgs, tasks)] == expected
+        assert index.count(release) == len([e for e in events if e.to_release == release])
+    assert index.get_candidates((9, 0), installed_pkgs) == []
+
+
+def test_drop_conflicting_release_events():
+    conflict1a = Event(1, Action.present, {'pkg1': 'repo'}, {}, (7, 6), (8, 0), [])
+    conflict1b = Event(2, Action.replaced, {'pkg1': 'repo'}, {}, (7, 6), (8, 2), [])
+    conflict1c = Event(3, Action.removed, {'pkg1': 'repo'}, {}, (7, 6), (8, 1), [])
+    conflict2a = Event(4, Action.removed, {'pkg2a': 'repo'}, {}, (7, 6), (8, 0), [])
+    conflict2b = Event(5, Action.replaced, {'pkg2a': 'repo'}, {'pkg2b': 'repo'}, (7, 6), (8, 0), [])
+    okay1a = Event(6, Action.replaced, {'pkg1': 'repo'}, {}, (8, 0), (8, 1), [])
+    okay1b = Event(7, Action.removed, {'pkg3': 'repo'}, {}, (7, 6), (8, 0), [])
+    events = [conflict1a, conflict1b, conflict1c, conflict2a, conflict2b, okay1a, okay1b]
+
+    peseventsscanner.drop_conflicting_release_events(events)
+    assert events == [conflict1b, conflict2b, okay1a, okay1b]
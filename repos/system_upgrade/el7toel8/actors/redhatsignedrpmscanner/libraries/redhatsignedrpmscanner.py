@@ -0,0 +1,121 @@
+import os
+
+from leapp.libraries.common import rhui, rpms
+from leapp.libraries.common.config import get_env
+from leapp.libraries.stdlib import api
+from leapp.models import (
+    InstalledRedHatSignedPackedRPM,
+    InstalledRedHatSignedRPM,
+    InstalledRPM,
+    InstalledUnsignedPackedRPM,
+    InstalledUnsignedRPM,
+)
+
+DEFAULT_KEYS_FILE = 'rpm_signing_keys.txt'
+"""Name of the actor file with IDs of the Red Hat signing keys."""
+CUSTOM_KEYS_FILE = '/etc/leapp/files/rpm_signing_keys.txt'
+"""Path to the optional file with IDs of additional trusted signing keys."""
+
+KEY_ID_MARKER = 'Key ID '
+
+
+def read_keys_file(path):
+    """
+    Read IDs of the signing keys from the file.
+
+    The file contains one key ID per line, empty lines and comments starting with '#' are ignored.
+
+    :return: Set of lowercase key IDs
+    """
+    keys = set()
+    with open(path) as f:
+        for line in f:
+            key_id = line.split('#', 1)[0].strip().lower()
+            if key_id:
+                keys.add(key_id)
+    return keys
+
+
+def get_signing_keys():
+    """Get IDs of the Red Hat signing keys and of the additional keys defined by the user."""
+    keys = read_keys_file(api.get_actor_file_path(DEFAULT_KEYS_FILE))
+    if os.path.isfile(CUSTOM_KEYS_FILE):
+        custom_keys = read_keys_file(CUSTOM_KEYS_FILE)
+        api.current_logger().info('Trusting additional signing keys from {}: {}'.format(
+            CUSTOM_KEYS_FILE, ', '.join(sorted(custom_keys))))
+        keys.update(custom_keys)
+    return keys
+
+
+def get_key_id(pgpsig):
+    """
+    Get ID of the key from the pgpsig string of the package.
+
+    E.g. 'RSA/SHA256, Mon 01 Jan 1970 00:00:00 AM UTC, Key ID 199e2f91fd431d51' -> '199e2f91fd431d51'
+
+    :return: Lowercase key ID or None when the package is not signed
+    """
+    _, marker, key_id = pgpsig.rpartition(KEY_ID_MARKER)
+    return key_id.strip().lower() if marker else None
+
+
+class SignatureClassifier(object):
+    """
+    Decide whether the package is considered to be signed by Red Hat.
+
+    All the rules are evaluated once when the classifier is created, so every package is
+    classified just by a few set lookups.
+    """
+
+    def __init__(self, keys, arch, all_signed=False):
+        """
+        :param keys: IDs of the trusted signing keys
+        :param arch: architecture of the system
+        :param all_signed: consider all packages to be signed (LEAPP_DEVEL_RPMS_ALL_SIGNED=1)
+        """
+        self.keys = frozenset(key.lower() for key in keys)
+        self.all_signed = all_signed
+        azure = rhui.RHUI_CLOUD_MAP.get(arch, {}).get('azure', {})
+        # Whitelist Azure config packages
+        self.whitelisted_names = frozenset(azure[key] for key in ('el7_pkg', 'el8_pkg') if key in azure)
+
+    def is_signed(self, pkg):
+        if self.all_signed:
+            return True
+        if get_key_id(pkg.pgpsig) in self.keys:
+            return True
+        if pkg.name in self.whitelisted_names:
+            return True
+        # gpg-pubkey is not signed as it would require another package to verify its signature
+        if pkg.name == 'gpg-pubkey':
+            return pkg.packager.startswith('Red Hat, Inc.')
+        # Whitelist the katello package
+        return pkg.name.startswith('katello-ca-consumer')
+
+
+def create_classifier():
+    return SignatureClassifier(
+        keys=get_signing_keys(),
+        arch=api.current_actor().configuration.architecture,
+        # if we start upgrade with LEAPP_DEVEL_RPMS_ALL_SIGNED=1, we consider
+        # all packages to be signed
+        all_signed=get_env('LEAPP_DEVEL_RPMS_ALL_SIGNED', '0') == '1',
+    )
+
+
+def process():
+    classifier = create_classifier()
+    signed_pkgs = InstalledRedHatSignedRPM()
+    unsigned_pkgs = InstalledUnsignedRPM()
+
+    for rpm_pkgs in api.consume(InstalledRPM):
+        for pkg in rpm_pkgs.items:
+            if classifier.is_signed(pkg):
+                signed_pkgs.items.append(pkg)
+            else:
+                unsigned_pkgs.items.append(pkg)
+
+    api.produce(signed_pkgs)
+    api.produce(unsigned_pkgs)
+    api.produce(InstalledRedHatSignedPackedRPM(packages=rpms.pack_rpms(signed_pkgs.items)))
+    api.produce(InstalledUnsignedPackedRPM(packages=rpms.pack_rpms(unsigned_pkgs.items)))
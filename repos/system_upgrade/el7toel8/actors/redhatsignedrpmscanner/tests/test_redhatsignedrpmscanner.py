@@ -1,11 +1,18 @@
+import os
+import time
+
 import mock
 
+from leapp.libraries.actor import redhatsignedrpmscanner
 from leapp.libraries.common import rpms
 from leapp.libraries.common.config import mock_configs
+from leapp.libraries.stdlib import api
 from leapp.models import (
     RPM,
+    InstalledRedHatSignedPackedRPM,
     InstalledRedHatSignedRPM,
     InstalledRPM,
+    InstalledUnsignedPackedRPM,
     InstalledUnsignedRPM,
     IPUConfig,
     Model,
@@ -13,6 +20,8 @@ from leapp.models import (
 )
 
 RH_PACKAGER = 'Red Hat, Inc. <http://bugzilla.redhat.com/bugzilla>'
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_KEYS_FILE = os.path.join(CUR_DIR, '../files', redhatsignedrpmscanner.DEFAULT_KEYS_FILE)
 
 
 class MockModel(Model):
@@ -154,3 +163,90 @@ def test_has_package(current_actor_context):
     assert not rpms.has_package(InstalledRedHatSignedRPM, 'nosuchpackage', context=current_actor_context)
     assert rpms.has_package(InstalledUnsignedRPM, 'sample02', context=current_actor_context)
     assert not rpms.has_package(InstalledUnsignedRPM, 'nosuchpackage', context=current_actor_context)
+
+
+def test_packed_messages(current_actor_context):
+    installed_rpm = [
+        RPM(name='sample01', version='0.1', release='1.sm01', epoch='1', packager=RH_PACKAGER, arch='noarch',
+            pgpsig='RSA/SHA256, Mon 01 Jan 1970 00:00:00 AM -03, Key ID 199e2f91fd431d51'),
+        RPM(name='sample02', version='0.1', release='1.sm01', epoch='1', packager=RH_PACKAGER, arch='noarch',
+            pgpsig='SOME_OTHER_SIG_X'),
+    ]
+
+    current_actor_context.feed(InstalledRPM(items=installed_rpm))
+    current_actor_context.run(config_model=mock_configs.CONFIG)
+    signed = current_actor_context.consume(InstalledRedHatSignedPackedRPM)[0].packages
+    unsigned = current_actor_context.consume(InstalledUnsignedPackedRPM)[0].packages
+    assert signed.names == ['sample01']
+    assert unsigned.names == ['sample02']
+    assert [pkg.dump() for pkg in rpms.RPMListView(unsigned)] == [installed_rpm[1].dump()]
+
+
+def test_get_key_id():
+    get_key_id = redhatsignedrpmscanner.get_key_id
+    assert get_key_id('RSA/SHA256, Mon 01 Jan 1970 00:00:00 AM -03, Key ID 199E2F91FD431D51') == '199e2f91fd431d51'
+    assert get_key_id('(none)') is None
+    assert get_key_id('') is None
+
+
+def test_read_keys_file(tmpdir):
+    keys_file = tmpdir.join('keys.txt')
+    keys_file.write('# internal keys\n\nAABBCCDDEEFF0011\n1122334455667788  # build system\n')
+    assert redhatsignedrpmscanner.read_keys_file(str(keys_file)) == {'aabbccddeeff0011', '1122334455667788'}
+    assert len(redhatsignedrpmscanner.read_keys_file(DEFAULT_KEYS_FILE)) == 5
+
+
+def test_custom_signing_keys(monkeypatch, tmpdir):
+    keys_file = tmpdir.join('keys.txt')
+    keys_file.write('aabbccddeeff0011\n')
+    monkeypatch.setattr(api, 'get_actor_file_path', lambda name: DEFAULT_KEYS_FILE)
+    monkeypatch.setattr(redhatsignedrpmscanner, 'CUSTOM_KEYS_FILE', str(keys_file))
+
+    keys = redhatsignedrpmscanner.get_signing_keys()
+    assert 'aabbccddeeff0011' in keys
+    assert '199e2f91fd431d51' in keys
+
+
+def test_classifier():
+    classifier = redhatsignedrpmscanner.SignatureClassifier(
+        redhatsignedrpmscanner.read_keys_file(DEFAULT_KEYS_FILE), arch='x86_64')
+
+    def _pkg(name, pgpsig, packager=RH_PACKAGER):
+        return RPM(name=name, version='0.1', release='1', epoch='(none)', packager=packager, arch='noarch',
+                   pgpsig=pgpsig)
+
+    assert classifier.is_signed(_pkg('bash', 'RSA/SHA256, Mon 01 Jan 1970, Key ID 5326810137017186'))
+    assert not classifier.is_signed(_pkg('custom', 'RSA/SHA256, Mon 01 Jan 1970, Key ID aabbccddeeff0011'))
+    assert not classifier.is_signed(_pkg('custom', '(none)'))
+    assert classifier.is_signed(_pkg('rhui-azure-rhel7', '(none)'))
+    assert classifier.is_signed(_pkg('katello-ca-consumer-example.com', '(none)', packager='None'))
+    assert classifier.is_signed(_pkg('gpg-pubkey', '(none)'))
+    assert not classifier.is_signed(_pkg('gpg-pubkey', '(none)', packager='Tester'))
+
+    all_signed = redhatsignedrpmscanner.SignatureClassifier([], arch='x86_64', all_signed=True)
+    assert all_signed.is_signed(_pkg('custom', '(none)'))
+
+
+def test_classifier_benchmark():
+    keys = redhatsignedrpmscanner.read_keys_file(DEFAULT_KEYS_FILE)
+    sigs = ['RSA/SHA256, Mon 01 Jan 1970 00:00:00 AM -03, Key ID {}'.format(key) for key in sorted(keys)]
+    sigs.append('RSA/SHA256, Mon 01 Jan 1970 00:00:00 AM -03, Key ID aabbccddeeff0011')
+    packages = [
+        RPM(name='package{}'.format(i), version='0.1', release='1', epoch='(none)', packager=RH_PACKAGER,
+            arch='noarch', pgpsig=sigs[i % len(sigs)])
+        for i in range(10000)
+    ]
+
+    start = time.time()
+    naive = [any(key in pkg.pgpsig for key in keys) for pkg in packages]
+    naive_time = time.time() - start
+
+    classifier = redhatsignedrpmscanner.SignatureClassifier(keys, arch='x86_64')
+    start = time.time()
+    classified = [classifier.is_signed(pkg) for pkg in packages]
+    classifier_time = time.time() - start
+
+    api.current_logger().info('Classified 10000 packages: substring search {:.3f}s, classifier {:.3f}s'.format(
+        naive_time, classifier_time))
+    assert classified == naive
+    assert classified.count(False) == 10000 // len(sigs)
@@ -1,8 +1,7 @@
 from leapp.actors import Actor
 from leapp.libraries import stdlib
-from leapp.libraries.common import rhsm
-from leapp.libraries.common.rpms import get_installed_rpms
-from leapp.models import LeftoverPackages, RemovedPackages, RPM
+from leapp.libraries.common import rhsm, rpms
+from leapp.models import LeftoverPackages, RemovedPackages
 from leapp.reporting import Report
 from leapp.tags import RPMUpgradePhaseTag, IPUWorkflowTag, ExperimentalTag
 
@@ -26,7 +25,7 @@ class RemoveLeftoverPackages(Actor):
             self.log.info('No leftover packages, skipping...')
             return
 
-        installed_rpms = get_installed_rpms()
+        installed_rpms = rpms.get_rpmdb_snapshot()
 
         to_remove = ['-'.join([pkg.name, pkg.version, pkg.release]) for pkg in leftover_packages.items]
         cmd = ['dnf', 'remove', '-y', '--noautoremove'] + to_remove
@@ -40,17 +39,5 @@ class RemoveLeftoverPackages(Actor):
             self.log.error(error)
             return
 
-        removed_packages = RemovedPackages()
-        removed = list(set(installed_rpms) - set(get_installed_rpms()))
-        for pkg in removed:
-            name, version, release, epoch, packager, arch, pgpsig = pkg.split('|')
-            removed_packages.items.append(RPM(
-                name=name,
-                version=version,
-                epoch=epoch,
-                packager=packager,
-                arch=arch,
-                release=release,
-                pgpsig=pgpsig
-            ))
-        self.produce(removed_packages)
+        removed = rpms.diff(installed_rpms, rpms.get_rpmdb_snapshot()).removed
+        self.produce(RemovedPackages(items=removed))
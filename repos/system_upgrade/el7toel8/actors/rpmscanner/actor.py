@@ -1,7 +1,6 @@
 from leapp.actors import Actor
-from leapp.libraries.actor.rpmscanner import get_package_repository_data
-from leapp.libraries.common.rpms import get_installed_rpms
-from leapp.models import InstalledRPM, RPM
+from leapp.libraries.actor import rpmscanner
+from leapp.models import InstalledPackedRPM, InstalledRPM
 from leapp.tags import IPUWorkflowTag, FactsPhaseTag
 
 
@@ -9,32 +8,17 @@ class RpmScanner(Actor):
     """
     Provides data about installed RPM Packages.
 
-    After collecting data from RPM query, a message with relevant data will be produced.
+    The rpmdb is read directly using the rpm python bindings and the origin repository of each
+    package is taken from the yumdb, all in a single pass. When this is not possible, the data
+    is collected from the RPM query and the yum package sack instead. After collecting the data,
+    a message with relevant data will be produced, both as the list of RPM models and in the compact
+    columnar encoding.
     """
 
     name = 'rpm_scanner'
     consumes = ()
-    produces = (InstalledRPM,)
+    produces = (InstalledRPM, InstalledPackedRPM)
     tags = (IPUWorkflowTag, FactsPhaseTag)
 
     def process(self):
-        output = get_installed_rpms()
-        pkg_repos = get_package_repository_data()
-
-        result = InstalledRPM()
-        for entry in output:
-            entry = entry.strip()
-            if not entry:
-                continue
-            name, version, release, epoch, packager, arch, pgpsig = entry.split('|')
-            repository = pkg_repos.get(name, '')
-            result.items.append(RPM(
-                name=name,
-                version=version,
-                epoch=epoch,
-                packager=packager,
-                arch=arch,
-                release=release,
-                pgpsig=pgpsig,
-                repository=repository))
-        self.produce(result)
+        rpmscanner.process()
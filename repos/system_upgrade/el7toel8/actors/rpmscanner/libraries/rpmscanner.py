@@ -1,6 +1,10 @@
+import os
 import warnings
 
 from leapp.exceptions import StopActorExecutionError
+from leapp.libraries.common import rpms
+from leapp.libraries.stdlib import api
+from leapp.models import InstalledPackedRPM, InstalledRPM, RPM
 
 no_yum = False
 no_yum_warning_msg = "package `yum` is unavailable"
@@ -10,6 +14,14 @@ except ImportError:
     no_yum = True
     warnings.warn(no_yum_warning_msg, ImportWarning)
 
+no_rpm = False
+try:
+    import rpm
+except ImportError:
+    no_rpm = True
+
+YUMDB_DIR = '/var/lib/yum/yumdb'
+
 
 def get_package_repository_data():
     """ Return dictionary mapping package name with repository from which it was installed.
@@ -37,3 +49,119 @@ def get_package_repository_data():
             })
 
     return pkg_repos
+
+
+def get_yumdb_repository_data(yumdb_dir=YUMDB_DIR):
+    """
+    Return dictionary mapping package NEVRA-like key (name-version-release-arch) with its origin repository.
+
+    The data is read directly from the yumdb directory, which is what yum itself does when it evaluates
+    the `from_repo` attribute of installed packages. Each package has its own directory there named
+    `<pkgid>-<name>-<version>-<release>-<arch>`; the pkgid is a checksum, so it never contains a dash.
+
+    Unlike `yum`, the releasever suffix (e.g. `@rhel-7-server-rpms/7Server`) is never appended.
+    """
+    pkg_repos = {}
+    for letter in os.listdir(yumdb_dir):
+        letter_dir = os.path.join(yumdb_dir, letter)
+        if not os.path.isdir(letter_dir):
+            continue
+        for pkg_dir in os.listdir(letter_dir):
+            if '-' not in pkg_dir:
+                continue
+            try:
+                with open(os.path.join(letter_dir, pkg_dir, 'from_repo')) as f:
+                    from_repo = f.read().strip()
+            except (IOError, OSError):
+                continue
+            pkg_repos[pkg_dir.split('-', 1)[1]] = from_repo
+    return pkg_repos
+
+
+def _create_rpm(entry, repository):
+    name, version, release, epoch, packager, arch, pgpsig = entry.split('|')
+    return RPM(
+        name=name,
+        version=version,
+        epoch=epoch,
+        packager=packager,
+        arch=arch,
+        release=release,
+        pgpsig=pgpsig,
+        repository=repository)
+
+
+def _repository_from_yumdb(pkg, yumdb_repos):
+    """
+    Get the repository of the package as `yum` would report it.
+
+    yum does not list gpg-pubkey among installed packages and uses the `installed` pseudo repository
+    for packages without a record in the yumdb.
+    """
+    if pkg.name == 'gpg-pubkey':
+        return ''
+    key = '{}-{}-{}-{}'.format(pkg.name, pkg.version, pkg.release, pkg.arch)
+    return yumdb_repos.get(key, 'installed')
+
+
+def _decode(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def iter_rpmdb_packages(yumdb_dir=YUMDB_DIR):
+    """
+    Yield RPM models for all installed packages, reading the rpmdb through the rpm python bindings.
+
+    Headers are walked just once and are rendered by the same query format as used by `rpm -qa`
+    in `rpms.get_installed_rpms()`, so the produced data is identical to the one obtained by
+    the fallback path.
+    """
+    yumdb_repos = get_yumdb_repository_data(yumdb_dir)
+    ts = rpm.TransactionSet()
+    for hdr in ts.dbMatch():
+        pkg = _create_rpm(_decode(hdr.sprintf(rpms.RPM_QUERY_FORMAT)), repository=None)
+        pkg.repository = _repository_from_yumdb(pkg, yumdb_repos)
+        yield pkg
+
+
+def iter_rpm_query_packages():
+    """
+    Yield RPM models for all installed packages using `rpm -qa` and the yum package sack.
+
+    This is the slower path used when the rpm python bindings or the yumdb are not available.
+    """
+    output = rpms.get_installed_rpms()
+    pkg_repos = get_package_repository_data()
+
+    for entry in output:
+        entry = entry.strip()
+        if not entry:
+            continue
+        pkg = _create_rpm(entry, repository=None)
+        pkg.repository = pkg_repos.get(pkg.name, '')
+        yield pkg
+
+
+def get_installed_rpms(yumdb_dir=YUMDB_DIR):
+    """
+    Get the list of installed packages including repositories they have been installed from.
+
+    Read the rpmdb directly when possible, otherwise fallback to `rpm -qa` and yum.
+    """
+    if not no_rpm and os.path.isdir(yumdb_dir):
+        try:
+            return list(iter_rpmdb_packages(yumdb_dir))
+        except (rpm.error, OSError, ValueError) as err:
+            api.current_logger().warning(
+                'Cannot read the rpmdb directly, falling back to `rpm -qa`: {}'.format(err))
+    else:
+        api.current_logger().debug('The rpm python bindings or the yumdb are unavailable, using `rpm -qa`.')
+    return list(iter_rpm_query_packages())
+
+
+def process():
+    installed_rpms = get_installed_rpms()
+    api.produce(InstalledRPM(items=installed_rpms))
+    api.produce(InstalledPackedRPM(packages=rpms.pack_rpms(installed_rpms)))
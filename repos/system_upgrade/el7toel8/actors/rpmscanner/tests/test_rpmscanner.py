@@ -1,7 +1,13 @@
+import os
 import sys
+import time
+from collections import Counter
 
 import pytest
 
+from leapp.libraries.actor import rpmscanner
+from leapp.libraries.common.testutils import logger_mocked
+from leapp.libraries.stdlib import api
 from leapp.models import InstalledRPM
 from leapp.snactor.fixture import current_actor_context
 
@@ -11,6 +17,90 @@ try:
 except ImportError:
     no_yum = True
 
+no_rpm = False
+try:
+    import rpm
+except ImportError:
+    no_rpm = True
+
+PGPSIG = 'RSA/SHA256, Mon 01 Jan 1970 00:00:00 AM UTC, Key ID 199e2f91fd431d51'
+
+
+def _create_yumdb_entry(yumdb_dir, pkgid, nvra, from_repo=None):
+    entry = yumdb_dir.join(nvra[0], '{}-{}'.format(pkgid, nvra))
+    entry.ensure(dir=True)
+    if from_repo is not None:
+        entry.join('from_repo').write(from_repo)
+
+
+def test_get_yumdb_repository_data(tmpdir):
+    _create_yumdb_entry(tmpdir, 'a1b2', 'bash-4.2.46-34.el7-x86_64', 'rhel-7-server-rpms')
+    _create_yumdb_entry(tmpdir, 'c3d4', 'bash-completion-2.1-8.el7-noarch', 'anaconda')
+    _create_yumdb_entry(tmpdir, 'e5f6', 'kernel-3.10.0-1160.el7-x86_64')
+    tmpdir.join('unexpected-file').write('')
+
+    pkg_repos = rpmscanner.get_yumdb_repository_data(str(tmpdir))
+    assert pkg_repos == {
+        'bash-4.2.46-34.el7-x86_64': 'rhel-7-server-rpms',
+        'bash-completion-2.1-8.el7-noarch': 'anaconda',
+    }
+
+
+class MockedHeader(object):
+    def __init__(self, entry):
+        self.entry = entry
+
+    def sprintf(self, fmt):
+        assert fmt == rpmscanner.rpms.RPM_QUERY_FORMAT
+        return self.entry
+
+
+class MockedTransactionSet(object):
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __call__(self):
+        return self
+
+    def dbMatch(self):
+        return (MockedHeader(entry) for entry in self.entries)
+
+
+class MockedRpmModule(object):
+    def __init__(self, entries):
+        self.TransactionSet = MockedTransactionSet(entries)
+
+
+def test_iter_rpmdb_packages(monkeypatch, tmpdir):
+    _create_yumdb_entry(tmpdir, 'a1b2', 'bash-4.2.46-34.el7-x86_64', 'rhel-7-server-rpms')
+    entries = [
+        'bash|4.2.46|34.el7|(none)|Red Hat, Inc. <http://bugzilla.redhat.com/bugzilla>|x86_64|' + PGPSIG,
+        'custom|1.0|1|1|(none)|noarch|(none)',
+        'gpg-pubkey|fd431d51|4ae0493b|(none)|Red Hat, Inc. <security@redhat.com>||(none)',
+    ]
+    monkeypatch.setattr(rpmscanner, 'rpm', MockedRpmModule(entries), raising=False)
+
+    pkgs = list(rpmscanner.iter_rpmdb_packages(str(tmpdir)))
+    assert [(p.name, p.epoch, p.arch, p.repository) for p in pkgs] == [
+        ('bash', '(none)', 'x86_64', 'rhel-7-server-rpms'),
+        ('custom', '1', 'noarch', 'installed'),
+        ('gpg-pubkey', '(none)', '', ''),
+    ]
+    assert pkgs[0].pgpsig == PGPSIG
+
+
+def test_get_installed_rpms_fallback(monkeypatch, tmpdir):
+    entries = ['bash|4.2.46|34.el7|(none)|Red Hat, Inc.|x86_64|' + PGPSIG, '']
+    monkeypatch.setattr(rpmscanner, 'no_rpm', True)
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    monkeypatch.setattr(rpmscanner.rpms, 'get_installed_rpms', lambda: entries)
+    monkeypatch.setattr(rpmscanner, 'get_package_repository_data', lambda: {'bash': 'rhel-7-server-rpms'})
+
+    pkgs = rpmscanner.get_installed_rpms(str(tmpdir))
+    assert len(pkgs) == 1
+    assert pkgs[0].name == 'bash'
+    assert pkgs[0].repository == 'rhel-7-server-rpms'
+
 
 @pytest.mark.skipif(
     sys.version_info.major >= 3,
@@ -25,3 +115,30 @@ def test_actor_execution(current_actor_context):
     current_actor_context.run()
     assert current_actor_context.consume(InstalledRPM)
     assert current_actor_context.consume(InstalledRPM)[0].items
+
+
+@pytest.mark.skipif(no_yum, reason="yum is unavailable")
+@pytest.mark.skipif(no_rpm, reason="rpm python bindings are unavailable")
+@pytest.mark.skipif(not os.path.isdir(rpmscanner.YUMDB_DIR), reason="yumdb is unavailable")
+def test_rpmdb_reader_matches_rpm_query():
+    start = time.time()
+    native = list(rpmscanner.iter_rpmdb_packages())
+    native_time = time.time() - start
+
+    start = time.time()
+    fallback = list(rpmscanner.iter_rpm_query_packages())
+    fallback_time = time.time() - start
+
+    api.current_logger().info(
+        'Scanned {} packages: rpmdb reader {:.3f}s, rpm -qa + yum {:.3f}s'.format(
+            len(native), native_time, fallback_time))
+
+    def _key(pkg):
+        return (pkg.name, pkg.version, pkg.release, pkg.arch)
+
+    # yum maps repositories by package name only, compare just packages with a unique name;
+    # the releasever suffix is never set by the rpmdb reader
+    names = Counter(pkg.name for pkg in native)
+    assert sorted(map(_key, native)) == sorted(map(_key, fallback))
+    assert ({(p.name, p.repository) for p in native if names[p.name] == 1}
+            == {(p.name, p.repository.split('/')[0]) for p in fallback if names[p.name] == 1})
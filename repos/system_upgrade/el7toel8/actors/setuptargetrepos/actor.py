@@ -1,9 +1,10 @@
 import platform
 
 from leapp.actors import Actor
-from leapp.models import (CustomTargetRepository, RepositoriesBlacklisted, RepositoriesFacts, RepositoriesMap,
-                          RepositoriesSetupTasks, RHELTargetRepository, SkippedRepositories, TargetRepositories,
-                          UsedRepositories)
+from leapp.libraries.common.repofileutils import RepositoriesUsageIndex
+from leapp.libraries.common.repomaputils import get_repositories_map_index
+from leapp.models import (CustomTargetRepository, RepositoriesBlacklisted, RepositoriesMap, RepositoriesSetupTasks,
+                          RepositoriesUsage, RHELTargetRepository, SkippedRepositories, TargetRepositories)
 from leapp.tags import FactsPhaseTag, IPUWorkflowTag
 
 
@@ -20,9 +21,8 @@ class SetupTargetRepos(Actor):
     consumes = (CustomTargetRepository,
                 RepositoriesSetupTasks,
                 RepositoriesMap,
-                RepositoriesFacts,
                 RepositoriesBlacklisted,
-                UsedRepositories)
+                RepositoriesUsage)
     produces = (TargetRepositories, SkippedRepositories)
     tags = (IPUWorkflowTag, FactsPhaseTag)
 
@@ -31,40 +31,26 @@ class SetupTargetRepos(Actor):
         for repo in self.consume(CustomTargetRepository):
             custom_repos.append(repo)
 
-        enabled_repos = set()
-        for repos in self.consume(RepositoriesFacts):
-            for repo_file in repos.repositories:
-                for repo in repo_file.data:
-                    if repo.enabled:
-                        enabled_repos.add(repo.repoid)
+        repos_usage = RepositoriesUsageIndex(next(self.consume(RepositoriesUsage), None))
+        enabled_repos = repos_usage.enabled_repoids()
 
         rhel_repos = []
         mapped_repos = set()
-        for repos_map in self.consume(RepositoriesMap):
-            for repo_map in repos_map.repositories:
-                # Check if repository map architecture matches system architecture
-                if platform.machine() != repo_map.arch:
-                    continue
-
-                mapped_repos.add(repo_map.from_repoid)
-                if repo_map.from_repoid in enabled_repos:
+        repos_map = get_repositories_map_index()
+        if repos_map:
+            # Use just the mapping records for the system architecture
+            arch = platform.machine()
+            mapped_repos = repos_map.from_repoids(arch)
+            for repoid in sorted(enabled_repos & mapped_repos):
+                for repo_map in repos_map.by_from_repoid(repoid, arch=arch):
                     rhel_repos.append(RHELTargetRepository(repoid=repo_map.to_repoid))
 
-        skipped_repos = enabled_repos.difference(mapped_repos)
-
-        used = {}
-        for used_repos in self.consume(UsedRepositories):
-            for used_repo in used_repos.repositories:
-                used[used_repo.repository] = used_repo.packages
-                for repo in repo_file.data:
-                    enabled_repos.add(repo.repoid)
-
-        skipped_repos = skipped_repos.intersection(set(used.keys()))
+        skipped_repos = repos_usage.used_repoids().difference(mapped_repos)
 
         if skipped_repos:
             pkgs = set()
             for repo in skipped_repos:
-                pkgs.update(used[repo])
+                pkgs.update(repos_usage.packages(repo))
             self.produce(SkippedRepositories(repos=list(skipped_repos), packages=list(pkgs)))
 
         for task in self.consume(RepositoriesSetupTasks):
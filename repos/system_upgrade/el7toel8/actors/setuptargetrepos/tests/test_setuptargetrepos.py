@@ -1,7 +1,6 @@
 from leapp.libraries import stdlib
-from leapp.models import CustomTargetRepository, TargetRepositories, RepositoryData, \
-    RepositoryFile, RepositoriesFacts, RepositoryMap, RepositoriesMap, RepositoriesSetupTasks, \
-    RepositoriesBlacklisted
+from leapp.models import CustomTargetRepository, TargetRepositories, RepositoryMap, RepositoriesMap, \
+    RepositoriesSetupTasks, RepositoriesBlacklisted, RepositoriesUsage, RepositoryUsage, SkippedRepositories
 
 
 def test_minimal_execution(current_actor_context):
@@ -50,11 +49,9 @@ def test_repositories_setup_tasks(current_actor_context):
 
 
 def test_repos_mapping(current_actor_context):
-    repos_data = [
-        RepositoryData(repoid='rhel-7-server-rpms', name='RHEL 7 Server'),
-        RepositoryData(repoid='rhel-7-blacklisted-rpms', name='RHEL 7 Blacklisted')]
-    repos_files = [RepositoryFile(file='/etc/yum.repos.d/redhat.repo', data=repos_data)]
-    facts = RepositoriesFacts(repositories=repos_files)
+    facts = RepositoriesUsage(repositories=[
+        RepositoryUsage(repoid='rhel-7-server-rpms', url_kind='remote'),
+        RepositoryUsage(repoid='rhel-7-blacklisted-rpms', url_kind='remote')])
     arch = stdlib.run(['uname', '-m'])['stdout'].strip()
 
     mapping = [RepositoryMap(from_repoid='rhel-7-server-rpms',
@@ -92,3 +89,18 @@ def test_repos_mapping(current_actor_context):
     assert len(rhel_repos) == 2
     assert {repo.repoid for repo in rhel_repos} == {'rhel-8-for-x86_64-baseos-htb-rpms',
                                                     'rhel-8-for-x86_64-appstream-htb-rpms'}
+
+
+def test_skipped_repos(current_actor_context):
+    usage = RepositoriesUsage(repositories=[
+        RepositoryUsage(repoid='rhel-7-server-rpms', url_kind='remote', packages=['bash']),
+        RepositoryUsage(repoid='unknown-used-rpms', url_kind='remote', packages=['pkg1', 'pkg2']),
+        RepositoryUsage(repoid='unknown-unused-rpms', url_kind='remote'),
+        RepositoryUsage(repoid='unknown-disabled-rpms', url_kind='remote', enabled=False, packages=['pkg3'])])
+
+    current_actor_context.feed(usage)
+    current_actor_context.run()
+    skipped = current_actor_context.consume(SkippedRepositories)
+    assert len(skipped) == 1
+    assert set(skipped[0].repos) == {'rhel-7-server-rpms', 'unknown-used-rpms'}
+    assert set(skipped[0].packages) == {'bash', 'pkg1', 'pkg2'}
@@ -1,5 +1,8 @@
+import hashlib
 import itertools
+import json
 import os
+import re
 
 from leapp import reporting
 from leapp.exceptions import StopActorExecution, StopActorExecutionError
@@ -53,6 +56,20 @@ from leapp.models import (
 # Issue: #486
 
 PROD_CERTS_FOLDER = 'prod-certs'
+USERSPACE_MANIFEST_FORMAT = 1
+"""Version of the target userspace manifest; bump it whenever the way the userspace is created changes."""
+USERSPACE_RPMDB_FILES = ('var/lib/rpm/Packages', 'var/lib/rpm/rpmdb.sqlite')
+
+_TARBALL_DECOMPRESSORS = (
+    # (suffixes, parallel decompressors, fallback decompressor)
+    (('.tar.gz', '.tgz'), ('pigz',), 'gzip'),
+    (('.tar.xz', '.txz'), ('pixz',), 'xz'),
+    (('.tar.zst', '.tzst'), (), 'zstd'),
+    (('.tar.bz2', '.tbz2'), ('lbzip2', 'pbzip2'), 'bzip2'),
+    (('.tar',), (), None),
+)
+_RE_NOT_PROVIDED = re.compile(r'^no package provides (\S+)', re.MULTILINE)
+_RE_REPOINFO = re.compile(r'^Repo-(id|revision)\s*:\s*(\S+)', re.MULTILINE)
 
 
 def _check_deprecated_rhsm_skip():
@@ -102,15 +119,257 @@ class _InputData(object):
             raise StopActorExecutionError('No storage info available cannot proceed.')
 
 
-def prepare_target_userspace(context, userspace_dir, enabled_repos, packages):
+def _get_dnf_repos_opts(enabled_repos, cached_repoids=()):
+    repos_opt = [['--enablerepo', repo] for repo in enabled_repos]
+    return (['--disablerepo', '*'] + list(itertools.chain(*repos_opt))
+            + dnfplugin.get_metadata_expire_opts(set(cached_repoids).intersection(enabled_repos)))
+
+
+def _get_repos_revisions(context, enabled_repos, cached_repoids=()):
+    """
+    Get revisions of metadata of the enabled repositories as reported by dnf inside the context.
+
+    :return: dict {repoid: revision} or None if the revisions cannot be obtained
+    """
+    cmd = ['dnf', 'repoinfo', '-q',
+           '--setopt=module_platform_id=platform:el8',
+           '--releasever', api.current_actor().configuration.version.target,
+           ] + _get_dnf_repos_opts(enabled_repos, cached_repoids)
+    if rhsm.skip_rhsm():
+        cmd += ['--disableplugin', 'subscription-manager']
+    try:
+        stdout = context.call(cmd, split=False)['stdout']
+    except CalledProcessError as exc:
+        api.current_logger().debug('Cannot get revisions of the target repositories: {}'.format(exc))
+        return None
+    revisions = {}
+    repoid = None
+    for key, value in _RE_REPOINFO.findall(stdout):
+        if key == 'id':
+            repoid = value
+        elif repoid:
+            revisions[repoid] = value
+    if set(revisions) != set(enabled_repos):
+        return None
+    return revisions
+
+
+def _get_userspace_rpmdb_digest(userspace_dir):
+    for rpmdb_file in USERSPACE_RPMDB_FILES:
+        path = os.path.join(userspace_dir, rpmdb_file)
+        if not os.path.isfile(path):
+            continue
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return '{}:{}'.format(rpmdb_file, digest.hexdigest())
+    return None
+
+
+def _create_userspace_manifest(context, enabled_repos, packages, cached_repoids=()):
+    """
+    Create the manifest describing the target userspace that would be created for the given input.
+
+    :return: dict with the manifest or None if the userspace cannot be described reliably
+    """
+    revisions = _get_repos_revisions(context, enabled_repos, cached_repoids)
+    if revisions is None:
+        return None
+    return {
+        'format': USERSPACE_MANIFEST_FORMAT,
+        'target_version': api.current_actor().configuration.version.target,
+        'architecture': api.current_actor().configuration.architecture,
+        'no_rhsm': rhsm.skip_rhsm(),
+        'enabled_repos': sorted(enabled_repos),
+        'packages': sorted(set(packages)),
+        'repos_revisions': revisions,
+    }
+
+
+def _read_userspace_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _is_userspace_reusable(userspace_dir, manifest, manifest_path):
+    """
+    Check whether the previously created target userspace matches the manifest and has not been modified.
+
+    The modification is detected just by the digest of the rpmdb, i.e. only changes of the installed
+    package set are detected. Content of the installed files is not verified, nor are files not owned
+    by any package (e.g. leftovers of previous runs). Set LEAPP_REBUILD_TARGET_USERSPACE=1 to create
+    the target userspace from scratch when it could have been modified otherwise.
+    """
+    if get_env('LEAPP_REBUILD_TARGET_USERSPACE', '0') == '1':
+        api.current_logger().info('Rebuild of the target userspace has been requested.')
+        return False
+    if manifest is None:
+        return False
+    stored = _read_userspace_manifest(manifest_path)
+    if not stored or stored.get('manifest') != manifest or stored.get('userspace_dir') != userspace_dir:
+        return False
+    if stored.get('rpmdb_digest') != _get_userspace_rpmdb_digest(userspace_dir):
+        api.current_logger().warning('The previously created target userspace has been modified, creating it again.')
+        return False
+    return True
+
+
+def _store_userspace_manifest(userspace_dir, manifest, manifest_path):
+    data = {
+        'manifest': manifest,
+        'userspace_dir': userspace_dir,
+        'rpmdb_digest': _get_userspace_rpmdb_digest(userspace_dir),
+    }
+    try:
+        with open(manifest_path, 'w') as f:
+            json.dump(data, f)
+    except (IOError, OSError) as err:
+        api.current_logger().warning('Cannot store the target userspace manifest: {}'.format(err))
+
+
+def _remove_userspace_manifest(manifest_path):
+    try:
+        os.unlink(manifest_path)
+    except OSError:
+        pass
+
+
+def _find_executable(name):
+    for path in os.environ.get('PATH', '/usr/bin:/bin').split(os.pathsep):
+        executable = os.path.join(path, name)
+        if os.path.isfile(executable) and os.access(executable, os.X_OK):
+            return executable
+    return None
+
+
+def _get_tar_decompress_opts(image):
+    """
+    Get tar options to decompress the image, using a parallel decompressor when available.
+
+    :return: list of options, or None if the image is not a (supported) tarball
+    """
+    for suffixes, parallel_programs, fallback in _TARBALL_DECOMPRESSORS:
+        if not image.endswith(suffixes):
+            continue
+        for program in parallel_programs:
+            if _find_executable(program):
+                return ['--use-compress-program', program]
+        return ['--use-compress-program', fallback] if fallback else []
+    return None
+
+
+def _get_missing_packages(userspace_dir, packages):
+    """
+    Return the given packages which are not provided by any package installed in the userspace.
+
+    The required packages can be specified also by capabilities, so they are queried as provides.
+    """
+    try:
+        run(['rpm', '--root', userspace_dir, '-q', '--whatprovides'] + sorted(packages), split=False)
+    except CalledProcessError as exc:
+        missing = _RE_NOT_PROVIDED.findall(exc.stdout or '')
+        return missing or sorted(packages)
+    return []
+
+
+def _get_userspace_release(userspace_dir):
+    """Return the version of the redhat-release package installed in the userspace or None."""
+    try:
+        result = run(['rpm', '--root', userspace_dir, '-q', '--queryformat', r'%{VERSION}\n',
+                      '--whatprovides', 'redhat-release'], split=False)
+    except CalledProcessError:
+        return None
+    versions = (result['stdout'] or '').split()
+    return versions[0] if versions else None
+
+
+def _prepare_target_userspace_from_image(image, userspace_dir, packages):
+    """
+    Create the target userspace from the prebuilt image.
+
+    The image is either a tarball (optionally compressed) or a filesystem image (e.g. squashfs) which
+    is loop mounted. The content is copied into the userspace directory, as the userspace is used
+    by actors in later phases and has to be writable.
+
+    :return: True if the userspace has been created for the target release and contains all required packages
+    """
+    if not os.path.isfile(image):
+        api.current_logger().warning('The target userspace image {} does not exist.'.format(image))
+        return False
+
+    run(['rm', '-rf', userspace_dir])
+    _create_target_userspace_directories(userspace_dir)
+    tar_opts = _get_tar_decompress_opts(image)
+    try:
+        if tar_opts is not None:
+            run(['tar', '--extract', '--file', image, '--directory', userspace_dir,
+                 '--numeric-owner', '--xattrs', '--acls', '--selinux'] + tar_opts, split=False)
+        else:
+            with mounting.LoopMount(source=image, target=os.path.join(constants.MOUNTS_DIR, 'userspace-image')) as img:
+                run(['cp', '-a', '--reflink=auto', os.path.join(img.target, '.'), userspace_dir], split=False)
+    except (CalledProcessError, mounting.MountError) as exc:
+        api.current_logger().warning('Cannot create the target userspace from the image {}: {}'.format(image, exc))
+        return False
+
+    release = _get_userspace_release(userspace_dir)
+    target_version = api.current_actor().configuration.version.target
+    if release != target_version:
+        api.current_logger().warning(
+            'The target userspace image {} has been built for the {} release instead of {}.'.format(
+                image, release or 'unknown', target_version))
+        return False
+    missing = _get_missing_packages(userspace_dir, packages)
+    if missing:
+        api.current_logger().warning(
+            'The target userspace image {} does not contain required packages: {}'.format(image, ', '.join(missing)))
+        return False
+    return True
+
+
+def prepare_target_userspace(context, userspace_dir, enabled_repos, packages,
+                             manifest_path=constants.TARGET_USERSPACE_MANIFEST, cached_repoids=()):
     """
     Implement the creation of the target userspace.
+
+    The created userspace is described by a manifest (target version, enabled repositories, required
+    packages and revisions of the repositories metadata). When the userspace created by a previous run
+    matches the manifest and its rpmdb has not been changed since then, it is reused. Set the
+    LEAPP_REBUILD_TARGET_USERSPACE=1 environment variable to create the userspace again anyway.
+
+    When the LEAPP_TARGET_USERSPACE_IMAGE environment variable is set, the userspace is created
+    from the prebuilt image instead; dnf is used only if the image cannot be used (e.g. it has been
+    built for another release or it does not provide all required packages).
+
+    Metadata of repositories listed in cached_repoids have been downloaded already into the dnf cache
+    of the context, which is used by dnf also for the installation into the userspace.
     """
+    image = get_env('LEAPP_TARGET_USERSPACE_IMAGE', '')
+    if image:
+        _remove_userspace_manifest(manifest_path)
+        if _prepare_target_userspace_from_image(image, userspace_dir, packages):
+            api.current_logger().info('The target userspace has been created from the image {}'.format(image))
+            return
+        api.current_logger().warning('Creating the target userspace using dnf instead of the image.')
+
+    manifest = _create_userspace_manifest(context, enabled_repos, packages, cached_repoids)
+    if _is_userspace_reusable(userspace_dir, manifest, manifest_path):
+        api.current_logger().info('Reusing the target userspace created previously in {}'.format(userspace_dir))
+        return
+    _remove_userspace_manifest(manifest_path)
+
     run(['rm', '-rf', userspace_dir])
     _create_target_userspace_directories(userspace_dir)
-    with mounting.BindMount(source=userspace_dir, target=os.path.join(context.base_dir, 'el8target')):
-        repos_opt = [['--enablerepo', repo] for repo in enabled_repos]
-        repos_opt = list(itertools.chain(*repos_opt))
+    installroot = os.path.join(context.base_dir, 'el8target')
+    if cached_repoids:
+        cache_mount = mounting.BindMount(
+            source=dnfplugin.DNF_CACHE_DIR, target=os.path.join(installroot, dnfplugin.DNF_CACHE_DIR.lstrip('/')))
+    else:
+        cache_mount = mounting.NullMount(target=installroot)
+    with mounting.BindMount(source=userspace_dir, target=installroot), cache_mount:
         cmd = ['dnf',
                'install',
                '-y',
@@ -119,8 +378,7 @@ def prepare_target_userspace(context, userspace_dir, enabled_repos, packages):
                '--setopt=keepcache=1',
                '--releasever', api.current_actor().configuration.version.target,
                '--installroot', '/el8target',
-               '--disablerepo', '*'
-               ] + repos_opt + packages
+               ] + _get_dnf_repos_opts(enabled_repos, cached_repoids) + packages
         if config.is_verbose():
             cmd.append('-v')
         if rhsm.skip_rhsm():
@@ -132,19 +390,23 @@ def prepare_target_userspace(context, userspace_dir, enabled_repos, packages):
                 message='Unable to install RHEL 8 userspace packages.',
                 details={'details': str(exc), 'stderr': exc.stderr}
             )
+    if manifest is not None:
+        _store_userspace_manifest(userspace_dir, manifest, manifest_path)
 
 
 def _prep_repository_access(context, target_userspace):
     """
     Prepare repository access by copying all relevant certificates and configuration files to the userspace
+
+    The directories are synchronized, so just files changed since the previous run are copied
+    when the userspace is reused.
     """
+    dirs = ['/etc/yum.repos.d']
     if not rhsm.skip_rhsm():
-        run(['rm', '-rf', os.path.join(target_userspace, 'etc', 'pki')])
-        run(['rm', '-rf', os.path.join(target_userspace, 'etc', 'rhsm')])
-        context.copytree_from('/etc/pki', os.path.join(target_userspace, 'etc', 'pki'))
-        context.copytree_from('/etc/rhsm', os.path.join(target_userspace, 'etc', 'rhsm'))
-    run(['rm', '-rf', os.path.join(target_userspace, 'etc', 'yum.repos.d')])
-    context.copytree_from('/etc/yum.repos.d', os.path.join(target_userspace, 'etc', 'yum.repos.d'))
+        dirs = ['/etc/pki', '/etc/rhsm'] + dirs
+    for path in dirs:
+        context.copytree_from(path, os.path.join(target_userspace, path.lstrip('/')),
+                              mode=mounting.CopyMode.REFLINK, sync=True)
 
 
 def _get_product_certificate_path():
@@ -451,9 +713,10 @@ def _gather_target_repositories(context, indata, prod_cert_path):
     return gather_target_repositories(context, indata)
 
 
-def _create_target_userspace(context, packages, target_repoids):
+def _create_target_userspace(context, packages, target_repoids, cached_repoids=()):
     """Create the target userspace."""
-    prepare_target_userspace(context, constants.TARGET_USERSPACE, target_repoids, list(packages))
+    prepare_target_userspace(context, constants.TARGET_USERSPACE, target_repoids, list(packages),
+                             cached_repoids=cached_repoids)
     _prep_repository_access(context, constants.TARGET_USERSPACE)
     dnfplugin.install(constants.TARGET_USERSPACE)
     # and do not forget to set the rhsm into the container mode again
@@ -473,15 +736,19 @@ def perform():
             scratch_dir=constants.SCRATCH_DIR,
             storage_info=indata.storage_info,
             xfs_info=indata.xfs_info) as overlay:
-        with overlay.nspawn() as context:
+        # many commands are executed in the context, do not start a new container for each of them
+        with overlay.nspawn(session=True) as context:
             target_repoids = _gather_target_repositories(context, indata, prod_cert_path)
-            _create_target_userspace(context, indata.packages, target_repoids)
+            # download metadata of all target repositories once, for all later dnf executions
+            cached_repoids = dnfplugin.make_metadata_cache(context, target_repoids)
+            _create_target_userspace(context, indata.packages, target_repoids, cached_repoids)
             # TODO: this is tmp solution as proper one needs significant refactoring
             target_repo_facts = repofileutils.get_parsed_repofiles(context)
             api.produce(TMPTargetRepositoriesFacts(repositories=target_repo_facts))
             # ## fixme ends here
             api.produce(UsedTargetRepositories(
-                repos=[UsedTargetRepository(repoid=repo) for repo in target_repoids]))
+                repos=[UsedTargetRepository(repoid=repo, metadata_cached=repo in cached_repoids)
+                       for repo in target_repoids]))
             api.produce(TargetUserSpaceInfo(
                 path=constants.TARGET_USERSPACE,
                 scratch=constants.SCRATCH_DIR,
@@ -9,6 +9,7 @@ from leapp.libraries.actor import userspacegen
 from leapp.libraries.common import overlaygen, repofileutils, rhsm
 from leapp.libraries.common.config import architecture
 from leapp.libraries.common.testutils import CurrentActorMocked, logger_mocked, produce_mocked
+from leapp.libraries.stdlib import CalledProcessError
 
 CUR_DIR = os.path.dirname(os.path.abspath(__file__))
 _CERTS_PATH = os.path.join(CUR_DIR, '../../../files', userspacegen.PROD_CERTS_FOLDER)
@@ -27,7 +28,7 @@ class MockedMountingBase(object):
     def __init__(self, **dummy_kwargs):
         self.called_copytree_from = []
 
-    def copytree_from(self, src, dst):
+    def copytree_from(self, src, dst, **dummy_kwargs):
         self.called_copytree_from.append((src, dst))
 
     def __call__(self, **dummy_kwarg):
@@ -36,7 +37,10 @@ class MockedMountingBase(object):
     def call(self, *args, **kwargs):
         return {'stdout': ''}
 
-    def nspawn(self):
+    def full_path(self, path):
+        return os.path.join('/nonexistent', path.lstrip('/'))
+
+    def nspawn(self, **dummy_kwargs):
         return self
 
     def __enter__(self):
@@ -302,3 +306,180 @@ def test_perform_ok(monkeypatch):
     assert userspacegen.api.produce.model_instances[1] == msg_target_repos
     # this one is full of contants, so it's safe to check just the instance
     assert isinstance(userspacegen.api.produce.model_instances[2], models.TargetUserSpaceInfo)
+
+
+class UserspaceContextMocked(object):
+    base_dir = '/nonexistent/overlay'
+
+    def __init__(self, userspace_dir, revisions):
+        self.userspace_dir = userspace_dir
+        self.revisions = revisions
+        self.installs = 0
+
+    def call(self, cmd, **dummy_kwargs):
+        if cmd[1] == 'repoinfo':
+            stdout = ''.join(
+                'Repo-id      : {}\nRepo-name    : {} name\nRepo-revision: {}\n\n'.format(repoid, repoid, revision)
+                for repoid, revision in sorted(self.revisions.items()))
+            return {'stdout': stdout}
+        self.installs += 1
+        rpmdb_dir = os.path.join(self.userspace_dir, 'var/lib/rpm')
+        if not os.path.isdir(rpmdb_dir):
+            os.makedirs(rpmdb_dir)
+        with open(os.path.join(rpmdb_dir, 'Packages'), 'w') as f:
+            f.write(' '.join(cmd))
+        return {'stdout': ''}
+
+
+class BindMountMocked(object):
+    def __init__(self, **dummy_kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dummy_args):
+        pass
+
+
+def test_prepare_target_userspace_reused(monkeypatch, tmpdir):
+    userspace_dir = str(tmpdir.join('el8userspace'))
+    manifest_path = str(tmpdir.join('el8userspace.manifest.json'))
+    removed = []
+    monkeypatch.setattr(userspacegen.api, 'current_actor', CurrentActorMocked(envars={'LEAPP_NO_RHSM': '0'}))
+    monkeypatch.setattr(userspacegen, 'run', lambda cmd: removed.append(cmd[-1]))
+    monkeypatch.setattr(userspacegen.mounting, 'BindMount', BindMountMocked)
+    monkeypatch.setattr(userspacegen.config, 'is_verbose', lambda: False)
+
+    context = UserspaceContextMocked(userspace_dir, {'baseos': '1', 'appstream': '2'})
+
+    def _prepare(packages=('dnf', 'pkgA')):
+        userspacegen.prepare_target_userspace(
+            context, userspace_dir, ['baseos', 'appstream'], list(packages), manifest_path=manifest_path)
+
+    _prepare()
+    assert context.installs == 1
+    assert removed == [userspace_dir]
+    _prepare(packages=('pkgA', 'dnf'))
+    assert context.installs == 1
+
+    # changed metadata of a repository
+    context.revisions['appstream'] = '3'
+    _prepare()
+    assert context.installs == 2
+    _prepare()
+    assert context.installs == 2
+
+    # changed set of packages
+    _prepare(packages=('dnf', 'pkgB'))
+    assert context.installs == 3
+
+    # modified userspace
+    with open(os.path.join(userspace_dir, 'var/lib/rpm/Packages'), 'a') as f:
+        f.write('modified')
+    _prepare(packages=('dnf', 'pkgB'))
+    assert context.installs == 4
+
+    # rebuild requested explicitly
+    monkeypatch.setattr(userspacegen.api, 'current_actor', CurrentActorMocked(
+        envars={'LEAPP_NO_RHSM': '0', 'LEAPP_REBUILD_TARGET_USERSPACE': '1'}))
+    _prepare(packages=('dnf', 'pkgB'))
+    assert context.installs == 5
+
+    # missing revision of a repository, the userspace cannot be cached
+    monkeypatch.setattr(userspacegen.api, 'current_actor', CurrentActorMocked(envars={'LEAPP_NO_RHSM': '0'}))
+    del context.revisions['appstream']
+    _prepare(packages=('dnf', 'pkgB'))
+    _prepare(packages=('dnf', 'pkgB'))
+    assert context.installs == 7
+    assert not os.path.exists(manifest_path)
+
+
+@pytest.mark.parametrize('image,executables,expected', [
+    ('/images/userspace.tar.gz', ['pigz', 'gzip'], ['--use-compress-program', 'pigz']),
+    ('/images/userspace.tgz', ['gzip'], ['--use-compress-program', 'gzip']),
+    ('/images/userspace.tar.xz', ['pixz'], ['--use-compress-program', 'pixz']),
+    ('/images/userspace.tar.bz2', ['pbzip2'], ['--use-compress-program', 'pbzip2']),
+    ('/images/userspace.tar', [], []),
+    ('/images/userspace.squashfs', ['pigz'], None),
+])
+def test_get_tar_decompress_opts(monkeypatch, image, executables, expected):
+    monkeypatch.setattr(userspacegen, '_find_executable', lambda name: name if name in executables else None)
+    assert userspacegen._get_tar_decompress_opts(image) == expected
+
+
+class RunImageMocked(object):
+    """Simulate rpm queries in the image providing the given capabilities, built for the given release"""
+
+    def __init__(self, provided, release):
+        self.provided = provided
+        self.release = release
+        self.commands = []
+
+    def __call__(self, cmd, **dummy_kwargs):
+        self.commands.append(cmd)
+        if cmd[0] != 'rpm':
+            return {'stdout': ''}
+        if '--queryformat' in cmd:
+            return {'stdout': self.release + '\n'}
+        missing = [cap for cap in cmd[5:] if cap not in self.provided]
+        if missing:
+            stdout = ''.join('no package provides {}\n'.format(cap) for cap in missing)
+            raise CalledProcessError(message='rpm failed', command=cmd,
+                                     result={'exit_code': len(missing), 'stdout': stdout, 'stderr': ''})
+        return {'stdout': ''}
+
+
+@pytest.mark.parametrize('provided,release,used,warning', [
+    ({'dnf', 'pkgA', '/usr/bin/pkgB'}, '8.1', True, None),
+    ({'dnf', '/usr/bin/pkgB'}, '8.1', False, 'pkgA'),
+    ({'dnf', 'pkgA', '/usr/bin/pkgB'}, '8.0', False, 'built for the 8.0 release instead of 8.1'),
+])
+def test_prepare_target_userspace_from_image(monkeypatch, tmpdir, provided, release, used, warning):
+    image = tmpdir.join('userspace.tar.gz')
+    image.write('')
+    userspace_dir = str(tmpdir.join('el8userspace'))
+    monkeypatch.setattr(userspacegen.api, 'current_actor', CurrentActorMocked(
+        envars={'LEAPP_NO_RHSM': '0', 'LEAPP_TARGET_USERSPACE_IMAGE': str(image)}))
+    monkeypatch.setattr(userspacegen.api, 'current_logger', logger_mocked())
+    monkeypatch.setattr(userspacegen, '_find_executable', lambda name: None)
+    monkeypatch.setattr(userspacegen, 'run', RunImageMocked(provided, release))
+    monkeypatch.setattr(userspacegen.mounting, 'BindMount', BindMountMocked)
+    monkeypatch.setattr(userspacegen.config, 'is_verbose', lambda: False)
+    context = UserspaceContextMocked(userspace_dir, {'baseos': '1'})
+
+    userspacegen.prepare_target_userspace(context, userspace_dir, ['baseos'], ['dnf', 'pkgA', '/usr/bin/pkgB'],
+                                          manifest_path=str(tmpdir.join('manifest.json')))
+
+    assert userspacegen.run.commands[1] == [
+        'tar', '--extract', '--file', str(image), '--directory', userspace_dir,
+        '--numeric-owner', '--xattrs', '--acls', '--selinux', '--use-compress-program', 'gzip']
+    assert userspacegen.run.commands[2][-2:] == ['--whatprovides', 'redhat-release']
+    if release == '8.1':
+        assert userspacegen.run.commands[3] == [
+            'rpm', '--root', userspace_dir, '-q', '--whatprovides', '/usr/bin/pkgB', 'dnf', 'pkgA']
+    # dnf is used just when the image is built for the target release and provides all required packages
+    assert context.installs == (0 if used else 1)
+    if warning:
+        assert warning in userspacegen.api.current_logger.warnmsg[0]
+
+
+def test_prepare_target_userspace_cached_metadata(monkeypatch, tmpdir):
+    userspace_dir = str(tmpdir.join('el8userspace'))
+    mounts = []
+    monkeypatch.setattr(userspacegen.api, 'current_actor', CurrentActorMocked(envars={'LEAPP_NO_RHSM': '0'}))
+    monkeypatch.setattr(userspacegen, 'run', lambda cmd: None)
+    monkeypatch.setattr(userspacegen.mounting, 'BindMount',
+                        lambda **kwargs: mounts.append(kwargs) or BindMountMocked())
+    monkeypatch.setattr(userspacegen.config, 'is_verbose', lambda: False)
+    context = UserspaceContextMocked(userspace_dir, {'baseos': '1', 'appstream': '2'})
+
+    userspacegen.prepare_target_userspace(context, userspace_dir, ['baseos', 'appstream'], ['dnf'],
+                                          manifest_path=str(tmpdir.join('manifest.json')), cached_repoids={'baseos'})
+
+    # the installation uses the dnf cache with metadata downloaded already, without checking their expiration
+    with open(os.path.join(userspace_dir, 'var/lib/rpm/Packages')) as f:
+        cmd = f.read().split()
+    assert '--setopt=baseos.metadata_expire=-1' in cmd
+    assert '--setopt=appstream.metadata_expire=-1' not in cmd
+    assert {'source': '/var/cache/dnf', 'target': '/nonexistent/overlay/el8target/var/cache/dnf'} in mounts
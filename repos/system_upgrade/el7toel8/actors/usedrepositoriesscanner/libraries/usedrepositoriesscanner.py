@@ -0,0 +1,53 @@
+from leapp.libraries.common import repofileutils
+from leapp.libraries.stdlib import api
+from leapp.models import (
+    InstalledRedHatSignedRPM,
+    RepositoriesFacts,
+    RepositoriesUsage,
+    RepositoryUsage,
+    UsedRepositories,
+    UsedRepository
+)
+
+
+def get_repositories_usage(repositories_facts, installed_pkgs):
+    """
+    Map the installed packages to the repositories defined on the system.
+
+    :param repositories_facts: iterable of RepositoriesFacts messages
+    :param installed_pkgs: iterable of RPM models
+    :return: Dictionary {repoid: RepositoryUsage}
+    """
+    usage = {}
+    for repos in repositories_facts:
+        for repo_file in repos.repositories:
+            for repo in repo_file.data:
+                repo_usage = usage.get(repo.repoid)
+                if not repo_usage:
+                    usage[repo.repoid] = RepositoryUsage(
+                        repoid=repo.repoid, enabled=repo.enabled, url_kind=repofileutils.get_url_kind(repo))
+                elif repo.enabled and not repo_usage.enabled:
+                    # the repository is defined in more files, use the enabled definition
+                    repo_usage.enabled = True
+                    repo_usage.url_kind = repofileutils.get_url_kind(repo)
+
+    for pkg in installed_pkgs:
+        repo_usage = usage.get(pkg.repository)
+        if repo_usage:
+            repo_usage.packages.append(pkg.name)
+    return usage
+
+
+def process():
+    installed_pkgs = []
+    for rpm_pkgs in api.consume(InstalledRedHatSignedRPM):
+        installed_pkgs.extend(rpm_pkgs.items)
+
+    usage = get_repositories_usage(api.consume(RepositoriesFacts), installed_pkgs)
+
+    result = UsedRepositories()
+    for repo in usage.values():
+        if repo.enabled and repo.packages:
+            result.repositories.append(UsedRepository(repository=repo.repoid, packages=repo.packages))
+    api.produce(result)
+    api.produce(RepositoriesUsage(repositories=list(usage.values())))
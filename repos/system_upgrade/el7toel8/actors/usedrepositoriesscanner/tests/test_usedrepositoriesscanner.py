@@ -1,6 +1,8 @@
+from leapp.libraries.actor import usedrepositoriesscanner
+from leapp.libraries.common.repofileutils import RepositoriesUsageIndex
 from leapp.snactor.fixture import current_actor_context
 from leapp.models import RPM, InstalledRedHatSignedRPM, RepositoryFile, RepositoryData, \
-    RepositoriesFacts, UsedRepositories
+    RepositoriesFacts, RepositoriesUsage, UsedRepositories
 
 
 def get_sample_rpm(name, repository):
@@ -49,3 +51,47 @@ def test_actor_execution(current_actor_context):
     assert used_repos[0].repository == 'rhel-7-server-rpms'
     assert len(used_repos[0].packages) == 2
     assert used_repos[0].packages == ['pkg1', 'pkg2']
+
+
+def test_repositories_usage(current_actor_context):
+    installed = get_sample_installed_pkgs([
+        ('pkg1', 'rhel-7-server-rpms'),
+        ('pkg2', 'rhel-7-disabled-rpms'),
+        ('pkg3', 'anaconda')])
+    repos = get_sample_repositories([
+        ('rhel-7-server-rpms', 'RHEL 7 Server'),
+        ('rhel-7-disabled-rpms', 'RHEL 7 Disabled')])
+    repos.repositories[1].data[0].enabled = False
+    repos.repositories[0].data[0].baseurl = 'file:///root/repo'
+
+    current_actor_context.feed(installed)
+    current_actor_context.feed(repos)
+    current_actor_context.run()
+    usage = RepositoriesUsageIndex(current_actor_context.consume(RepositoriesUsage)[0])
+    assert usage.enabled_repoids() == {'rhel-7-server-rpms'}
+    assert usage.used_repoids() == {'rhel-7-server-rpms'}
+    assert usage.url_kind('rhel-7-server-rpms') == 'local'
+    assert usage.url_kind('rhel-7-disabled-rpms') == 'none'
+    assert usage.packages('rhel-7-disabled-rpms') == ['pkg2']
+    assert usage.repository_of('pkg1') == 'rhel-7-server-rpms'
+    assert usage.repository_of('pkg3') is None
+
+
+def test_repositories_usage_scaling(monkeypatch):
+    repos = get_sample_repositories([('repo{}'.format(i), 'Repo {}'.format(i)) for i in range(500)])
+    pkgs = [get_sample_rpm('pkg{}'.format(i), 'repo{}'.format(i % 600)) for i in range(5000)]
+    url_kinds = []
+
+    def get_url_kind_mocked(repo):
+        url_kinds.append(repo.repoid)
+        return 'remote'
+
+    monkeypatch.setattr(usedrepositoriesscanner.repofileutils, 'get_url_kind', get_url_kind_mocked)
+    usage = usedrepositoriesscanner.get_repositories_usage([repos], pkgs)
+
+    assert len(usage) == 500
+    # packages from repo500..repo599 are installed from repositories not defined on the system
+    assert sum(len(repo.packages) for repo in usage.values()) == 4200
+    assert usage['repo7'].packages == ['pkg{}'.format(i) for i in range(7, 5000, 600)]
+    # each repository definition is processed just once, regardless of the number of packages
+    assert len(url_kinds) == 500
@@ -1,13 +1,25 @@
 # plugin inspired by "system_upgrade.py" from rpm-software-management
 from __future__ import print_function
 
+import functools
+import hashlib
 import json
+import os
+import resource
 import sys
+import time
 
 import dnf
+import dnf.callback
 import dnf.cli
+import dnf.selector
+import dnf.transaction
 
 CMDS = ['download', 'upgrade', 'check']
+GLOB_CHARS = '*?['
+TRANSACTION_FORMAT = 2
+# download options applied also to each enabled repository, as repository files may set them
+REPO_DOWNLOAD_OPTIONS = ('fastestmirror', 'minrate', 'timeout')
 
 
 class DoNotDownload(Exception):
@@ -18,6 +30,67 @@ def _do_not_download_packages(packages, progress=None, total=None):
     raise DoNotDownload()
 
 
+class DownloadStatistics(dnf.callback.DownloadProgress):
+    """
+    Download progress collecting statistics of the downloaded packages
+
+    All events are passed to the wrapped progress, so the output of dnf is not affected.
+    """
+
+    def __init__(self, progress=None):
+        super(DownloadStatistics, self).__init__()
+        self._progress = progress
+        self._started = {}
+        self.repos = {}
+        self.retries = 0
+        self.failed = 0
+
+    def start(self, total_files, total_size, total_drpms=0):
+        if self._progress:
+            self._progress.start(total_files, total_size, total_drpms)
+
+    def progress(self, payload, done):
+        self._started.setdefault(payload, time.time())
+        if self._progress:
+            self._progress.progress(payload, done)
+
+    def end(self, payload, status, msg):
+        now = time.time()
+        if status == dnf.callback.STATUS_MIRROR:
+            self.retries += 1
+        elif status == dnf.callback.STATUS_FAILED:
+            self.failed += 1
+        elif status in (dnf.callback.STATUS_OK, dnf.callback.STATUS_DRPM):
+            pkg = getattr(payload, 'pkg', None)
+            stats = self.repos.setdefault(pkg.reponame if pkg else 'unknown',
+                                          {'packages': 0, 'bytes': 0, 'start': now, 'end': now})
+            stats['packages'] += 1
+            stats['bytes'] += payload.download_size
+            stats['start'] = min(stats['start'], self._started.get(payload, now))
+            stats['end'] = now
+        if self._progress:
+            self._progress.end(payload, status, msg)
+
+    def report(self, packages, seconds):
+        """
+        Returns the statistics of the download of the given number of packages in seconds
+        """
+        downloaded = sum(stats['packages'] for stats in self.repos.values())
+        return {
+            'packages': downloaded,
+            'cached_packages': max(packages - downloaded - self.failed, 0),
+            'bytes': sum(stats['bytes'] for stats in self.repos.values()),
+            'seconds': seconds,
+            'retries': self.retries,
+            'failed': self.failed,
+            'repos': {
+                repoid: {'packages': stats['packages'], 'bytes': stats['bytes'],
+                         'seconds': stats['end'] - stats['start']}
+                for repoid, stats in self.repos.items()
+            },
+        }
+
+
 class RhelUpgradeCommand(dnf.cli.Command):
     aliases = ('rhel-upgrade',)
     summary = ("Plugin for upgrading to the next RHEL major release")
@@ -25,6 +98,34 @@ class RhelUpgradeCommand(dnf.cli.Command):
     def __init__(self, cli):
         super(RhelUpgradeCommand, self).__init__(cli)
         self.plugin_data = {}
+        self._configured = None
+        self._replayed_reasons = None
+
+    def _record_timing(self, name, start):
+        """
+        Stores the time elapsed since the start of the lifecycle step into the plugin data
+
+        The peak memory is the maximum resident set size of the process reached so far.
+        """
+        self.plugin_data['timings'][self.opts.tid[0]].append({
+            'name': name,
+            'seconds': time.monotonic() - start,
+            'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+        self._save_plugin_data()
+
+    def _timed(self, name, func):
+        """
+        Wraps the function to record the timing of each of its calls
+        """
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._record_timing(name, start)
+        return _wrapper
 
     @staticmethod
     def set_argparser(parser):
@@ -32,27 +133,97 @@ class RhelUpgradeCommand(dnf.cli.Command):
                             metavar="[%s]" % "|".join(CMDS))
         parser.add_argument('filename')
 
-    def _process_packages(self, pkg_set, op):
+    def _name_selectors(self, query, obsoletes):
+        """
+        Yields the name and the selector of packages of each name in the query
+
+        As dnf does for a plain package name, the selector includes also the available packages
+        obsoleting the packages of the name, when obsoletes are enabled.
         """
-        Adds list of packages for given operation to the transaction
+        by_name = {}
+        for pkg in query:
+            by_name.setdefault(pkg.name, []).append(pkg)
+        obsoleters = self.base.sack.query().available().filter(obsoletes=query) if obsoletes else None
+        for name, pkgs in by_name.items():
+            if obsoleters:
+                pkgs = pkgs + obsoleters.filter(obsoletes=pkgs).run()
+            yield name, dnf.selector.Selector(self.base.sack).set(pkg=pkgs)
+
+    def _mark_by_name(self, names, kind):
         """
+        Marks packages of given names for the operation of the given kind in bulk and returns the names marked
+
+        Resolving each name as a generic package spec (NEVRA forms, globs, provides) is expensive
+        for thousands of packages, so all packages are looked up by a single sack query and the names
+        are marked by selectors built as the operation does for a plain package name.
+        """
+        query = self.base.sack.query().filter(name=list(names))
+        installed = query.installed()
+        if kind == 'remove':
+            for pkg in installed:
+                self.base._goal.erase(pkg, clean_deps=self.base.conf.clean_requirements_on_remove)
+            return {pkg.name for pkg in installed}
+        if kind == 'install':
+            marked = set()
+            for name, sltr in self._name_selectors(query, self.base.conf.obsoletes):
+                self.base._goal.install(select=sltr, optional=not self.base.conf.strict)
+                marked.add(name)
+            return marked
+        if kind == 'upgrade':
+            # as the upgrade operation, report the names that are not installed
+            marked = set()
+            query = query.filter(name=[pkg.name for pkg in installed])
+            for name, sltr in self._name_selectors(query, self.base.conf.obsoletes):
+                self.base._goal.upgrade(select=sltr)
+                marked.add(name)
+            return marked
+        raise ValueError('Unknown kind of the operation: {}'.format(kind))
+
+    def _process_packages(self, pkg_set, kind):
+        """
+        Adds list of packages for the operation of the given kind (remove, install, upgrade) to the transaction
+
+        Package names are marked in bulk, only the remaining specs are processed one by one.
+        """
+        op = getattr(self.base, kind)
         pkgs_notfound = []
 
+        names = {pkg_spec for pkg_spec in pkg_set if not set(pkg_spec).intersection(GLOB_CHARS)}
+        marked = self._mark_by_name(names, kind) if names else set()
         for pkg_spec in pkg_set:
+            if pkg_spec in marked:
+                continue
             try:
                 op(pkg_spec)
             except dnf.exceptions.MarkingError:
                 pkgs_notfound.append(pkg_spec)
         if pkgs_notfound:
             err_str = ('Packages marked by Leapp for {} not found '
-                       'in repositories metadata: '.format(op.__name__) + ' '.join(pkgs_notfound))
+                       'in repositories metadata: '.format(kind) + ' '.join(pkgs_notfound))
             print('Warning: ' + err_str, file=sys.stderr)
 
-    def _save_aws_region(self, region):
-        self.plugin_data['rhui']['aws']['region'] = region
+    def _save_plugin_data(self):
         with open(self.opts.filename, 'w+') as fo:
             json.dump(self.plugin_data, fo, sort_keys=True, indent=2)
 
+    def _save_aws_region(self, region):
+        self.plugin_data['rhui']['aws']['region'] = region
+        self._save_plugin_data()
+
+    def _download_with_report(self, download_packages):
+        """
+        Wraps the download of packages to store the statistics of the download into the plugin data
+        """
+        def _download_packages(pkglist, progress=None, callback_total=None):
+            statistics = DownloadStatistics(progress)
+            start = time.time()
+            try:
+                return download_packages(pkglist, statistics, callback_total)
+            finally:
+                self.plugin_data['download_report'] = statistics.report(len(pkglist), time.time() - start)
+                self._save_plugin_data()
+        return _download_packages
+
     def _read_aws_region(self, repo):
         region = None
         if repo.baseurl:
@@ -77,13 +248,135 @@ class RhelUpgradeCommand(dnf.cli.Command):
             raise dnf.exceptions.RepoError("RHUI repository %s does not have an url" % repo.name)
         return repo
 
+    def _get_installed_digest(self):
+        """
+        Returns digest of the installed packages, to detect changes of the system between stages
+        """
+        nevras = sorted(str(pkg) for pkg in self.base.sack.query().installed())
+        return hashlib.sha256('\n'.join(nevras).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _replay_action(tsi):
+        """
+        Returns the action needed to replay the transaction item
+        """
+        if tsi.action in dnf.transaction.FORWARD_ACTIONS:
+            return 'install'
+        if tsi.action == dnf.transaction.PKG_REMOVE:
+            return 'remove'
+        # packages replaced by the installed ones, no explicit action is needed for them
+        return 'replaced'
+
+    def _transaction_items(self):
+        """
+        Returns the packages of the resolved transaction with the action needed to replay it and their reason
+        """
+        return [{'name': tsi.pkg.name, 'nevra': str(tsi.pkg), 'repoid': tsi.pkg.reponame,
+                 'action': self._replay_action(tsi), 'reason': tsi.reason}
+                for tsi in self.base.transaction]
+
+    def _restore_reasons(self, reasons):
+        """
+        Sets the reasons resolved in the download stage to the items of the resolved transaction
+
+        The replayed packages are marked explicitly, so the resolution reports all of them as installed
+        by the user, including the dependencies.
+        """
+        for tsi in self.base.transaction:
+            reason = reasons.get((str(tsi.pkg), self._replay_action(tsi)))
+            if reason is not None:
+                tsi.reason = reason
+
+    def _save_transaction(self, path):
+        """
+        Stores the resolved transaction, so it can be replayed in the upgrade stage
+        """
+        transaction = {
+            'format': TRANSACTION_FORMAT,
+            'installed_digest': self._get_installed_digest(),
+            'packages': self._transaction_items(),
+        }
+        with open(path, 'w') as fo:
+            json.dump(transaction, fo, sort_keys=True, indent=2)
+
+    def _replay_transaction(self, path):
+        """
+        Marks and resolves the transaction resolved in the download stage and returns True, if it is still valid
+
+        The transaction is valid when the installed packages have not changed since the download stage
+        and all packages of the transaction are available. The goal is then built directly from the
+        packages, so there is nothing to choose during the resolution. The reasons of the packages
+        (user, dependency, ...) are restored from the stored transaction. The resolved transaction must
+        be the same as the stored one including the reasons, otherwise the goal is reset, so
+        the transaction can be resolved again from the packages marked by leapp.
+        """
+        try:
+            with open(path) as fo:
+                transaction = json.load(fo)
+        except (IOError, OSError, ValueError) as e:
+            print('Cannot read the transaction from the download stage: {}'.format(e), file=sys.stderr)
+            return False
+        if transaction.get('format') != TRANSACTION_FORMAT:
+            return False
+        if transaction['installed_digest'] != self._get_installed_digest():
+            print('Installed packages changed since the download stage, resolving the transaction again.',
+                  file=sys.stderr)
+            return False
+
+        names = {item['name'] for item in transaction['packages']}
+        packages = {(str(pkg), pkg.reponame): pkg for pkg in self.base.sack.query().filter(name=list(names))}
+        to_install = []
+        to_remove = []
+        for item in transaction['packages']:
+            if item['action'] == 'replaced':
+                continue
+            repoid = item['repoid'] if item['action'] == 'install' else '@System'
+            pkg = packages.get((item['nevra'], repoid))
+            if pkg is None:
+                print('Package {} of the transaction from the download stage is not available, '
+                      'resolving the transaction again.'.format(item['nevra']), file=sys.stderr)
+                return False
+            (to_install if item['action'] == 'install' else to_remove).append(pkg)
+
+        for pkg in to_install:
+            self.base._goal.install(pkg)
+        for pkg in to_remove:
+            self.base._goal.erase(pkg, clean_deps=False)
+        try:
+            self.base.resolve(allow_erasing=self.cli.demands.allow_erasing)
+        except dnf.exceptions.DepsolveError as e:
+            print('Cannot resolve the transaction from the download stage, resolving the transaction again: '
+                  '{}'.format(e), file=sys.stderr)
+            self.base.reset(goal=True)
+            return False
+        reasons = {(item['nevra'], item['action']): item['reason'] for item in transaction['packages']}
+        self._restore_reasons(reasons)
+        expected = {(item['nevra'], item['action'], item['reason']) for item in transaction['packages']}
+        if {(item['nevra'], item['action'], item['reason']) for item in self._transaction_items()} != expected:
+            print('The transaction differs from the one resolved in the download stage, '
+                  'resolving the transaction again.', file=sys.stderr)
+            self.base.reset(goal=True)
+            return False
+        self._replayed_reasons = reasons
+        return True
+
     def pre_configure(self):
+        start = time.monotonic()
         with open(self.opts.filename) as fo:
             self.plugin_data = json.load(fo)
+        # timings of the previous stages are kept
+        self.plugin_data.setdefault('timings', {})[self.opts.tid[0]] = []
         # There is an issue that ignores releasever value if it is set at configure
         self.base.conf.releasever = self.plugin_data['dnf_conf']['releasever']
+        self._record_timing('pre_configure', start)
 
     def configure(self):
+        start = time.monotonic()
+        self._configure()
+        self._record_timing('configure', start)
+        self._configured = time.monotonic()
+
+    def _configure(self):
 
         on_aws = self.plugin_data['rhui']['aws']['on_aws']
         self.cli.demands.root_user = True
@@ -103,8 +396,13 @@ class RhelUpgradeCommand(dnf.cli.Command):
             self.base.conf.installroot = installroot
         if self.plugin_data['dnf_conf']['test_flag'] and self.opts.tid[0] == 'download':
             self.base.conf.tsflags.append("test")
+        download_conf = self.plugin_data.get('download', {})
+        for option, value in download_conf.items():
+            setattr(self.base.conf, option, value)
 
         enabled_repos = self.plugin_data['dnf_conf']['enable_repos']
+        # metadata of these repositories have been downloaded already by leapp, do not download them again
+        cached_repos = self.plugin_data['dnf_conf'].get('cached_repos', [])
         self.base.repos.all().disable()
 
         aws_region = None
@@ -114,6 +412,11 @@ class RhelUpgradeCommand(dnf.cli.Command):
                 repo.skip_if_unavailable = False
                 if not self.base.conf.gpgcheck:
                     repo.gpgcheck = False
+                if repo.id in cached_repos:
+                    repo.metadata_expire = -1
+                for option in REPO_DOWNLOAD_OPTIONS:
+                    if option in download_conf:
+                        setattr(repo, option, download_conf[option])
                 repo.enable()
                 if self.opts.tid[0] == 'download' and on_aws:
                     # during the upgrade phase we has to disable "Amazon-id" plugin as we do not have networking
@@ -137,9 +440,37 @@ class RhelUpgradeCommand(dnf.cli.Command):
             self._save_aws_region(aws_region)
 
     def run(self):
+        # dnf loads the repositories and fills the sack between the configure and run hooks
+        self._record_timing('sack_activation', self._configured)
+        start = time.monotonic()
+        self.base.resolve = self._timed('resolve', self.base.resolve)
+        self.base._run_transaction = self._timed('transaction', self.base._run_transaction)
+        try:
+            self._run()
+        finally:
+            self._record_timing('run', start)
+
+    def _run(self):
+        """
+        Marks the packages for the transaction; in the check stage also resolves and checks the transaction
+        """
         # takes local rpms, creates Package objects from them, and then adds them to the sack as virtual repository
         local_rpm_objects = self.base.add_remote_rpms(self.plugin_data['pkgs_info']['local_rpms'])
 
+        if self.opts.tid[0] == 'download':
+            self.plugin_data.pop('download_report', None)
+            self.base.download_packages = self._timed(
+                'download', self._download_with_report(self.base.download_packages))
+
+        transaction_path = self.plugin_data['dnf_conf'].get('transaction_path')
+        if transaction_path and self.opts.tid[0] == 'download' and os.path.exists(transaction_path):
+            os.unlink(transaction_path)
+        if transaction_path and self.opts.tid[0] == 'upgrade' and os.path.exists(transaction_path):
+            if self._replay_transaction(transaction_path):
+                print('Replaying the transaction resolved in the download stage.')
+                return
+
+        # the local rpms are marked after the replay, as its failure resets the goal
         for pkg in local_rpm_objects:
             self.base.package_install(pkg)
 
@@ -148,11 +479,11 @@ class RhelUpgradeCommand(dnf.cli.Command):
         to_upgrade = self.plugin_data['pkgs_info']['to_upgrade']
 
         # Packages to be removed
-        self._process_packages(to_remove, self.base.remove)
+        self._process_packages(to_remove, 'remove')
         # Packages to be installed
-        self._process_packages(to_install, self.base.install)
+        self._process_packages(to_install, 'install')
         # Packages to be upgraded
-        self._process_packages(to_upgrade, self.base.upgrade)
+        self._process_packages(to_upgrade, 'upgrade')
 
         self.base.distro_sync()
 
@@ -174,6 +505,16 @@ class RhelUpgradeCommand(dnf.cli.Command):
             except DoNotDownload:
                 print('Check completed.')
 
+    def run_resolved(self):
+        # dnf resolves the goal once more after the run hook, so the reasons have to be restored again
+        if self._replayed_reasons:
+            self._restore_reasons(self._replayed_reasons)
+
+    def run_transaction(self):
+        transaction_path = self.plugin_data['dnf_conf'].get('transaction_path')
+        if transaction_path and self.opts.tid[0] == 'download':
+            self._save_transaction(transaction_path)
+
 
 class RhelUpgradePlugin(dnf.Plugin):
     name = 'rhel-upgrade'
@@ -4,9 +4,13 @@ import json
 import os
 import shutil
 
+from six.moves import shlex_quote
+
 from leapp.exceptions import StopActorExecutionError
 from leapp.libraries.common import guards, mounting, overlaygen, rhsm, utils
+from leapp.libraries.common.config import get_env
 from leapp.libraries.stdlib import CalledProcessError, api, config
+from leapp.models import DNFDownloadReport, DNFPluginStepTiming, DNFPluginTimings, DNFRepositoryDownload
 
 DNF_PLUGIN_NAME = 'rhel_upgrade.py'
 DNF_PLUGIN_PATH = os.path.join('/lib/python3.6/site-packages/dnf-plugins', DNF_PLUGIN_NAME)
@@ -14,6 +18,26 @@ DNF_PLUGIN_DATA_NAME = 'dnf-plugin-data.txt'
 DNF_PLUGIN_DATA_PATH = os.path.join('/var/lib/leapp', DNF_PLUGIN_DATA_NAME)
 DNF_PLUGIN_DATA_LOG_PATH = os.path.join('/var/log/leapp', DNF_PLUGIN_DATA_NAME)
 DNF_DEBUG_DATA_PATH = '/var/log/leapp/dnf-debugdata/'
+DNF_TRANSACTION_PATH = '/var/lib/leapp/dnf-transaction.json'
+DNF_CACHE_DIR = '/var/cache/dnf'
+DNF_WARMUP_DIR_NAME = 'leapp-warmup'
+_WARMUP_FAILED_MARK = 'leapp-metadata-warmup-failed: '
+
+
+def _parse_bool(value):
+    if value not in ('0', '1'):
+        raise ValueError('expected 0 or 1')
+    return value == '1'
+
+
+DOWNLOAD_TUNING_ENVARS = (
+    ('max_parallel_downloads', 'LEAPP_DNF_MAX_PARALLEL_DOWNLOADS', int),
+    ('fastestmirror', 'LEAPP_DNF_FASTESTMIRROR', _parse_bool),
+    ('minrate', 'LEAPP_DNF_MINRATE', int),
+    ('timeout', 'LEAPP_DNF_TIMEOUT', int),
+    ('deltarpm', 'LEAPP_DNF_DELTARPM', _parse_bool),
+)
+"""DNF download options that can be set by leapp environment variables, with their value parsers."""
 
 
 def install(target_basedir):
@@ -31,9 +55,35 @@ def install(target_basedir):
         )
 
 
-def build_plugin_data(target_repoids, debug, test, tasks, on_aws):
+def get_download_tuning():
+    """
+    Return DNF download options set by leapp environment variables.
+
+    Only the options that are set are returned, DNF defaults are used for the rest.
+    Invalid values are ignored with a warning.
+    """
+    tuning = {}
+    for option, envar, parse in DOWNLOAD_TUNING_ENVARS:
+        value = get_env(envar)
+        if not value:
+            continue
+        try:
+            tuning[option] = parse(value)
+        except ValueError:
+            api.current_logger().warning('Ignoring invalid value of {}: {}'.format(envar, value))
+    return tuning
+
+
+def build_plugin_data(target_repoids, debug, test, tasks, on_aws, cached_repoids=()):
     """
     Generates a dictionary with the DNF plugin data.
+
+    The download section contains DNF download options set by leapp environment variables;
+    in the download stage the plugin stores the statistics of the download in the download_report.
+
+    The transaction resolved in the download stage is stored by the plugin in the transaction_path file,
+    so the upgrade stage can replay it instead of resolving the whole transaction again.
+    Expiration of metadata is disabled for repositories listed in cached_repoids.
     """
     # get list of repo IDs of target repositories that should be used for upgrade
     data = {
@@ -46,6 +96,7 @@ def build_plugin_data(target_repoids, debug, test, tasks, on_aws):
         'dnf_conf': {
             'allow_erasing': True,
             'best': True,
+            'cached_repos': sorted(set(cached_repoids).intersection(target_repoids)),
             'debugsolver': debug,
             'disable_repos': True,
             'enable_repos': target_repoids,
@@ -53,8 +104,10 @@ def build_plugin_data(target_repoids, debug, test, tasks, on_aws):
             'platform_id': 'platform:el8',
             'releasever': api.current_actor().configuration.version.target,
             'installroot': '/installroot',
-            'test_flag': test
+            'test_flag': test,
+            'transaction_path': DNF_TRANSACTION_PATH
         },
+        'download': get_download_tuning(),
         'rhui': {
             'aws': {
               'on_aws': on_aws,
@@ -65,14 +118,15 @@ def build_plugin_data(target_repoids, debug, test, tasks, on_aws):
     return data
 
 
-def create_config(context, target_repoids, debug, test, tasks, on_aws=False):
+def create_config(context, target_repoids, debug, test, tasks, on_aws=False, cached_repoids=()):
     """
     Creates the configuration data file for our DNF plugin.
     """
     context.makedirs(os.path.dirname(DNF_PLUGIN_DATA_PATH), exists_ok=True)
     with context.open(DNF_PLUGIN_DATA_PATH, 'w+') as f:
         config_data = build_plugin_data(
-            target_repoids=target_repoids, debug=debug, test=test, tasks=tasks, on_aws=on_aws
+            target_repoids=target_repoids, debug=debug, test=test, tasks=tasks, on_aws=on_aws,
+            cached_repoids=cached_repoids
         )
         json.dump(config_data, f, sort_keys=True, indent=2)
 
@@ -97,9 +151,12 @@ def backup_debug_data(context):
             api.current_logger().warning('Failed to copy debugdata. Message: {}'.format(str(e)), exc_info=True)
 
 
-def _transaction(context, stage, target_repoids, tasks, plugin_info, test=False, cmd_prefix=None, on_aws=False):
+def _transaction(context, stage, target_repoids, tasks, plugin_info, test=False, cmd_prefix=None, on_aws=False,
+                 cached_repoids=()):
     """
     Perform the actual DNF rpm download via our DNF plugin
+
+    Timings of the plugin lifecycle steps are logged and produced as the DNFPluginTimings message.
     """
 
     # we do not want
@@ -109,7 +166,8 @@ def _transaction(context, stage, target_repoids, tasks, plugin_info, test=False,
             target_repoids=target_repoids,
             debug=config.is_debug(),
             test=test, tasks=tasks,
-            on_aws=on_aws
+            on_aws=on_aws,
+            cached_repoids=cached_repoids
         )
     backup_config(context=context)
 
@@ -150,16 +208,196 @@ def _transaction(context, stage, target_repoids, tasks, plugin_info, test=False,
         finally:
             if stage == 'check':
                 backup_debug_data(context=context)
+            timings = get_plugin_timings(context, stage)
+            if timings:
+                api.current_logger().debug(format_plugin_timings(timings))
+                api.produce(timings)
+
+
+def _read_plugin_data(context):
+    try:
+        with context.open(DNF_PLUGIN_DATA_PATH) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        api.current_logger().warning('Cannot read the data file of the DNF plugin: {}'.format(e))
+        return {}
+
+
+def get_plugin_timings(context, stage):
+    """
+    Return the timings of lifecycle steps stored by the DNF plugin into the plugin data file for the stage.
+
+    :return: DNFPluginTimings or None when the plugin has not stored any
+    """
+    steps = _read_plugin_data(context).get('timings', {}).get(stage)
+    if not steps:
+        return None
+    return DNFPluginTimings(stage=stage, steps=[
+        DNFPluginStepTiming(name=step['name'], seconds=float(step['seconds']), peak_rss_kib=step['peak_rss_kib'])
+        for step in steps
+    ])
+
+
+def format_plugin_timings(timings):
+    """
+    Format the timings of the DNF plugin steps as a table for the debug log.
+    """
+    lines = ['Timings of the DNF plugin in the {} stage:'.format(timings.stage),
+             '    {:<16}{:>12}{:>18}'.format('step', 'time [s]', 'peak RSS [MiB]')]
+    for step in timings.steps:
+        lines.append('    {:<16}{:>12.3f}{:>18.1f}'.format(step.name, step.seconds, step.peak_rss_kib / 1024.0))
+    return '\n'.join(lines)
+
+
+def get_download_report(context):
+    """
+    Return the statistics of the download stored by the DNF plugin into the plugin data file.
+
+    :return: DNFDownloadReport or None when the plugin has not stored any
+    """
+    report = _read_plugin_data(context).get('download_report')
+    if not report:
+        return None
+    repositories = [
+        DNFRepositoryDownload(repoid=repoid, packages=stats['packages'], bytes=stats['bytes'],
+                              seconds=float(stats['seconds']))
+        for repoid, stats in sorted(report['repos'].items())
+    ]
+    return DNFDownloadReport(packages=report['packages'], cached_packages=report['cached_packages'],
+                             bytes=report['bytes'], seconds=float(report['seconds']), retries=report['retries'],
+                             failed=report['failed'], repositories=repositories)
+
+
+def _throughput(size, seconds):
+    return '{:.1f} MiB/s'.format(size / seconds / 2 ** 20) if seconds > 0 else 'n/a'
+
+
+def format_download_report(report):
+    """
+    Format the statistics of the download for the log.
+    """
+    lines = ['Downloaded {} packages ({:.1f} MiB) in {:.1f}s, {}; {} packages cached, {} retries, {} failed'.format(
+        report.packages, report.bytes / 2.0 ** 20, report.seconds, _throughput(report.bytes, report.seconds),
+        report.cached_packages, report.retries, report.failed)]
+    for repo in report.repositories:
+        lines.append('    {}: {} packages ({:.1f} MiB) in {:.1f}s, {}'.format(
+            repo.repoid, repo.packages, repo.bytes / 2.0 ** 20, repo.seconds, _throughput(repo.bytes, repo.seconds)))
+    return '\n'.join(lines)
+
+
+def get_metadata_expire_opts(cached_repoids):
+    """
+    Return dnf options disabling expiration of metadata of the given repositories.
+
+    The option is set per repository as repository files (e.g. redhat.repo) usually set
+    metadata_expire for each repository, which overrides the global value.
+    """
+    return ['--setopt={}.metadata_expire=-1'.format(repoid) for repoid in sorted(cached_repoids)]
+
+
+def _build_warmup_script(target_repoids, warmup_dir):
+    """
+    Build the shell script running dnf makecache for all repositories in parallel.
+
+    dnf holds the metadata lock of its cache directory for the whole loading of repositories,
+    so each repository is downloaded into its own cache directory. The subscription-manager plugin
+    is always disabled, as every parallel dnf process would regenerate the same redhat.repo file.
+    Each failed repository is reported on the stdout by a line starting with _WARMUP_FAILED_MARK.
+    """
+    lines = []
+    for i, repoid in enumerate(target_repoids):
+        cmd = [
+            'dnf',
+            'makecache',
+            '--setopt=module_platform_id=platform:el8',
+            '--setopt=cachedir={}'.format(os.path.join(warmup_dir, repoid)),
+            '--releasever', api.current_actor().configuration.version.target,
+            '--disablerepo', '*',
+            '--enablerepo', repoid,
+            '--disableplugin', 'subscription-manager',
+        ]
+        lines.append('{} & pid{}=$!'.format(' '.join(shlex_quote(arg) for arg in cmd), i))
+    for i, repoid in enumerate(target_repoids):
+        lines.append('wait $pid{} || echo {}'.format(i, shlex_quote(_WARMUP_FAILED_MARK + repoid)))
+    return '\n'.join(lines)
+
+
+def _merge_repo_cache(repo_cache_dir, cache_dir, repoid):
+    """
+    Move the cached metadata and solv files of the repository into the dnf cache directory.
+    """
+    for name in os.listdir(repo_cache_dir):
+        if not name.startswith((repoid + '-', repoid + '.')):
+            continue
+        dst = os.path.join(cache_dir, name)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        elif os.path.lexists(dst):
+            os.unlink(dst)
+        os.rename(os.path.join(repo_cache_dir, name), dst)
+
+
+def make_metadata_cache(context, target_repoids, cache_dir=DNF_CACHE_DIR):
+    """
+    Download metadata of the target repositories into the dnf cache directory of the context.
+
+    The metadata of all repositories are downloaded in parallel, once for all later dnf executions;
+    the cache directory is expected to be the bind mounted /var/cache/dnf of the host, so the
+    metadata are available also for the target userspace and after the reboot.
+
+    :param context: context with dnf that has access to the target repositories
+    :param target_repoids: ids of the target repositories
+    :param cache_dir: dnf cache directory inside the context
+    :return: set of ids of repositories whose metadata have been cached
+    """
+    target_repoids = sorted(set(target_repoids))
+    if not target_repoids:
+        return set()
+    warmup_dir = os.path.join(cache_dir, DNF_WARMUP_DIR_NAME)
+    host_cache_dir = context.full_path(cache_dir)
+    host_warmup_dir = context.full_path(warmup_dir)
+    if os.path.isdir(host_warmup_dir):
+        shutil.rmtree(host_warmup_dir)
+
+    failed = set()
+    try:
+        script = _build_warmup_script(target_repoids, warmup_dir)
+        try:
+            stdout = context.call(['/bin/bash', '-c', script], split=False)['stdout']
+        except (OSError, CalledProcessError) as e:
+            api.current_logger().warning('Failed to download metadata of the target repositories: {}'.format(e))
+            return set()
+        for line in stdout.splitlines():
+            if line.startswith(_WARMUP_FAILED_MARK):
+                failed.add(line[len(_WARMUP_FAILED_MARK):].strip())
+        for repoid in target_repoids:
+            if repoid in failed:
+                continue
+            try:
+                _merge_repo_cache(os.path.join(host_warmup_dir, repoid), host_cache_dir, repoid)
+            except OSError as e:
+                api.current_logger().warning('Failed to cache metadata of the {} repository: {}'.format(repoid, e))
+                failed.add(repoid)
+    finally:
+        shutil.rmtree(host_warmup_dir, ignore_errors=True)
+
+    if failed:
+        api.current_logger().warning(
+            'Metadata of the following target repositories have not been cached: {}'.format(
+                ', '.join(sorted(failed))))
+    return set(target_repoids) - failed
 
 
 @contextlib.contextmanager
 def _prepare_transaction(used_repos, target_userspace_info, binds=()):
     """ Creates the transaction environment needed for the target userspace DNF execution  """
     target_repoids = set()
+    cached_repoids = set()
     for message in used_repos:
         target_repoids.update([repo.repoid for repo in message.repos])
+        cached_repoids.update([repo.repoid for repo in message.repos if repo.metadata_cached])
     with mounting.NspawnActions(base_dir=target_userspace_info.path, binds=binds) as context:
-        yield context, list(target_repoids), target_userspace_info
+        yield context, list(target_repoids), cached_repoids, target_userspace_info
 
 
 def install_initramdisk_requirements(packages, target_userspace_info, used_repos):
@@ -167,9 +405,11 @@ def install_initramdisk_requirements(packages, target_userspace_info, used_repos
     Performs the installation of packages into the initram disk
     """
     with _prepare_transaction(used_repos=used_repos,
-                              target_userspace_info=target_userspace_info) as (context, target_repoids, _unused):
+                              target_userspace_info=target_userspace_info,
+                              binds=['{0}:{0}'.format(DNF_CACHE_DIR)]
+                              ) as (context, target_repoids, cached_repoids, _unused):
         repos_opt = [['--enablerepo', repo] for repo in target_repoids]
-        repos_opt = list(itertools.chain(*repos_opt))
+        repos_opt = list(itertools.chain(*repos_opt)) + get_metadata_expire_opts(cached_repoids)
         cmd = [
             'dnf',
             'install',
@@ -217,7 +457,7 @@ def perform_transaction_install(target_userspace_info, storage_info, used_repos,
     with _prepare_transaction(used_repos=used_repos,
                               target_userspace_info=target_userspace_info,
                               binds=bind_mounts
-                              ) as (context, target_repoids, _unused):
+                              ) as (context, target_repoids, _unused, _unused_info):
         # the below nsenter command is important as we need to enter sysvipc namespace on the host so we can
         # communicate with udev
         cmd_prefix = ['nsenter', '--ipc=/installroot/proc/1/ns/ipc']
@@ -227,34 +467,48 @@ def perform_transaction_install(target_userspace_info, storage_info, used_repos,
         )
 
 
-def perform_transaction_check(target_userspace_info, used_repos, tasks, xfs_info, storage_info, plugin_info):
+def perform_transaction_check(target_userspace_info, used_repos, tasks, xfs_info, storage_info, plugin_info,
+                              memory_info=None):
     """
     Perform DNF transaction check using our plugin
+
+    The memory_info is used to decide whether upper layers of the source system overlay can be placed on tmpfs.
     """
     with _prepare_transaction(used_repos=used_repos,
                               target_userspace_info=target_userspace_info
-                              ) as (context, target_repoids, userspace_info):
+                              ) as (context, target_repoids, cached_repoids, userspace_info):
         with overlaygen.create_source_overlay(mounts_dir=userspace_info.mounts, scratch_dir=userspace_info.scratch,
                                               xfs_info=xfs_info, storage_info=storage_info,
-                                              mount_target=os.path.join(context.base_dir, 'installroot')) as overlay:
+                                              mount_target=os.path.join(context.base_dir, 'installroot'),
+                                              memory_info=memory_info) as overlay:
             utils.apply_yum_workaround(overlay.nspawn())
             _transaction(
-                context=context, stage='check', target_repoids=target_repoids, plugin_info=plugin_info, tasks=tasks
+                context=context, stage='check', target_repoids=target_repoids, plugin_info=plugin_info, tasks=tasks,
+                cached_repoids=cached_repoids
             )
 
 
-def perform_rpm_download(target_userspace_info, used_repos, tasks, xfs_info, storage_info, plugin_info, on_aws=False):
+def perform_rpm_download(target_userspace_info, used_repos, tasks, xfs_info, storage_info, plugin_info, on_aws=False,
+                         memory_info=None):
     """
     Perform RPM download including the transaction test using dnf with our plugin
+
+    The statistics of the download are logged and produced as the DNFDownloadReport message.
+    The memory_info is used to decide whether upper layers of the source system overlay can be placed on tmpfs.
     """
     with _prepare_transaction(used_repos=used_repos,
                               target_userspace_info=target_userspace_info
-                              ) as (context, target_repoids, userspace_info):
+                              ) as (context, target_repoids, cached_repoids, userspace_info):
         with overlaygen.create_source_overlay(mounts_dir=userspace_info.mounts, scratch_dir=userspace_info.scratch,
                                               xfs_info=xfs_info, storage_info=storage_info,
-                                              mount_target=os.path.join(context.base_dir, 'installroot')) as overlay:
+                                              mount_target=os.path.join(context.base_dir, 'installroot'),
+                                              memory_info=memory_info) as overlay:
             utils.apply_yum_workaround(overlay.nspawn())
             _transaction(
                 context=context, stage='download', target_repoids=target_repoids, plugin_info=plugin_info, tasks=tasks,
-                test=True, on_aws=on_aws
+                test=True, on_aws=on_aws, cached_repoids=cached_repoids
             )
+        report = get_download_report(context)
+        if report:
+            api.current_logger().info(format_download_report(report))
+            api.produce(report)
@@ -1,6 +1,16 @@
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import itertools
 import os
+import random
 import shutil
+import signal
+import stat
+import subprocess
+import time
 from collections import namedtuple
 
 from leapp.libraries.stdlib import run, CalledProcessError, api
@@ -9,8 +19,27 @@ from leapp.libraries.common.config import get_all_envs
 
 ALWAYS_BIND = ['/etc/hosts:/etc/hosts']
 
+FICLONE = 0x40049409
+""" ioctl request cloning a file (reflink) on filesystems supporting it (e.g. XFS with reflink=1, btrfs) """
+
+_LINK_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.EMLINK)
+
 ErrorData = namedtuple('ErrorData', ['summary', 'details'])
 
+MS_BIND = 4096
+MNT_FORCE = 1
+MNT_DETACH = 2
+
+_libc = []
+_mount_stats = {}
+
+NSPAWN_SESSION_START_TIMEOUT = 10
+""" Seconds to wait for the start of the container of a nspawn session """
+
+NSPAWN_DEFAULT_ENV = ['PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin', 'HOME=/root',
+                      'USER=root', 'LOGNAME=root', 'container=systemd-nspawn']
+""" Environment of commands executed in a nspawn session, as set by systemd-nspawn """
+
 
 class MountingMode(object):
     """
@@ -37,6 +66,309 @@ def _makedirs(path, mode=0o777, exists_ok=True):
             raise
 
 
+class CopyMode(object):
+    """
+    CopyMode are strategies of copying directory trees by IsolatedActions.copytree_to/copytree_from
+
+    All strategies but BIND fall back to the regular copy of files when they cannot be used
+    (e.g. the source and destination are on different filesystems).
+    """
+    COPY = 'copy'
+    """ Copy content of files """
+    REFLINK = 'reflink'
+    """ Clone files sharing their data blocks (copy-on-write), where the filesystem supports it """
+    HARDLINK = 'hardlink'
+    """ Hardlink files; use just for content that is not modified in the source nor in the destination """
+    BIND = 'bind'
+    """ Bind mount the tree for the lifetime of the isolated actions context; for read-only trees only """
+
+
+class _TreeCopier(object):
+    """
+    Copy directory trees using the given CopyMode, optionally synchronizing an existing destination.
+
+    Symbolic links in the source tree are followed, as shutil.copytree does by default. In the sync mode
+    files of the same size and modification time in the destination are kept untouched, other files are
+    replaced and entries missing in the source are removed from the destination. Symbolic links in the
+    destination tree are never followed, they are replaced. As with shutil.copytree errors are collected
+    and raised as shutil.Error at the end.
+    """
+
+    def __init__(self, mode=CopyMode.COPY, sync=False):
+        self.mode = mode
+        self.sync = sync
+        self._link_supported = mode in (CopyMode.REFLINK, CopyMode.HARDLINK)
+        self.stats = {'copied': 0, 'linked': 0, 'skipped': 0, 'removed': 0}
+
+    def _link_file(self, src, dst):
+        if self.mode == CopyMode.HARDLINK:
+            os.link(os.path.realpath(src), dst)
+            return
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                except (IOError, OSError):
+                    fdst.close()
+                    os.unlink(dst)
+                    raise
+        shutil.copystat(src, dst)
+
+    def copy_file(self, src, dst):
+        if self._link_supported:
+            try:
+                self._link_file(src, dst)
+                self.stats['linked'] += 1
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in _LINK_UNSUPPORTED_ERRNOS:
+                    raise
+                # the same will most likely happen for all other files of the tree
+                self._link_supported = False
+        shutil.copy2(src, dst)
+        self.stats['copied'] += 1
+
+    @staticmethod
+    def _is_unchanged(src_stat, dst):
+        try:
+            dst_stat = os.lstat(dst)
+        except OSError:
+            return False
+        return (stat.S_ISREG(dst_stat.st_mode) and dst_stat.st_size == src_stat.st_size
+                and int(dst_stat.st_mtime) == int(src_stat.st_mtime))
+
+    @staticmethod
+    def _is_real_dir(path):
+        """
+        Check the path is a directory, not following a symbolic link at the path itself.
+        """
+        try:
+            return stat.S_ISDIR(os.lstat(path).st_mode)
+        except OSError:
+            return False
+
+    def _remove(self, path):
+        if self._is_real_dir(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+        self.stats['removed'] += 1
+
+    def copytree(self, src, dst):
+        errors = []
+        names = os.listdir(src)
+        # a symbolic link in the destination must never be followed, it could point out of the tree
+        if not self.sync or not self._is_real_dir(dst):
+            if self.sync and os.path.lexists(dst):
+                self._remove(dst)
+            os.makedirs(dst)
+        else:
+            for name in set(os.listdir(dst)).difference(names):
+                try:
+                    self._remove(os.path.join(dst, name))
+                except (IOError, OSError) as e:
+                    errors.append((os.path.join(dst, name), os.path.join(dst, name), str(e)))
+        for name in names:
+            srcname = os.path.join(src, name)
+            dstname = os.path.join(dst, name)
+            try:
+                if os.path.isdir(srcname):
+                    self.copytree(srcname, dstname)
+                    continue
+                if self.sync:
+                    if self._is_unchanged(os.stat(srcname), dstname):
+                        self.stats['skipped'] += 1
+                        continue
+                    if os.path.lexists(dstname):
+                        self._remove(dstname)
+                self.copy_file(srcname, dstname)
+            except shutil.Error as err:
+                errors.extend(err.args[0])
+            except (IOError, OSError) as e:
+                errors.append((srcname, dstname, str(e)))
+        try:
+            shutil.copystat(src, dst)
+        except OSError as e:
+            errors.append((src, dst, str(e)))
+        if errors:
+            raise shutil.Error(errors)
+
+
+def _get_libc():
+    """ Load the C library for the syscall mount backend, return None when it cannot be loaded """
+    if not _libc:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.mount.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p)
+            libc.umount2.argtypes = (ctypes.c_char_p, ctypes.c_int)
+        except (OSError, AttributeError):
+            libc = None
+        _libc.append(libc)
+    return _libc[0]
+
+
+def _to_bytes(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _syscall_backend_enabled(mode):
+    """
+    Tell whether the syscall backend should be used for mounts of the given MountingMode.
+
+    The subprocess backend can be forced for all mounts by LEAPP_DEVEL_MOUNT_SUBPROCESS=1, or just for
+    some modes by a comma separated list of them (e.g. LEAPP_DEVEL_MOUNT_SUBPROCESS=overlay,bind).
+    """
+    subprocess_modes = os.getenv('LEAPP_DEVEL_MOUNT_SUBPROCESS', '0').split(',')
+    if '1' in subprocess_modes or mode in subprocess_modes:
+        return False
+    return _get_libc() is not None
+
+
+def _syscall_mount(source, target, fstype, flags, data):
+    if _get_libc().mount(_to_bytes(source), _to_bytes(target), _to_bytes(fstype), flags, _to_bytes(data)) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def _syscall_umount(target, flags):
+    if _get_libc().umount2(_to_bytes(target), flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+@contextlib.contextmanager
+def _measure(operation, backend):
+    """ Count the operation performed by the backend and the time spent by it """
+    start = time.time()
+    try:
+        yield
+    finally:
+        count, elapsed = _mount_stats.get((operation, backend), (0, 0.0))
+        _mount_stats[(operation, backend)] = (count + 1, elapsed + time.time() - start)
+
+
+def get_mount_stats():
+    """
+    Get counters of mount operations performed by this library.
+
+    :return: dict {(operation, backend): (count, seconds)}; operations are mount, umount and remove,
+             backends are syscall, subprocess and in-process
+    """
+    return dict(_mount_stats)
+
+
+def format_mount_stats():
+    """ Format the counters of mount operations for logging """
+    return ', '.join('{} by {}: {} in {:.3f}s'.format(operation, backend, count, elapsed)
+                     for (operation, backend), (count, elapsed) in sorted(_mount_stats.items()))
+
+
+def _remove_path(path):
+    """ In-process equivalent of rm -rf """
+    with _measure('remove', 'in-process'):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+
+
+def _get_mounts_below(path):
+    """ Get mount points below the path (including the path) as listed in /proc/self/mountinfo """
+    prefix = path.rstrip('/') + '/'
+    mounts = []
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            mountpoint = line.split()[4]
+            if mountpoint == path or mountpoint.startswith(prefix):
+                mounts.append(mountpoint)
+    return mounts
+
+
+def _find_process(cmdline):
+    """ Find pid of the process with the given command line (list of arguments) """
+    expected = '\0'.join(cmdline) + '\0'
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', pid, 'cmdline')) as f:
+                if f.read() == expected:
+                    return int(pid)
+        except (IOError, OSError):
+            continue
+    return None
+
+
+class _NspawnSession(object):
+    """
+    Container started by systemd-nspawn in background, commands are executed in it by nsenter.
+
+    The container runs just sleep with an unique argument, which is used to find the pid of the
+    container leader process. The commands do not need to start a new container, so they are
+    executed with a much lower latency.
+
+    Mounts created on the host below the container root are not propagated into a running container,
+    so the container is restarted when the mounts below its root change.
+    """
+
+    def __init__(self, target, nspawn_cmd, env):
+        self.target = target
+        self.nspawn_cmd = nspawn_cmd
+        self.env = env
+        self.leader = None
+        self._process = None
+        self._mounts = None
+
+    def start(self):
+        """ Start the container, raise OSError when it cannot be started """
+        sleep_cmd = ['sleep', '{}.{:06d}'.format(2 ** 31 - 1, random.randint(0, 999999))]
+        self._mounts = _get_mounts_below(self.target)
+        with open(os.devnull, 'r+') as devnull:
+            self._process = subprocess.Popen(self.nspawn_cmd + sleep_cmd, stdin=devnull, stdout=devnull,
+                                             stderr=devnull, close_fds=True)
+        deadline = time.time() + NSPAWN_SESSION_START_TIMEOUT
+        while time.time() < deadline and self._process.poll() is None:
+            self.leader = _find_process(sleep_cmd)
+            if self.leader:
+                return
+            time.sleep(0.02)
+        self.stop()
+        raise OSError(errno.ETIMEDOUT, 'The container in {} has not been started'.format(self.target))
+
+    def stop(self):
+        """ Stop the container """
+        if self.leader:
+            try:
+                os.kill(self.leader, signal.SIGKILL)
+            except OSError:
+                pass
+            self.leader = None
+        if self._process:
+            deadline = time.time() + NSPAWN_SESSION_START_TIMEOUT
+            while self._process.poll() is None and time.time() < deadline:
+                time.sleep(0.02)
+            if self._process.poll() is None:
+                self._process.kill()
+                self._process.wait()
+            self._process = None
+
+    def make_command(self, cmd):
+        """ Transform the command to be executed in the container, (re)starting it when needed """
+        if self._process is None or self._process.poll() is not None or _get_mounts_below(self.target) != self._mounts:
+            self.stop()
+            self.start()
+        return [
+            'nsenter',
+            '--target', str(self.leader),
+            '--mount', '--uts', '--ipc', '--pid',
+            '--root', '--wd',
+            '--',
+            'env', '-i'
+        ] + self.env + cmd
+
+
 class MountError(Exception):
     """ Exception that is thrown when a mount related operation failed """
 
@@ -68,13 +400,18 @@ class IsolationType(object):
     class NSPAWN(_Implementation):
         """ systemd-nspawn implementation """
 
-        def __init__(self, target, binds=(), env_vars=None):
+        def __init__(self, target, binds=(), env_vars=None, session=False):
             super(IsolationType.NSPAWN, self).__init__(target=target)
             self.binds = list(binds) + ALWAYS_BIND
             self.env_vars = env_vars or get_all_envs()
-
-        def make_command(self, cmd):
-            """ Transform the command to be executed with systemd-nspawn """
+            self.session = None
+            if session:
+                self.session = _NspawnSession(
+                    target=target,
+                    nspawn_cmd=self._make_nspawn_command([]),
+                    env=NSPAWN_DEFAULT_ENV + ['{}={}'.format(env.name, env.value) for env in self.env_vars])
+
+        def _make_nspawn_command(self, cmd):
             binds = ['--bind={}'.format(bind) for bind in self.binds]
             setenvs = ['--setenv={}={}'.format(env.name, env.value) for env in self.env_vars]
             return [
@@ -84,6 +421,28 @@ class IsolationType(object):
                 '-D', self.target
             ] + binds + setenvs + cmd
 
+        def close(self):
+            """ Stop the container of the session """
+            if self.session:
+                self.session.stop()
+
+        def make_command(self, cmd):
+            """
+            Transform the command to be executed with systemd-nspawn
+
+            In the session mode the command is executed in the running container instead. When the container
+            cannot be started, the session mode is turned off and each command starts its own container again.
+            """
+            if self.session:
+                try:
+                    return self.session.make_command(cmd)
+                except (IOError, OSError) as e:
+                    api.current_logger().warning(
+                        'Cannot start a nspawn session in {}, falling back to a container per command: {}'.format(
+                            self.target, e))
+                    self.session = None
+            return self._make_nspawn_command(cmd)
+
     class CHROOT(_Implementation):
         """ chroot implementation """
 
@@ -128,13 +487,23 @@ class IsolatedActions(object):
     def __init__(self, base_dir, implementation, **kwargs):
         self.base_dir = base_dir
         self.type = implementation(base_dir, **kwargs)
+        self._bind_mounts = []
+        self.call_stats = {'count': 0, 'seconds': 0.0, 'max': 0.0}
 
     def __enter__(self):
         self.type.create()
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
+        while self._bind_mounts:
+            self._bind_mounts.pop().umount()
         self.type.close()
+        if self.call_stats['count']:
+            api.current_logger().debug(
+                'Executed {count} commands in {context} for {base_dir}: '
+                'average latency {avg:.3f}s, max {max:.3f}s'.format(
+                    count=self.call_stats['count'], context=type(self).__name__, base_dir=self.base_dir,
+                    avg=self.call_stats['seconds'] / self.call_stats['count'], max=self.call_stats['max']))
 
     def full_path(self, path):
         """
@@ -157,7 +526,14 @@ class IsolatedActions(object):
 
     def call(self, cmd, *args, **kwargs):
         """ Running the given command using the leapp.libraries.stdlib.run function in a isolated manner. """
-        return run(self.type.make_command(cmd), *args, **kwargs)
+        start = time.time()
+        try:
+            return run(self.type.make_command(cmd), *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            self.call_stats['count'] += 1
+            self.call_stats['seconds'] += elapsed
+            self.call_stats['max'] = max(self.call_stats['max'], elapsed)
 
     def remove(self, path):
         """
@@ -177,25 +553,45 @@ class IsolatedActions(object):
         """
         _makedirs(path=self.full_path(path), mode=mode, exists_ok=exists_ok)
 
-    def copytree_to(self, src, dst):
+    def _copytree(self, src, dst, mode, sync):
+        if mode == CopyMode.BIND:
+            mount = BindMount(source=src, target=dst)
+            mount.mount()
+            self._bind_mounts.append(mount)
+            return
+        copier = _TreeCopier(mode=mode, sync=sync)
+        try:
+            copier.copytree(src, dst)
+        finally:
+            api.current_logger().debug('Copied tree {} to {} ({} mode{}): {}'.format(
+                src, dst, mode, ', sync' if sync else '',
+                ', '.join('{} {}'.format(count, key) for key, count in sorted(copier.stats.items()))))
+
+    def copytree_to(self, src, dst, mode=CopyMode.COPY, sync=False):
         """
         Recursively copy an entire directory tree rooted at src. The destination directory,
         named by dst, must not already exist; it will be created as well as missing parent directories.
 
         The destination directory is considered to be in the isolated environment.
         The source directory is considered to be on the current system root.
+
+        Files are copied using the given CopyMode. With sync=True the destination directory may exist;
+        it is synchronized with the source, skipping files of the same size and modification time.
+        CopyMode.BIND can be used only when the context is entered, the mount is removed on its exit.
         """
-        shutil.copytree(src, self.full_path(dst))
+        self._copytree(src, self.full_path(dst), mode, sync)
 
-    def copytree_from(self, src, dst):
+    def copytree_from(self, src, dst, mode=CopyMode.COPY, sync=False):
         """
         Recursively copy an entire directory tree rooted at src. The destination directory,
         named by dst, must not already exist; it will be created as well as missing parent directories.
 
         The destination directory is considered to be on the current system root.
         The source directory is considered to be in the isolated environment.
+
+        See copytree_to for the description of the mode and sync parameters.
         """
-        shutil.copytree(self.full_path(src), dst)
+        self._copytree(self.full_path(src), dst, mode, sync)
 
     def copy_to(self, src, dst):
         """
@@ -241,9 +637,13 @@ class ChrootActions(IsolatedActions):
 class NspawnActions(IsolatedActions):
     """ Isolation with systemd-nspawn """
 
-    def __init__(self, base_dir, binds=(), env_vars=None):
+    def __init__(self, base_dir, binds=(), env_vars=None, session=False):
+        """
+        With session=True a single container is started for the lifetime of the context and all commands
+        are executed in it, which lowers their latency. Use it just as a context manager then.
+        """
         super(NspawnActions, self).__init__(
-            base_dir=base_dir, implementation=IsolationType.NSPAWN, binds=binds, env_vars=env_vars)
+            base_dir=base_dir, implementation=IsolationType.NSPAWN, binds=binds, env_vars=env_vars, session=session)
 
 
 class NotIsolatedActions(IsolatedActions):
@@ -284,13 +684,48 @@ class MountingBase(object):
         """
         return ['-o', self._mode, self.source]
 
+    def _syscall_mount_args(self):
+        """
+        Arguments (source, fstype, flags, data) of the mount syscall performing the mount, or None when the mount
+        must be performed by the mount command. Individual implementations may override this function.
+        """
+        if self._mode == MountingMode.BIND:
+            return (self.source, None, MS_BIND, None)
+        return None
+
+    def _mount(self):
+        """ Perform the mount by the mount syscall when possible, falling back to the mount command """
+        args = self._syscall_mount_args()
+        if args is not None and _syscall_backend_enabled(self._mode):
+            source, fstype, flags, data = args
+            try:
+                with _measure('mount', 'syscall'):
+                    _syscall_mount(source, self.target, fstype, flags, data)
+                return
+            except OSError as e:
+                api.current_logger().debug('Mount syscall for %s failed with: %s', self.target, str(e))
+        with _measure('mount', 'subprocess'):
+            run(['mount'] + self._mount_options() + [self.target], split=False)
+
+    def _umount(self):
+        """ Lazily unmount the target by the umount2 syscall when possible, falling back to the umount command """
+        if _syscall_backend_enabled(self._mode):
+            try:
+                with _measure('umount', 'syscall'):
+                    _syscall_umount(self.target, MNT_FORCE | MNT_DETACH)
+                return
+            except OSError as e:
+                api.current_logger().debug('Umount syscall for %s failed with: %s', self.target, str(e))
+        with _measure('umount', 'subprocess'):
+            run(['umount', '-fl', self.target], split=False)
+
     def chroot(self):
         """ Create a ChrootActions instance for this mount """
         return ChrootActions(self.target)
 
-    def nspawn(self):
+    def nspawn(self, session=False):
         """ Create a NspawnActions instance for this mount """
-        return NspawnActions(self.target)
+        return NspawnActions(self.target, session=session)
 
     def real(self):
         """ Create a NotIsolatedActions instance for this mount """
@@ -300,12 +735,12 @@ class MountingBase(object):
         """ Cleanup operations """
         if os.path.exists(self.target) and os.path.ismount(self.target):
             try:
-                run(['umount', '-fl', self.target], split=False)
+                self._umount()
             except (OSError, CalledProcessError) as e:
                 api.current_logger().warning('Unmounting %s failed with: %s', self.target, str(e))
         for directory in itertools.chain(self.additional_directories, (self.target,)):
             try:
-                run(['rm', '-rf', directory], split=False)
+                _remove_path(directory)
             except (OSError, CalledProcessError) as e:
                 api.current_logger().warning('Removing mount directory %s failed with: %s', directory, str(e))
 
@@ -322,7 +757,7 @@ class MountingBase(object):
             except (OSError) as e:
                 raise MountError('Failed to create mount target directory {}'.format(directory), str(e))
         try:
-            run(['mount'] + self._mount_options() + [self.target], split=False)
+            self._mount()
         except (OSError, CalledProcessError) as e:
             api.current_logger().warning('Mounting %s failed with: %s', self.target, str(e), exc_info=True)
             raise MountError(
@@ -374,16 +809,22 @@ class BindMount(MountingBase):
 class TypedMount(MountingBase):
     """ Performs a typed mounts """
 
-    def __init__(self, fstype, source, target, config=MountConfig.Mount):
+    def __init__(self, fstype, source, target, config=MountConfig.Mount, options=None):
         super(TypedMount, self).__init__(source=source, target=target, mode=MountingMode.FSTYPE, config=config)
         self.fstype = fstype
+        self.options = options
 
     def _mount_options(self):
+        options = ['-o', self.options] if self.options else []
         return [
-            '-t', self.fstype,
+            '-t', self.fstype
+        ] + options + [
             self.source
         ]
 
+    def _syscall_mount_args(self):
+        return (self.source, self.fstype, 0, self.options)
+
 
 class OverlayMount(MountingBase):
     """ Performs an overlayfs mount """
@@ -398,5 +839,11 @@ class OverlayMount(MountingBase):
     def _mount_options(self):
         return [
             '-t', 'overlay', 'overlay2',
-            '-o', 'lowerdir={},upperdir={},workdir={}'.format(self.source, self._upper_dir, self._work_dir)
+            '-o', self._overlay_options()
         ]
+
+    def _overlay_options(self):
+        return 'lowerdir={},upperdir={},workdir={}'.format(self.source, self._upper_dir, self._work_dir)
+
+    def _syscall_mount_args(self):
+        return ('overlay2', 'overlay', 0, self._overlay_options())
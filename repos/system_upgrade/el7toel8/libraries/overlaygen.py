@@ -10,6 +10,12 @@ from leapp.libraries.stdlib import CalledProcessError, api, run
 
 OVERLAY_DO_NOT_MOUNT = ('tmpfs', 'devpts', 'sysfs', 'proc', 'cramfs', 'sysv', 'vfat')
 
+TMPFS_MAX_MEMORY_RATIO = 0.25
+""" The biggest part of the total memory that can be used by tmpfs for overlay upper layers """
+
+DISK_IMAGE_MIN_USAGE = 512
+""" Space in MiB expected for files newly created in a disk image (e.g. rpmdb rewrites, dnf history) """
+
 
 MountPoints = namedtuple('MountPoints', ['fs_file', 'fs_vfstype'])
 
@@ -20,7 +26,11 @@ def _ensure_enough_diskimage_space(space_needed, directory):
         message = ('Not enough space available for creating required disk images in {directory}. ' +
                    'Needed: {space_needed} MiB').format(space_needed=space_needed, directory=directory)
         api.current_logger().error(message)
-        raise StopActorExecutionError(message)
+        hint = ('The disk images are sparse. The needed space assumes every image grows by the current usage'
+                ' of its filesystem plus {min_usage} MiB for newly created files, up to the LEAPP_OVL_SIZE'
+                ' limit. Free up space in {directory} or lower the LEAPP_OVL_SIZE environment variable.').format(
+                    min_usage=DISK_IMAGE_MIN_USAGE, directory=directory)
+        raise StopActorExecutionError(message, details={'hint': hint})
 
 
 def _get_mountpoints(storage_info):
@@ -44,16 +54,16 @@ def _mount_dir(mounts_dir, mountpoint):
     return os.path.join(mounts_dir, _mount_name(mountpoint))
 
 
-def _prepare_required_mounts(scratch_dir, mounts_dir, mount_points, xfs_info):
+def _prepare_required_mounts(scratch_dir, mounts_dir, mount_points, xfs_info, use_disk_images=True):
     result = {
         mount_point.fs_file: mounting.NullMount(
             _mount_dir(mounts_dir, mount_point.fs_file)) for mount_point in mount_points
     }
 
-    if not xfs_info.mountpoints_without_ftype:
+    if not xfs_info.mountpoints_without_ftype or not use_disk_images:
         return result
 
-    space_needed = _overlay_disk_size() * len(xfs_info.mountpoints_without_ftype)
+    space_needed = sum(_expected_disk_image_usage(mountpoint) for mountpoint in xfs_info.mountpoints_without_ftype)
     disk_images_directory = os.path.join(scratch_dir, 'diskimages')
 
     # Ensure we cleanup old disk images before we check for space contraints.
@@ -103,6 +113,70 @@ def _overlay_disk_size():
     return disk_size
 
 
+def _expected_disk_image_usage(mountpoint):
+    """
+    Estimate the space in MiB really used by the sparse disk image for the mountpoint.
+
+    The disk image holds the upper directory of the mountpoint overlay, which contains files modified
+    in the overlay (copied up) and files newly created there. The copy-ups cannot need more than
+    the current usage of the filesystem; for the new files DISK_IMAGE_MIN_USAGE is assumed. The usage
+    cannot exceed the size of the disk image.
+    """
+    disk_size = _overlay_disk_size()
+    try:
+        stat = os.statvfs(mountpoint)
+    except OSError:
+        return disk_size
+    used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize // (1024 * 1024) + 1
+    return min(disk_size, used + DISK_IMAGE_MIN_USAGE)
+
+
+def _tmpfs_upper_size(memory_info):
+    """
+    Get the size in MiB of tmpfs for overlay upper layers, or 0 when they should be placed on disk.
+
+    tmpfs is used only when requested by LEAPP_OVL_TMPFS=1 and the expected write volume into the upper
+    layers, limited by LEAPP_OVL_SIZE, fits into TMPFS_MAX_MEMORY_RATIO of the total memory.
+    """
+    if os.getenv('LEAPP_OVL_TMPFS', default='0') != '1':
+        return 0
+    if not memory_info or not memory_info.mem_total:
+        api.current_logger().debug('Total memory is unknown, overlay upper layers are placed on disk.')
+        return 0
+    size = _overlay_disk_size()
+    if size * 1024 > memory_info.mem_total * TMPFS_MAX_MEMORY_RATIO:
+        api.current_logger().debug(
+            'Not enough memory for tmpfs of %d MiB, overlay upper layers are placed on disk.', size)
+        return 0
+    return size
+
+
+@contextlib.contextmanager
+def _mount_tmpfs_upper(mounts_dir, memory_info):
+    """
+    Context manager mounting tmpfs on the mounts directory when it should hold overlay upper layers.
+
+    Yields True when the tmpfs is mounted, False when the upper layers are placed on disk.
+    """
+    size = _tmpfs_upper_size(memory_info)
+    if not size:
+        yield False
+        return
+    tmpfs = mounting.TypedMount(fstype='tmpfs', source='tmpfs', target=mounts_dir,
+                                options='size={}m,mode=0700'.format(size))
+    try:
+        tmpfs.mount()
+    except mounting.MountError as e:
+        api.current_logger().warning('Failed to mount tmpfs for overlay upper layers, using disk instead: %s', e)
+        yield False
+        return
+    api.current_logger().debug('Overlay upper layers are placed on tmpfs of %d MiB in %s', size, mounts_dir)
+    try:
+        yield True
+    finally:
+        tmpfs.umount()
+
+
 def cleanup_scratch(scratch_dir, mounts_dir):
     """
     Function to cleanup the scratch directory
@@ -123,26 +197,36 @@ def cleanup_scratch(scratch_dir, mounts_dir):
 def _create_mount_disk_image(disk_images_directory, path):
     """
     Creates the mount disk image, for cases when we hit XFS with ftype=0
+
+    The image is a sparse file, so the space is allocated just when it is really used by the overlay.
+    Inode tables and the journal are initialized lazily (by the kernel when the filesystem is mounted)
+    to not write them all when the filesystem is created.
     """
     diskimage_path = os.path.join(disk_images_directory, _mount_name(path))
     disk_size = _overlay_disk_size()
 
     api.current_logger().debug('Attempting to create disk image with size %d MiB at %s', disk_size, diskimage_path)
     utils.call_with_failure_hint(
-        cmd=['/bin/dd', 'if=/dev/zero', 'of={}'.format(diskimage_path), 'bs=1M', 'count={}'.format(disk_size)],
-        hint='Please ensure that there is enough diskspace in {} at least {} MiB are needed'.format(
-            diskimage_path, disk_size)
+        cmd=['/usr/bin/truncate', '--size={}M'.format(disk_size), diskimage_path],
+        hint='Please ensure that {} is writable'.format(disk_images_directory)
     )
 
     api.current_logger().debug('Creating ext4 filesystem in disk image at %s', diskimage_path)
     try:
-        utils.call_with_oserror_handled(cmd=['/sbin/mkfs.ext4', '-F', diskimage_path])
+        utils.call_with_oserror_handled(cmd=[
+            '/sbin/mkfs.ext4', '-F', '-E', 'lazy_itable_init=1,lazy_journal_init=1,nodiscard', diskimage_path
+        ])
     except CalledProcessError as e:
         api.current_logger().error('Failed to create ext4 filesystem %s', exc_info=True)
         raise StopActorExecutionError(
             message=str(e)
         )
 
+    try:
+        allocated = os.stat(diskimage_path).st_blocks * 512 // (1024 * 1024)
+        api.current_logger().debug('Disk image %s allocates %d MiB of %d MiB', diskimage_path, allocated, disk_size)
+    except OSError:
+        pass
     return diskimage_path
 
 
@@ -198,25 +282,33 @@ def _mount_dnf_cache(overlay_target):
 
 
 @contextlib.contextmanager
-def create_source_overlay(mounts_dir, scratch_dir, xfs_info, storage_info, mount_target=None):
+def create_source_overlay(mounts_dir, scratch_dir, xfs_info, storage_info, mount_target=None, memory_info=None):
     """
     Context manager that prepares the source system overlay and yields the mount.
+
+    When memory_info is given, the overlay upper layers can be placed on tmpfs instead of the disk,
+    see _tmpfs_upper_size. Disk images for XFS without ftype are not needed in such a case.
     """
     api.current_logger().debug('Creating source overlay in {scratch_dir} with mounts in {mounts_dir}'.format(
         scratch_dir=scratch_dir, mounts_dir=mounts_dir))
     try:
         _create_mounts_dir(scratch_dir, mounts_dir)
-        mounts = _prepare_required_mounts(scratch_dir, mounts_dir, _get_mountpoints(storage_info), xfs_info)
-        with mounts.pop('/') as root_mount:
-            with mounting.OverlayMount(name='system_overlay', source='/', workdir=root_mount.target) as root_overlay:
-                if mount_target:
-                    target = mounting.BindMount(source=root_overlay.target, target=mount_target)
-                else:
-                    target = mounting.NullMount(target=root_overlay.target)
-                with target:
-                    with _build_overlay_mount(root_overlay, mounts) as overlay:
-                        with _mount_dnf_cache(overlay.target):
-                            yield overlay
+        with _mount_tmpfs_upper(mounts_dir, memory_info) as on_tmpfs:
+            mounts = _prepare_required_mounts(scratch_dir, mounts_dir, _get_mountpoints(storage_info), xfs_info,
+                                              use_disk_images=not on_tmpfs)
+            with mounts.pop('/') as root_mount:
+                with mounting.OverlayMount(name='system_overlay', source='/',
+                                           workdir=root_mount.target) as root_overlay:
+                    if mount_target:
+                        target = mounting.BindMount(source=root_overlay.target, target=mount_target)
+                    else:
+                        target = mounting.NullMount(target=root_overlay.target)
+                    with target:
+                        with _build_overlay_mount(root_overlay, mounts) as overlay:
+                            with _mount_dnf_cache(overlay.target):
+                                yield overlay
     except Exception:
         cleanup_scratch(scratch_dir, mounts_dir)
         raise
+    finally:
+        api.current_logger().debug('Mount operations so far: {}'.format(mounting.format_mount_stats()))
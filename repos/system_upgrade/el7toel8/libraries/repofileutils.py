@@ -10,6 +10,10 @@ try:
 except ImportError:
     api.current_logger().warning('repofileutils.py: failed to import dnf')
 
+_MAX_SYMLINKS = 40
+
+_repodirs_cache = {}
+
 
 def _parse_repository(repoid, repo_data):
     def asbool(x):
@@ -48,12 +52,58 @@ def get_repodirs():
     By default, the possible paths on RHEL 7 should be:
     ['/etc/yum.repos.d', '/etc/yum/repos.d', '/etc/distro.repos.d']
 
+    The dnf configuration is read just once, further calls return the cached list.
+
     ATTENTION: Requires the dnf module to be present.
     TODO: Get repodirs inside given context.
     """
-    with dnf.base.Base() as base:
-        base.conf.read(priority=dnf.conf.PRIO_MAINCONFIG)
-        return list({os.path.realpath(d) for d in base.conf.reposdir if os.path.isdir(d)})
+    if 'reposdir' not in _repodirs_cache:
+        with dnf.base.Base() as base:
+            base.conf.read(priority=dnf.conf.PRIO_MAINCONFIG)
+            _repodirs_cache['reposdir'] = list({os.path.realpath(d) for d in base.conf.reposdir if os.path.isdir(d)})
+    return list(_repodirs_cache['reposdir'])
+
+
+def _resolve_path(context, path):
+    """
+    Return the real path on the system of the path inside the context, following symlinks inside the context.
+
+    Just symlinks of the last path component are followed, which is enough for repo files and directories.
+    """
+    for dummy in range(_MAX_SYMLINKS):
+        full_path = context.full_path(path)
+        if not os.path.islink(full_path):
+            return full_path
+        target = os.readlink(full_path)
+        path = target if os.path.isabs(target) else os.path.join(os.path.dirname(path), target)
+    return context.full_path(path)
+
+
+def _list_dir(path):
+    """Return names of entries in the directory or an empty list if it cannot be listed."""
+    try:
+        if hasattr(os, 'scandir'):
+            return [entry.name for entry in os.scandir(path)]
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _find_repofiles(context, repodirs):
+    """
+    Return paths (inside the context) of all *.repo files in the given directories of the context.
+
+    Equivalent of `find -L <repodirs> -maxdepth 1 -type f -name '*.repo'` executed in the context,
+    done without spawning any process.
+    """
+    repofiles_paths = []
+    for repodir in repodirs:
+        full_repodir = _resolve_path(context, repodir)
+        for name in sorted(_list_dir(full_repodir)):
+            path = os.path.join(repodir, name)
+            if name.endswith('.repo') and os.path.isfile(_resolve_path(context, path)):
+                repofiles_paths.append(path)
+    return repofiles_paths
 
 
 def get_parsed_repofiles(context=mounting.NotIsolatedActions(base_dir='/')):
@@ -70,11 +120,11 @@ def get_parsed_repofiles(context=mounting.NotIsolatedActions(base_dir='/')):
     :type context: mounting.IsolatedActions class
     :rtype: List(RepositoryFile)
     """
+    repofiles_paths = _find_repofiles(context, get_repodirs())
+
     repofiles = []
-    cmd = ['find', '-L'] + get_repodirs() + ['-maxdepth', '1', '-type', 'f', '-name', '*.repo']
-    repofiles_paths = context.call(cmd, split=True)['stdout']
     for repofile_path in repofiles_paths:
-        repofile = parse_repofile(context.full_path(repofile_path))
+        repofile = parse_repofile(_resolve_path(context, repofile_path))
         # we want full path in cotext, not the real full path
         repofile.file = repofile_path
         repofiles.append(repofile)
@@ -104,3 +154,69 @@ def get_duplicate_repositories(repofiles):
     rf_repos = {repofile.file: [repo.repoid for repo in repofile.data] for repofile in repofiles}
     repos = _invert_dict(rf_repos)
     return {repo: set(rfiles) for repo, rfiles in repos.items() if len(set(rfiles)) > 1}
+
+
+def get_repository_url(repo):
+    """
+    Return the URL used by DNF to access the repository.
+
+    :type repo: RepositoryData
+    :return: The mirrorlist, metalink or baseurl (in this order of precedence) or an empty string
+    """
+    return repo.mirrorlist or repo.metalink or repo.baseurl or ''
+
+
+def get_url_kind(repo):
+    """
+    Return the kind of the repository URL: 'local' for file:// URLs, 'remote' for others and 'none' if unset.
+
+    :type repo: RepositoryData
+    """
+    url = get_repository_url(repo)
+    if not url:
+        return 'none'
+    return 'local' if url.startswith('file:') else 'remote'
+
+
+class RepositoriesUsageIndex(object):
+    """
+    Hash based lookups over the RepositoriesUsage message.
+
+    :param usage: RepositoriesUsage message, can be None
+    """
+
+    def __init__(self, usage=None):
+        self._repos = {}
+        self._pkg_repo = {}
+        for repo in usage.repositories if usage else ():
+            self._repos[repo.repoid] = repo
+            for pkg in repo.packages:
+                self._pkg_repo[pkg] = repo.repoid
+
+    def __contains__(self, repoid):
+        return repoid in self._repos
+
+    def is_enabled(self, repoid):
+        repo = self._repos.get(repoid)
+        return bool(repo and repo.enabled)
+
+    def url_kind(self, repoid):
+        repo = self._repos.get(repoid)
+        return repo.url_kind if repo else None
+
+    def enabled_repoids(self):
+        """Return set of ids of all enabled repositories."""
+        return {repoid for repoid, repo in self._repos.items() if repo.enabled}
+
+    def used_repoids(self):
+        """Return set of ids of enabled repositories with installed packages."""
+        return {repoid for repoid, repo in self._repos.items() if repo.enabled and repo.packages}
+
+    def packages(self, repoid):
+        """Return list of installed packages from the repository."""
+        repo = self._repos.get(repoid)
+        return list(repo.packages) if repo else []
+
+    def repository_of(self, package):
+        """Return id of the repository the package has been installed from or None."""
+        return self._pkg_repo.get(package)
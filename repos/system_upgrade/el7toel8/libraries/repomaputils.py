@@ -0,0 +1,96 @@
+import weakref
+
+from leapp.libraries.common.utils import get_cache_owner
+from leapp.libraries.stdlib import api
+from leapp.models import RepositoriesMap
+
+_repositories_map_indexes = weakref.WeakKeyDictionary()
+
+
+class RepositoriesMapIndex(object):
+    """
+    Hash based lookups over records of the RepositoriesMap message.
+
+    Records are indexed by to_pes_repo, from_repoid and (arch, repo_type); all lookups return
+    records in the order they are stored in the message.
+
+    :param repositories: list of RepositoryMap records
+    """
+
+    def __init__(self, repositories=()):
+        self._repositories = list(repositories)
+        self._by_to_pes_repo = {}
+        self._by_from_repoid = {}
+        self._by_arch = {}
+        self._pes_repo_mappings = {}
+        for repo in self._repositories:
+            self._by_to_pes_repo.setdefault(repo.to_pes_repo, []).append(repo)
+            self._by_from_repoid.setdefault(repo.from_repoid, []).append(repo)
+            self._by_arch.setdefault((repo.arch, repo.repo_type), []).append(repo)
+
+    def __len__(self):
+        return len(self._repositories)
+
+    def __iter__(self):
+        return iter(self._repositories)
+
+    @staticmethod
+    def _filter_arch(repos, arch):
+        return [repo for repo in repos if arch is None or repo.arch == arch]
+
+    def by_to_pes_repo(self, to_pes_repo, arch=None):
+        """Return records mapping to the PES repository, optionally just those for the architecture."""
+        return self._filter_arch(self._by_to_pes_repo.get(to_pes_repo, ()), arch)
+
+    def by_from_repoid(self, from_repoid, arch=None):
+        """Return records mapping the source repository, optionally just those for the architecture."""
+        return self._filter_arch(self._by_from_repoid.get(from_repoid, ()), arch)
+
+    def by_arch(self, arch, repo_type=None):
+        """Return records for the architecture, optionally just those of the repository type."""
+        if repo_type is not None:
+            return list(self._by_arch.get((arch, repo_type), ()))
+        return [repo for repo in self._repositories if repo.arch == arch]
+
+    def from_repoids(self, arch):
+        """Return set of source repository ids mapped for the architecture."""
+        return {repo.from_repoid for repo in self.by_arch(arch)}
+
+    def pes_repo_mapping(self, arch):
+        """
+        Return dict mapping PES repositories to target repository ids for the architecture.
+
+        When more records map the same PES repository, the last one wins.
+        """
+        if arch not in self._pes_repo_mappings:
+            self._pes_repo_mappings[arch] = {
+                repo.to_pes_repo: repo.to_repoid for repo in self._repositories if repo.arch == arch
+            }
+        return self._pes_repo_mappings[arch]
+
+
+def get_repositories_map_index(context=api):
+    """
+    Get the index of the RepositoriesMap message.
+
+    The message is consumed and the index is built just once per actor, further calls return
+    the same instance.
+
+    :param context: context of the execution
+    :return: RepositoriesMapIndex or None when no RepositoriesMap message has been received
+    """
+    owner = get_cache_owner(context)
+    if owner in _repositories_map_indexes:
+        return _repositories_map_indexes[owner]
+
+    msgs = iter(context.consume(RepositoriesMap))
+    msg = next(msgs, None)
+    if list(msgs):
+        api.current_logger().warning('Unexpectedly received more than one RepositoriesMap message.')
+    index = RepositoriesMapIndex(msg.repositories) if msg is not None else None
+    try:
+        _repositories_map_indexes[owner] = index
+    except TypeError:
+        # the owner cannot be referenced weakly (e.g. None), do not cache
+        pass
+    return index
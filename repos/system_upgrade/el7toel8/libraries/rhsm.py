@@ -1,8 +1,10 @@
 import contextlib
+import copy
 import functools
 import os
 import re
 import time
+import weakref
 
 from leapp import reporting
 from leapp.exceptions import StopActorExecutionError
@@ -17,6 +19,9 @@ _RE_SKU_CONSUMED = re.compile(r'SKU:\s*([^\s]+)')
 _ATTEMPTS = 5
 _RETRY_SLEEP = 5
 _DEFAULT_RHSM_REPOFILE = '/etc/yum.repos.d/redhat.repo'
+# {context: RHSMState} for isolated contexts, {base_dir: RHSMState} for the host
+_rhsm_states = weakref.WeakKeyDictionary()
+_host_rhsm_states = {}
 
 SCA_TEXT = "Content Access Mode is set to Simple Content Access"
 
@@ -90,6 +95,74 @@ def _handle_rhsm_exceptions(hint=None):
         )
 
 
+class RHSMState(object):
+    """
+    Results of the subscription-manager queries cached for one context.
+
+    The values are kept until the state is invalidated, which is done by all functions in this
+    library that modify the subscription-manager configuration. The state lives in the memory
+    of the process, so it is not shared between actors.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key, getter):
+        """Return the cached value of the key, calling the getter to get the value when not cached yet."""
+        if key not in self._values:
+            self._values[key] = getter()
+        return copy.copy(self._values[key])
+
+    def invalidate(self):
+        self._values.clear()
+
+
+def get_rhsm_state(context):
+    """
+    Get the cached RHSM state of the given context.
+
+    All non-isolated contexts over the same directory share the state. Isolated contexts (containers)
+    can be created repeatedly over the same directory with a different content, so each of them
+    has its own state, which is dropped together with the context.
+
+    :param context: An instance of a mounting.IsolatedActions class
+    :type context: mounting.IsolatedActions class
+    :rtype: RHSMState
+    """
+    is_isolated = getattr(context, 'is_isolated', None)
+    if is_isolated is not None and not is_isolated():
+        return _host_rhsm_states.setdefault(context.base_dir, RHSMState())
+    state = _rhsm_states.get(context)
+    if state is None:
+        state = _rhsm_states[context] = RHSMState()
+    return state
+
+
+def invalidate_rhsm_state(context):
+    """Drop all cached subscription-manager results of the given context."""
+    get_rhsm_state(context).invalidate()
+
+
+def _cached(f):
+    """Decorator caching the result of a query function for its arguments in the RHSM state of the context."""
+    @functools.wraps(f)
+    def wrapper(context, *args, **kwargs):
+        key = (f.__name__, args, tuple(sorted(kwargs.items())))
+        return get_rhsm_state(context).get(key, lambda: f(context, *args, **kwargs))
+    return wrapper
+
+
+def _invalidates_state(f):
+    """Decorator invalidating the RHSM state of the context after calling a function changing it."""
+    @functools.wraps(f)
+    def wrapper(context, *args, **kwargs):
+        try:
+            return f(context, *args, **kwargs)
+        finally:
+            invalidate_rhsm_state(context)
+    return wrapper
+
+
 def skip_rhsm():
     """Check whether we should skip RHSM related code."""
     return get_env('LEAPP_NO_RHSM', '0') == '1'
@@ -106,6 +179,7 @@ def with_rhsm(f):
 
 
 @with_rhsm
+@_cached
 def get_attached_skus(context):
     """
     Retrieve the list of the SKUs the system is attached to with the subscription-manager.
@@ -121,6 +195,7 @@ def get_attached_skus(context):
 
 
 @with_rhsm
+@_cached
 def get_rhsm_status(context):
     """
     Retrieve "subscription-manager status" output.
@@ -147,6 +222,7 @@ def is_manifest_sca(context):
     return SCA_TEXT in get_rhsm_status(context)
 
 
+@_cached
 def get_available_repo_ids(context):
     """
     Retrieve repo ids of all the repositories available through the subscription-manager.
@@ -156,10 +232,10 @@ def get_available_repo_ids(context):
     :return: Repositories that are available to the current system through the subscription-manager
     :rtype: List(string)
     """
-    # Regenerated redhat.repo file ...
-    # FIXME: try to come up with something less invasive than yum clean all
-    # but still safe to call..
-    cmd = ['yum', 'clean', 'all']
+    # Regenerate the redhat.repo file by the subscription-manager yum plugin.
+    # Just mark the metadata as expired, so yum can reuse already downloaded
+    # metadata that are still valid instead of fetching everything again.
+    cmd = ['yum', 'clean', 'expire-cache']
     try:
         context.call(cmd)
     except CalledProcessError as exc:
@@ -223,6 +299,7 @@ def _inhibit_on_duplicate_repos(repofiles):
 
 
 @with_rhsm
+@_cached
 def get_enabled_repo_ids(context):
     """
     Retrieve repo ids of all the repositories enabled through the subscription-manager.
@@ -238,6 +315,7 @@ def get_enabled_repo_ids(context):
 
 
 @with_rhsm
+@_invalidates_state
 @_rhsm_retry(max_attempts=_ATTEMPTS, sleep=_RETRY_SLEEP)
 def unset_release(context):
     """
@@ -251,6 +329,7 @@ def unset_release(context):
 
 
 @with_rhsm
+@_invalidates_state
 @_rhsm_retry(max_attempts=_ATTEMPTS, sleep=_RETRY_SLEEP)
 def set_release(context, release):
     """
@@ -266,6 +345,7 @@ def set_release(context, release):
 
 
 @with_rhsm
+@_cached
 def get_release(context):
     """
     Retrieves the release the subscription-manager has been pinned to, if applicable.
@@ -282,6 +362,7 @@ def get_release(context):
 
 
 @with_rhsm
+@_invalidates_state
 @_rhsm_retry(max_attempts=_ATTEMPTS, sleep=_RETRY_SLEEP)
 def refresh(context):
     """
@@ -325,6 +406,9 @@ def set_container_mode(context):
     could be affected and the generated repo file in the container could be
     affected as well (e.g. when the release is set, using rhsm, on the host).
 
+    The call is idempotent, so it can be called again for a reused target userspace. Without the -n
+    option, ln would follow the existing /etc/rhsm-host link and create the /etc/rhsm/rhsm link inside.
+
     :param context: An instance of a mounting.IsolatedActions class
     :type context: mounting.IsolatedActions class
     """
@@ -333,13 +417,14 @@ def set_container_mode(context):
                                    'on host. Skipping the action.')
         return
     try:
-        context.call(['ln', '-s', '/etc/rhsm', '/etc/rhsm-host'])
+        context.call(['ln', '-sfn', '/etc/rhsm', '/etc/rhsm-host'])
     except CalledProcessError:
         raise StopActorExecutionError(
                 message='Cannot set the container mode for the subscription-manager.')
 
 
 @with_rhsm
+@_invalidates_state
 def switch_certificate(context, rhsm_info, cert_path):
     """
     Perform all actions needed to switch the passed RHSM product certificate.
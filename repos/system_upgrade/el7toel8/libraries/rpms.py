@@ -1,5 +1,30 @@
+import bisect
+import fnmatch
+import json
+import os
+import weakref
+from collections import namedtuple
+
 from leapp.libraries import stdlib
-from leapp.models import InstalledRPM
+from leapp.libraries.common.utils import get_cache_owner
+from leapp.models import (
+    InstalledPackedRPM,
+    InstalledRedHatSignedPackedRPM,
+    InstalledRedHatSignedRPM,
+    InstalledRPM,
+    InstalledUnsignedPackedRPM,
+    InstalledUnsignedRPM,
+    PackedRPMList,
+    RPM,
+)
+
+
+# Format of a single package entry, fields are separated by '|':
+#   name|version|release|epoch|packager|arch|pgpsig
+RPM_QUERY_FORMAT = (
+    r'%{NAME}|%{VERSION}|%{RELEASE}|%|EPOCH?{%{EPOCH}}:{(none)}||%|PACKAGER?{%{PACKAGER}}:{(none)}||%|'
+    r'ARCH?{%{ARCH}}:{}||%|DSAHEADER?{%{DSAHEADER:pgpsig}}:{%|RSAHEADER?{%{RSAHEADER:pgpsig}}:{(none)}|}|'
+)
 
 
 def get_installed_rpms():
@@ -7,8 +32,7 @@ def get_installed_rpms():
         '/bin/rpm',
         '-qa',
         '--queryformat',
-        r'%{NAME}|%{VERSION}|%{RELEASE}|%|EPOCH?{%{EPOCH}}:{(none)}||%|PACKAGER?{%{PACKAGER}}:{(none)}||%|'
-        r'ARCH?{%{ARCH}}:{}||%|DSAHEADER?{%{DSAHEADER:pgpsig}}:{%|RSAHEADER?{%{RSAHEADER:pgpsig}}:{(none)}|}|\n'
+        RPM_QUERY_FORMAT + r'\n'
     ]
     try:
         return stdlib.run(rpm_cmd, split=True)['stdout']
@@ -19,6 +43,404 @@ def get_installed_rpms():
         return []
 
 
+RPMDB_FILES = ('/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite')
+"""Files of the rpmdb, the first existing one is used to detect changes of the database."""
+
+RPMDB_SNAPSHOT_PATH = '/var/lib/leapp/rpmdb-snapshot.json'
+"""File storing the last snapshot of the rpmdb, so it is shared by actors, each running in its own process."""
+
+RpmdbDiff = namedtuple('RpmdbDiff', ['added',    # A list of RPM models present just in the new snapshot
+                                     'removed',  # A list of RPM models present just in the old snapshot
+                                     'changed',  # A list of (old RPM, new RPM) tuples of updated packages
+                                     ])
+
+_snapshot_cache = {}
+
+
+def parse_installed_rpm(entry):
+    """
+    Create the RPM model from the line printed by `rpm -qa` using the RPM_QUERY_FORMAT.
+
+    :return: RPM model or None for empty lines
+    """
+    entry = entry.strip()
+    if not entry:
+        return None
+    name, version, release, epoch, packager, arch, pgpsig = entry.split('|')
+    return RPM(name=name, version=version, release=release, epoch=epoch, packager=packager, arch=arch,
+               pgpsig=pgpsig)
+
+
+def get_rpmdb_stamp(rpmdb_files=None):
+    """
+    Get the stamp of the current state of the rpmdb.
+
+    :param rpmdb_files: files of the rpmdb to check, RPMDB_FILES by default
+    :return: (path, inode, size, mtime) tuple of the rpmdb file or None if no such file exists
+    """
+    for path in rpmdb_files or RPMDB_FILES:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        return (path, stat.st_ino, stat.st_size, stat.st_mtime)
+    return None
+
+
+class RpmdbSnapshot(object):
+    """Immutable set of packages installed on the system at the moment the snapshot has been taken."""
+
+    def __init__(self, packages, stamp=None):
+        self.packages = tuple(packages)
+        self.stamp = stamp
+        self._by_nevra = {_package_key(pkg): pkg for pkg in self.packages}
+
+    def __contains__(self, nevra):
+        try:
+            return _split_nevra(nevra) in self._by_nevra
+        except ValueError:
+            return False
+
+    def __len__(self):
+        return len(self.packages)
+
+    def __iter__(self):
+        return iter(self.packages)
+
+
+def _snapshot_from_entries(entries, stamp):
+    return RpmdbSnapshot((pkg for pkg in map(parse_installed_rpm, entries) if pkg is not None), stamp=stamp)
+
+
+def _load_stored_snapshot(stamp):
+    """Return the snapshot stored in RPMDB_SNAPSHOT_PATH if it has been taken for the stamp, otherwise None."""
+    try:
+        with open(RPMDB_SNAPSHOT_PATH) as f:
+            data = json.load(f)
+        if tuple(data['stamp']) != stamp:
+            return None
+        return _snapshot_from_entries(data['entries'], stamp)
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _store_snapshot(stamp, entries):
+    tmp_path = RPMDB_SNAPSHOT_PATH + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'stamp': list(stamp), 'entries': entries}, f)
+        os.rename(tmp_path, RPMDB_SNAPSHOT_PATH)
+    except (IOError, OSError) as e:
+        stdlib.api.current_logger().debug('Cannot store the snapshot of the rpmdb: {}'.format(e))
+
+
+def get_rpmdb_snapshot():
+    """
+    Get the snapshot of packages installed on the system.
+
+    The packages are listed by `rpm -qa` only if the rpmdb has been modified since the last snapshot
+    has been taken, otherwise the previous snapshot is returned. The last snapshot is cached in memory
+    and stored in RPMDB_SNAPSHOT_PATH, so it is reused also by actors running later.
+
+    :rtype: RpmdbSnapshot
+    """
+    stamp = get_rpmdb_stamp()
+    if stamp is None:
+        return _snapshot_from_entries(get_installed_rpms(), stamp)
+    if _snapshot_cache.get('stamp') == stamp:
+        return _snapshot_cache['snapshot']
+    snapshot = _load_stored_snapshot(stamp)
+    if snapshot is None:
+        entries = [entry.strip() for entry in get_installed_rpms() if entry.strip()]
+        snapshot = _snapshot_from_entries(entries, stamp)
+        _store_snapshot(stamp, entries)
+    _snapshot_cache.update(stamp=stamp, snapshot=snapshot)
+    return snapshot
+
+
+def diff(old, new):
+    """
+    Compare two snapshots of the rpmdb.
+
+    Packages which have been replaced by another version of the package with the same name and
+    architecture are reported as changed. In case of packages which can be installed in more
+    versions at once (e.g. kernel), added and removed versions are reported separately.
+
+    :type old: RpmdbSnapshot
+    :type new: RpmdbSnapshot
+    :rtype: RpmdbDiff
+    """
+    # pylint: disable=protected-access
+    removed = [pkg for key, pkg in old._by_nevra.items() if key not in new._by_nevra]
+    added = [pkg for key, pkg in new._by_nevra.items() if key not in old._by_nevra]
+
+    removed_by_na = {}
+    for pkg in removed:
+        removed_by_na.setdefault((pkg.name, pkg.arch), []).append(pkg)
+    added_by_na = {}
+    for pkg in added:
+        added_by_na.setdefault((pkg.name, pkg.arch), []).append(pkg)
+
+    changed = []
+    for name_arch, removed_pkgs in removed_by_na.items():
+        added_pkgs = added_by_na.get(name_arch, [])
+        if len(removed_pkgs) == 1 and len(added_pkgs) == 1:
+            changed.append((removed_pkgs[0], added_pkgs[0]))
+    changed_old = {id(old_pkg) for old_pkg, _ in changed}
+    changed_new = {id(new_pkg) for _, new_pkg in changed}
+
+    sort_key = _package_key
+    return RpmdbDiff(
+        added=sorted((pkg for pkg in added if id(pkg) not in changed_new), key=sort_key),
+        removed=sorted((pkg for pkg in removed if id(pkg) not in changed_old), key=sort_key),
+        changed=sorted(changed, key=lambda pair: _package_key(pair[0])),
+    )
+
+
+def _package_key(pkg):
+    return (pkg.name, _normalize_epoch(pkg.epoch), pkg.version, pkg.release, pkg.arch)
+
+
+def _normalize_epoch(epoch):
+    return '0' if epoch in (None, '', '(none)') else epoch
+
+
+def _split_nevra(nevra):
+    """
+    Split the NEVRA string (name-[epoch:]version-release.arch) into a tuple.
+
+    :return: (name, epoch, version, release, arch)
+    """
+    nevr, arch = nevra.rsplit('.', 1)
+    name, version, release = nevr.rsplit('-', 2)
+    epoch = None
+    if ':' in version:
+        epoch, version = version.split(':', 1)
+    return name, _normalize_epoch(epoch), version, release, arch
+
+
+def pack_rpms(packages):
+    """
+    Encode the list of RPM models into the columnar PackedRPMList model.
+
+    :param packages: iterable of RPM models
+    :rtype: PackedRPMList
+    """
+    packed = PackedRPMList()
+    strings = {}
+
+    def _intern(value):
+        if value is None:
+            return -1
+        if value not in strings:
+            strings[value] = len(packed.strings)
+            packed.strings.append(value)
+        return strings[value]
+
+    for pkg in packages:
+        packed.names.append(pkg.name)
+        packed.epochs.append(pkg.epoch)
+        packed.versions.append(pkg.version)
+        packed.releases.append(pkg.release)
+        packed.arches.append(pkg.arch)
+        packed.packagers.append(_intern(pkg.packager))
+        packed.pgpsigs.append(_intern(pkg.pgpsig))
+        packed.repositories.append(_intern(pkg.repository))
+    return packed
+
+
+class RPMListView(object):
+    """
+    Read-only sequence of RPM models backed by the PackedRPMList model.
+
+    The RPM models are created lazily, only when the particular item is accessed.
+    """
+
+    def __init__(self, packed):
+        self._packed = packed
+
+    def __len__(self):
+        return len(self._packed.names)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        packed = self._packed
+        strings = packed.strings
+        repository = packed.repositories[position]
+        return RPM(
+            name=packed.names[position],
+            epoch=packed.epochs[position],
+            version=packed.versions[position],
+            release=packed.releases[position],
+            arch=packed.arches[position],
+            packager=strings[packed.packagers[position]],
+            pgpsig=strings[packed.pgpsigs[position]],
+            repository=strings[repository] if repository >= 0 else None)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def names(self):
+        """Return names of all packages without creating the RPM models."""
+        return self._packed.names
+
+    def keys(self):
+        """Yield (name, epoch, version, release, arch) of all packages without creating the RPM models."""
+        packed = self._packed
+        for key in zip(packed.names, packed.epochs, packed.versions, packed.releases, packed.arches):
+            yield key
+
+
+def _iter_package_keys(packages):
+    if isinstance(packages, RPMListView):
+        return packages.keys()
+    return ((pkg.name, pkg.epoch, pkg.version, pkg.release, pkg.arch) for pkg in packages)
+
+
+class PackageIndex(object):
+    """
+    Indexed view of packages listed in a message of the InstalledRPM family.
+
+    All lookups by name or NEVRA are done in constant time, prefix and glob queries use
+    the sorted list of package names. The index holds just positions of the packages, so
+    in case of the RPMListView the RPM models are created only for the returned packages.
+    """
+
+    def __init__(self, packages=None):
+        self._packages = packages
+        self._by_name = {}
+        self._by_nevra = {}
+        for position, key in enumerate(_iter_package_keys(packages or ())):
+            name, epoch, version, release, arch = key
+            self._by_name.setdefault(name, []).append(position)
+            self._by_nevra[(name, _normalize_epoch(epoch), version, release, arch)] = position
+        self._names = sorted(self._by_name)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __iter__(self):
+        for name in self._names:
+            for position in self._by_name[name]:
+                yield self._packages[position]
+
+    def packages(self):
+        """Return the indexed sequence of packages in its original order, None when there has been no message."""
+        return self._packages
+
+    def names(self):
+        """Return the sorted list of names of the indexed packages."""
+        return list(self._names)
+
+    def get(self, name):
+        """Return the list of packages (more versions or architectures can be installed) with the given name."""
+        return [self._packages[position] for position in self._by_name.get(name, [])]
+
+    def get_by_nevra(self, nevra):
+        """
+        Return the package matching the NEVRA string or None.
+
+        The epoch in the string is optional, e.g. `bash-0:4.2.46-34.el7.x86_64` and `bash-4.2.46-34.el7.x86_64`
+        are equal.
+        """
+        try:
+            position = self._by_nevra.get(_split_nevra(nevra))
+        except ValueError:
+            return None
+        return self._packages[position] if position is not None else None
+
+    def startswith(self, prefix):
+        """Return the sorted list of names of the packages starting with the prefix."""
+        start = bisect.bisect_left(self._names, prefix)
+        end = start
+        while end < len(self._names) and self._names[end].startswith(prefix):
+            end += 1
+        return self._names[start:end]
+
+    def match(self, pattern):
+        """Return the sorted list of names of the packages matching the shell-style pattern."""
+        prefix = pattern
+        for i, char in enumerate(pattern):
+            if char in '*?[':
+                prefix = pattern[:i]
+                break
+        else:
+            return [pattern] if pattern in self else []
+        return fnmatch.filter(self.startswith(prefix), pattern)
+
+
+# {context: {model: PackageIndex}}
+_package_indexes = weakref.WeakKeyDictionary()
+
+
+PACKED_MODELS = {
+    InstalledRPM: InstalledPackedRPM,
+    InstalledRedHatSignedRPM: InstalledRedHatSignedPackedRPM,
+    InstalledUnsignedRPM: InstalledUnsignedPackedRPM,
+}
+"""Packed variants of the InstalledRPM family models; the scanners produce just the packed ones."""
+
+
+def _consume_packages(model, context):
+    """
+    Return the sequence of packages from the message of the model or None when there is no message.
+
+    For models of the InstalledRPM family the packed variant is preferred; the list variant is used
+    just when no packed message is available (e.g. it has been produced by a custom actor).
+    """
+    for candidate in (PACKED_MODELS.get(model), model):
+        if candidate is None:
+            continue
+        msg = next(iter(context.consume(candidate)), None)
+        if msg is None:
+            continue
+        if isinstance(msg, InstalledPackedRPM):
+            return RPMListView(msg.packages)
+        return msg.items
+    return None
+
+
+def get_package_index(model=InstalledRPM, context=stdlib.api):
+    """
+    Get the indexed view of packages from the message of the given model.
+
+    The message is consumed and the index is built just once per actor, further calls return
+    the same instance. Actors using the index should consume both the list and the packed variant
+    of the model (see PACKED_MODELS).
+
+    :param model: model class, InstalledRPM, InstalledPackedRPM or any of their subclasses
+    :param context: context of the execution
+    :rtype: PackageIndex
+    """
+    owner = get_cache_owner(context)
+    try:
+        indexes = _package_indexes.setdefault(owner, {})
+    except TypeError:
+        # the owner cannot be referenced weakly (e.g. None), do not cache
+        indexes = {}
+    if model not in indexes:
+        indexes[model] = PackageIndex(_consume_packages(model, context))
+    return indexes[model]
+
+
+def get_installed_packages(model=InstalledRPM, context=stdlib.api):
+    """
+    Get packages from the message of the given model in the order they are listed in the message.
+
+    The packed variant of the model is preferred as described in get_package_index().
+
+    :param model: model class, InstalledRPM, InstalledPackedRPM or any of their subclasses
+    :param context: context of the execution
+    :return: sequence of RPM models or None when no message has been received
+    """
+    return get_package_index(model, context=context).packages()
+
+
 def create_lookup(model, field, key, context=stdlib.api):
     """
     Create a lookup set from one of the model fields.
@@ -28,6 +450,9 @@ def create_lookup(model, field, key, context=stdlib.api):
     :param key: property of the field's data that will be used to build a resulting set
     :param context: context of the execution
     """
+    if isinstance(model, type) and issubclass(model, InstalledRPM) and (field, key) == ('items', 'name'):
+        names = get_package_index(model, context=context).names()
+        return set(names) if names else {}
     data = getattr(next((m for m in context.consume(model)), model()), field)
     try:
         return {getattr(obj, key) for obj in data} if data else {}
@@ -41,13 +466,15 @@ def create_lookup(model, field, key, context=stdlib.api):
 
 def has_package(model, package_name, context=stdlib.api):
     """
-    Expects a model InstalledRedHatSignedRPM or InstalledUnsignedRPM.
+    Expects a model InstalledRedHatSignedRPM or InstalledUnsignedRPM, or their packed variants
+    InstalledRedHatSignedPackedRPM or InstalledUnsignedPackedRPM.
     Can be useful in cases like a quick item presence check, ex. check in actor that
     a certain package is installed.
 
     :param model: model class
     :param package_name: package to be checked
+    :param context: context of the execution
     """
-    if not (isinstance(model, type) and issubclass(model, InstalledRPM)):
+    if not (isinstance(model, type) and issubclass(model, (InstalledRPM, InstalledPackedRPM))):
         return False
-    return package_name in create_lookup(model, field='items', key='name', context=context)
+    return package_name in get_package_index(model, context=context)
@@ -0,0 +1,192 @@
+import json
+import os
+
+import pytest
+
+from leapp.libraries.common import dnfplugin
+from leapp.libraries.common.testutils import CurrentActorMocked, logger_mocked
+from leapp.libraries.stdlib import api
+from leapp.models import (
+    DNFDownloadReport,
+    DNFPluginTimings,
+    FilteredRpmTransactionTasks,
+    TargetUserSpaceInfo,
+    UsedTargetRepositories,
+    UsedTargetRepository,
+)
+
+
+class MakecacheContextMocked(object):
+    """Simulate the parallel dnf makecache, creating the cache of each repository unless it should fail."""
+
+    def __init__(self, base_dir, failing=()):
+        self.base_dir = base_dir
+        self.failing = failing
+        self.scripts = []
+
+    def full_path(self, path):
+        return os.path.join(self.base_dir, path.lstrip('/'))
+
+    def call(self, cmd, **dummy_kwargs):
+        self.scripts.append(cmd[-1])
+        stdout = ''
+        for line in cmd[-1].splitlines():
+            if not line.startswith('dnf makecache'):
+                continue
+            repoid = line.split('--enablerepo ')[1].split()[0]
+            if repoid in self.failing:
+                stdout += dnfplugin._WARMUP_FAILED_MARK + repoid + '\n'
+                continue
+            cachedir = self.full_path(line.split('--setopt=cachedir=')[1].split()[0])
+            os.makedirs(os.path.join(cachedir, '{}-0123456789abcdef'.format(repoid), 'repodata'))
+            for name in (repoid + '.solv', repoid + '-filenames.solvx', 'expired_repos.json'):
+                with open(os.path.join(cachedir, name), 'w') as f:
+                    f.write('new')
+        return {'stdout': stdout}
+
+
+@pytest.mark.parametrize('failing', [(), ('appstream',)])
+def test_make_metadata_cache(monkeypatch, tmpdir, failing):
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked(envars={'LEAPP_NO_RHSM': '0'}))
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    cache_dir = tmpdir.mkdir('var').mkdir('cache').mkdir('dnf')
+    cache_dir.join('baseos.solv').write('old')
+    cache_dir.mkdir('baseos-0123456789abcdef').join('stale').write('old')
+    context = MakecacheContextMocked(str(tmpdir), failing=failing)
+
+    cached = dnfplugin.make_metadata_cache(context, ['baseos', 'appstream', 'baseos'])
+
+    assert cached == {'baseos', 'appstream'} - set(failing)
+    # all repositories are downloaded by a single script in parallel
+    assert len(context.scripts) == 1
+    assert context.scripts[0].count(' & pid') == 2
+    # the parallel processes must not regenerate the redhat.repo file even when RHSM is used
+    assert context.scripts[0].count('--disableplugin subscription-manager') == 2
+    assert cache_dir.join('baseos.solv').read() == 'new'
+    assert not cache_dir.join('baseos-0123456789abcdef', 'stale').check()
+    assert cache_dir.join('baseos-0123456789abcdef', 'repodata').check(dir=True)
+    assert cache_dir.join('appstream.solv').check() == ('appstream' not in failing)
+    assert not cache_dir.join('expired_repos.json').check()
+    assert not cache_dir.join(dnfplugin.DNF_WARMUP_DIR_NAME).check()
+    assert bool(api.current_logger.warnmsg) == bool(failing)
+
+
+def test_make_metadata_cache_no_repos():
+    assert dnfplugin.make_metadata_cache(MakecacheContextMocked('/nonexistent'), []) == set()
+
+
+class NspawnActionsMocked(object):
+    def __init__(self, base_dir, binds=()):
+        self.base_dir = base_dir
+        self.binds = binds
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dummy_args):
+        pass
+
+
+def test_metadata_expire_disabled_for_cached_repos(monkeypatch):
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked())
+    monkeypatch.setattr(dnfplugin.mounting, 'NspawnActions', NspawnActionsMocked)
+    used_repos = [UsedTargetRepositories(repos=[
+        UsedTargetRepository(repoid='baseos', metadata_cached=True),
+        UsedTargetRepository(repoid='appstream'),
+    ])]
+    userspace_info = TargetUserSpaceInfo(path='/nonexistent', scratch='/nonexistent', mounts='/nonexistent')
+
+    with dnfplugin._prepare_transaction(used_repos, userspace_info) as (dummy, target_repoids, cached_repoids, dummy):
+        assert sorted(target_repoids) == ['appstream', 'baseos']
+        assert cached_repoids == {'baseos'}
+
+    data = dnfplugin.build_plugin_data(target_repoids, debug=False, test=False,
+                                       tasks=FilteredRpmTransactionTasks(), on_aws=False,
+                                       cached_repoids=cached_repoids | {'unused'})
+    assert data['dnf_conf']['cached_repos'] == ['baseos']
+    assert data['dnf_conf']['transaction_path'] == dnfplugin.DNF_TRANSACTION_PATH
+    assert dnfplugin.get_metadata_expire_opts(cached_repoids) == ['--setopt=baseos.metadata_expire=-1']
+
+
+def test_download_tuning(monkeypatch):
+    envars = {
+        'LEAPP_DNF_MAX_PARALLEL_DOWNLOADS': '10',
+        'LEAPP_DNF_FASTESTMIRROR': '1',
+        'LEAPP_DNF_MINRATE': 'fast',
+        'LEAPP_DNF_DELTARPM': '0',
+    }
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked(envars=envars))
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+
+    data = dnfplugin.build_plugin_data(['baseos'], debug=False, test=False, tasks=FilteredRpmTransactionTasks(),
+                                       on_aws=False)
+
+    assert data['download'] == {'max_parallel_downloads': 10, 'fastestmirror': True, 'deltarpm': False}
+    assert len(api.current_logger.warnmsg) == 1
+    assert 'LEAPP_DNF_MINRATE' in api.current_logger.warnmsg[0]
+
+
+class PluginDataContextMocked(object):
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, path, *args):
+        assert path == dnfplugin.DNF_PLUGIN_DATA_PATH
+        return open(self.path, *args)
+
+
+def test_get_download_report(monkeypatch, tmpdir):
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    data_file = tmpdir.join('plugin-data')
+    context = PluginDataContextMocked(str(data_file))
+
+    data_file.write(json.dumps({'dnf_conf': {}}))
+    assert dnfplugin.get_download_report(context) is None
+
+    data_file.write(json.dumps({'download_report': {
+        'packages': 3, 'cached_packages': 1, 'bytes': 3 * 2 ** 20, 'seconds': 2, 'retries': 1, 'failed': 0,
+        'repos': {
+            'baseos': {'packages': 2, 'bytes': 2 * 2 ** 20, 'seconds': 1.0},
+            'appstream': {'packages': 1, 'bytes': 2 ** 20, 'seconds': 0},
+        },
+    }}))
+    report = dnfplugin.get_download_report(context)
+
+    assert isinstance(report, DNFDownloadReport)
+    assert (report.packages, report.cached_packages, report.bytes, report.retries) == (3, 1, 3 * 2 ** 20, 1)
+    assert [repo.repoid for repo in report.repositories] == ['appstream', 'baseos']
+    formatted = dnfplugin.format_download_report(report).splitlines()
+    assert formatted[0].startswith('Downloaded 3 packages (3.0 MiB) in 2.0s, 1.5 MiB/s')
+    assert formatted[1:] == ['    appstream: 1 packages (1.0 MiB) in 0.0s, n/a',
+                             '    baseos: 2 packages (2.0 MiB) in 1.0s, 2.0 MiB/s']
+
+    data_file.remove()
+    assert dnfplugin.get_download_report(context) is None
+    assert api.current_logger.warnmsg
+
+
+def test_get_plugin_timings(monkeypatch, tmpdir):
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    data_file = tmpdir.join('plugin-data')
+    context = PluginDataContextMocked(str(data_file))
+    data_file.write(json.dumps({'timings': {
+        'download': [
+            {'name': 'pre_configure', 'seconds': 0.25, 'peak_rss_kib': 51200},
+            {'name': 'sack_activation', 'seconds': 12, 'peak_rss_kib': 409600},
+        ],
+        'upgrade': [],
+    }}))
+
+    timings = dnfplugin.get_plugin_timings(context, 'download')
+
+    assert isinstance(timings, DNFPluginTimings)
+    assert timings.stage == 'download'
+    assert [(step.name, step.seconds) for step in timings.steps] == [
+        ('pre_configure', 0.25),
+        ('sack_activation', 12.0),
+    ]
+    formatted = dnfplugin.format_plugin_timings(timings).splitlines()
+    assert formatted[2].split() == ['pre_configure', '0.250', '50.0']
+    assert formatted[3].split() == ['sack_activation', '12.000', '400.0']
+    assert dnfplugin.get_plugin_timings(context, 'upgrade') is None
+    assert dnfplugin.get_plugin_timings(context, 'check') is None
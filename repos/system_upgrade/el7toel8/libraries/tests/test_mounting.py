@@ -0,0 +1,260 @@
+import os
+import shutil
+
+import pytest
+
+from leapp.libraries.common import mounting
+from leapp.libraries.common.testutils import CurrentActorMocked, logger_mocked
+from leapp.libraries.stdlib import api
+
+
+@pytest.fixture
+def source_tree(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('file').write('content')
+    src.mkdir('subdir').join('nested').write('nested content')
+    return src
+
+
+def _context(tmpdir):
+    return mounting.NotIsolatedActions(base_dir=str(tmpdir.mkdir('context')))
+
+
+@pytest.mark.parametrize('mode', [mounting.CopyMode.COPY, mounting.CopyMode.REFLINK, mounting.CopyMode.HARDLINK])
+def test_copytree_to(monkeypatch, tmpdir, source_tree, mode):
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    context = _context(tmpdir)
+
+    context.copytree_to(str(source_tree), '/dst', mode=mode)
+
+    dst = context.full_path('/dst')
+    with open(os.path.join(dst, 'subdir', 'nested')) as f:
+        assert f.read() == 'nested content'
+    same_inode = os.stat(os.path.join(dst, 'file')).st_ino == source_tree.join('file').stat().ino
+    assert same_inode == (mode == mounting.CopyMode.HARDLINK)
+    # as with shutil.copytree, the destination must not exist without the sync mode
+    with pytest.raises(OSError):
+        context.copytree_to(str(source_tree), '/dst', mode=mode)
+
+
+def test_copytree_link_fallback(monkeypatch, tmpdir, source_tree):
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+
+    def _link_cross_device(dummy_src, dummy_dst):
+        raise OSError(mounting.errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(mounting.os, 'link', _link_cross_device)
+    copier = mounting._TreeCopier(mode=mounting.CopyMode.HARDLINK)
+    copier.copytree(str(source_tree), str(tmpdir.join('dst')))
+
+    assert tmpdir.join('dst', 'subdir', 'nested').read() == 'nested content'
+    assert copier.stats['copied'] == 2 and copier.stats['linked'] == 0
+
+
+def test_copytree_from_sync(monkeypatch, tmpdir, source_tree):
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    context = mounting.NotIsolatedActions(base_dir=str(source_tree))
+    dst = tmpdir.join('dst')
+    context.copytree_from('/', str(dst), sync=True)
+
+    source_tree.join('file').write('changed content')
+    source_tree.join('subdir', 'new').write('new')
+    source_tree.join('subdir', 'nested').remove()
+    dst.join('subdir', 'extra').write('extra')
+    copied = []
+    copy2 = shutil.copy2
+    monkeypatch.setattr(mounting.shutil, 'copy2', lambda src, dst: copied.append(src) or copy2(src, dst))
+
+    context.copytree_from('/', str(dst), sync=True)
+
+    assert sorted(copied) == [str(source_tree.join('file')), str(source_tree.join('subdir', 'new'))]
+    assert dst.join('file').read() == 'changed content'
+    assert sorted(os.listdir(str(dst.join('subdir')))) == ['new']
+    # nothing is copied when nothing has changed
+    del copied[:]
+    context.copytree_from('/', str(dst), sync=True)
+    assert not copied
+
+
+def test_copytree_sync_symlinked_dir(monkeypatch, tmpdir, source_tree):
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    host_dir = tmpdir.mkdir('host')
+    host_dir.join('precious').write('precious')
+    dst = tmpdir.mkdir('dst')
+    dst.join('subdir').mksymlinkto(host_dir)
+
+    mounting._TreeCopier(sync=True).copytree(str(source_tree), str(dst))
+
+    # the symlink is replaced by a directory, nothing is written into or removed from its target
+    assert not dst.join('subdir').islink()
+    assert dst.join('subdir', 'nested').read() == 'nested content'
+    assert os.listdir(str(host_dir)) == ['precious']
+
+
+def test_copytree_bind(monkeypatch, tmpdir, source_tree):
+    mounts = []
+
+    class BindMountMocked(object):
+        def __init__(self, source, target):
+            self.source = source
+            self.target = target
+
+        def mount(self):
+            mounts.append(self.target)
+
+        def umount(self):
+            mounts.remove(self.target)
+
+    monkeypatch.setattr(mounting, 'BindMount', BindMountMocked)
+    with _context(tmpdir) as context:
+        context.copytree_to(str(source_tree), '/dst', mode=mounting.CopyMode.BIND)
+        assert mounts == [context.full_path('/dst')]
+    assert not mounts
+
+
+class LibcMocked(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    def mount(self, source, target, fstype, flags, data):
+        self.calls.append(('mount', source, target, fstype, flags, data))
+        return -1 if self.fail else 0
+
+    def umount2(self, target, flags):
+        self.calls.append(('umount2', target, flags))
+        return 0
+
+
+@pytest.fixture
+def mount_backend(monkeypatch):
+    commands = []
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    monkeypatch.setattr(mounting, 'run', lambda cmd, **dummy_kwargs: commands.append(cmd))
+    monkeypatch.setattr(mounting, '_mount_stats', {})
+    monkeypatch.delenv('LEAPP_DEVEL_MOUNT_SUBPROCESS', raising=False)
+    return commands
+
+
+@pytest.mark.parametrize('mount,expected', [
+    (lambda target: mounting.BindMount(source='/src', target=target), (b'/src', None, mounting.MS_BIND, None)),
+    (lambda target: mounting.TypedMount(fstype='tmpfs', source='tmpfs', target=target, options='size=1m'),
+     (b'tmpfs', b'tmpfs', 0, b'size=1m')),
+])
+def test_syscall_mount_backend(monkeypatch, tmpdir, mount_backend, mount, expected):
+    libc = LibcMocked()
+    monkeypatch.setattr(mounting, '_get_libc', lambda: libc)
+    target = str(tmpdir.join('target'))
+
+    mount(target).mount()
+
+    assert libc.calls == [('mount', expected[0], target.encode('utf-8')) + expected[1:]]
+    assert not mount_backend
+    assert mounting.get_mount_stats()[('mount', 'syscall')][0] == 1
+
+
+def test_syscall_mount_backend_fallback(monkeypatch, tmpdir, mount_backend):
+    libc = LibcMocked(fail=True)
+    monkeypatch.setattr(mounting, '_get_libc', lambda: libc)
+    target = str(tmpdir.join('target'))
+
+    # loop mounts are always performed by the mount command
+    mounting.LoopMount(source='/image', target=target).mount()
+    assert not libc.calls
+    # failed mount syscall falls back to the mount command
+    mounting.BindMount(source='/src', target=target).mount()
+    assert len(libc.calls) == 1
+    assert mount_backend == [['mount', '-o', 'loop', '/image', target], ['mount', '-o', 'bind', '/src', target]]
+    # the subprocess backend can be forced for a mount type
+    monkeypatch.setenv('LEAPP_DEVEL_MOUNT_SUBPROCESS', 'overlay,bind')
+    mounting.BindMount(source='/src', target=target).mount()
+    assert len(libc.calls) == 1
+    assert mounting.get_mount_stats()[('mount', 'subprocess')][0] == 3
+
+
+def test_cleanup_in_process(monkeypatch, tmpdir, mount_backend):
+    libc = LibcMocked()
+    monkeypatch.setattr(mounting, '_get_libc', lambda: libc)
+    monkeypatch.setattr(mounting.os.path, 'ismount', lambda path: True)
+    target = tmpdir.mkdir('target')
+    target.mkdir('upper').join('file').write('')
+
+    mounting.BindMount(source='/src', target=str(target)).umount()
+
+    assert libc.calls == [('umount2', str(target).encode('utf-8'), mounting.MNT_FORCE | mounting.MNT_DETACH)]
+    assert not target.check()
+    assert not mount_backend
+
+
+class PopenMocked(object):
+    started = []
+
+    def __init__(self, cmd, **dummy_kwargs):
+        self.cmd = cmd
+        self.returncode = None
+        PopenMocked.started.append(self)
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+
+    def wait(self):
+        return self.returncode
+
+
+@pytest.fixture
+def nspawn_session(monkeypatch):
+    state = {'mounts': ['/userspace'], 'leader': 4242, 'killed': []}
+    PopenMocked.started = []
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    monkeypatch.setattr(mounting.subprocess, 'Popen', PopenMocked)
+    monkeypatch.setattr(mounting, '_get_mounts_below', lambda path: list(state['mounts']))
+    monkeypatch.setattr(mounting, '_find_process', lambda cmdline: state['leader'])
+    monkeypatch.setattr(mounting.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(mounting, 'NSPAWN_SESSION_START_TIMEOUT', 0.1)
+
+    def _kill(pid, dummy_sig):
+        state['killed'].append(pid)
+        PopenMocked.started[-1].returncode = 0
+
+    monkeypatch.setattr(mounting.os, 'kill', _kill)
+    return state
+
+
+def test_nspawn_session(monkeypatch, nspawn_session):
+    commands = []
+    monkeypatch.setattr(mounting, 'run', lambda cmd, **dummy_kwargs: commands.append(cmd) or {'stdout': ''})
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked(envars={'LEAPP_NO_RHSM': '1'}))
+
+    with mounting.NspawnActions('/userspace', session=True) as context:
+        context.call(['rpm', '-q', 'dnf'])
+        context.call(['dnf', 'repolist'])
+        # the container is restarted when mounts below the root change
+        nspawn_session['mounts'].append('/userspace/el8target')
+        context.call(['rpm', '-q', 'dnf'])
+        assert context.call_stats['count'] == 3
+
+    assert len(PopenMocked.started) == 2
+    assert PopenMocked.started[0].cmd[:5] == ['systemd-nspawn', '--register=no', '--quiet', '-D', '/userspace']
+    assert PopenMocked.started[0].cmd[-2] == 'sleep'
+    assert commands[0][:3] == ['nsenter', '--target', '4242']
+    assert commands[0][-4:] == ['LEAPP_NO_RHSM=1', 'rpm', '-q', 'dnf']
+    assert nspawn_session['killed'] == [4242, 4242]
+
+
+def test_nspawn_session_fallback(monkeypatch, nspawn_session):
+    commands = []
+    monkeypatch.setattr(mounting, 'run', lambda cmd, **dummy_kwargs: commands.append(cmd) or {'stdout': ''})
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked())
+    nspawn_session['leader'] = None
+
+    with mounting.NspawnActions('/userspace', session=True) as context:
+        context.call(['rpm', '-q', 'dnf'])
+        context.call(['rpm', '-q', 'dnf'])
+
+    # the container has not been started, each command starts its own one
+    assert len(PopenMocked.started) == 1
+    assert [cmd[0] for cmd in commands] == ['systemd-nspawn', 'systemd-nspawn']
+    assert len(api.current_logger.warnmsg) == 1
@@ -0,0 +1,80 @@
+import os
+from collections import namedtuple
+
+import pytest
+
+from leapp.libraries.common import overlaygen
+from leapp.libraries.common.testutils import logger_mocked
+from leapp.libraries.stdlib import api
+from leapp.models import MemoryInfo
+
+StatVFS = namedtuple('StatVFS', ['f_frsize', 'f_blocks', 'f_bfree', 'f_bavail'])
+
+
+def test_create_mount_disk_image(monkeypatch, tmpdir):
+    commands = []
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    monkeypatch.setattr(overlaygen.utils, 'call_with_failure_hint', lambda cmd, hint: commands.append(cmd))
+    monkeypatch.setattr(overlaygen.utils, 'call_with_oserror_handled', lambda cmd: commands.append(cmd))
+    monkeypatch.setenv('LEAPP_OVL_SIZE', '4096')
+
+    image = overlaygen._create_mount_disk_image(str(tmpdir), '/var/lib')
+
+    assert image == os.path.join(str(tmpdir), 'root_var_lib')
+    # the image is sparse, no zeros are written
+    assert commands[0] == ['/usr/bin/truncate', '--size=4096M', image]
+    assert commands[1][0] == '/sbin/mkfs.ext4'
+    assert 'lazy_itable_init=1,lazy_journal_init=1,nodiscard' in commands[1]
+
+
+@pytest.mark.parametrize('used_mib,expected', [(0, 513), (100, 613), (5000, 2048)])
+def test_expected_disk_image_usage(monkeypatch, used_mib, expected):
+    monkeypatch.delenv('LEAPP_OVL_SIZE', raising=False)
+    blocks = 10 * 1024 * 256
+    monkeypatch.setattr(overlaygen.os, 'statvfs', lambda dummy_path: StatVFS(
+        f_frsize=4096, f_blocks=blocks, f_bfree=blocks - used_mib * 256, f_bavail=0))
+    assert overlaygen._expected_disk_image_usage('/var') == expected
+
+
+@pytest.mark.parametrize('opt_in,mem_total_mib,expected', [
+    ('1', 16384, 2048),
+    ('1', 4096, 0),
+    ('1', None, 0),
+    ('0', 16384, 0),
+])
+def test_tmpfs_upper_size(monkeypatch, opt_in, mem_total_mib, expected):
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    monkeypatch.setenv('LEAPP_OVL_TMPFS', opt_in)
+    monkeypatch.delenv('LEAPP_OVL_SIZE', raising=False)
+    memory_info = MemoryInfo(mem_total=mem_total_mib * 1024 if mem_total_mib else None)
+    assert overlaygen._tmpfs_upper_size(memory_info) == expected
+
+
+@pytest.mark.parametrize('mount_fails', [False, True])
+def test_mount_tmpfs_upper(monkeypatch, mount_fails):
+    mounted = []
+
+    class TypedMountMocked(object):
+        def __init__(self, fstype, source, target, options):
+            self.target = target
+            self.options = options
+
+        def mount(self):
+            if mount_fails:
+                raise overlaygen.mounting.MountError('Mount failed', None)
+            mounted.append(self.options)
+
+        def umount(self):
+            mounted.remove(self.options)
+
+    monkeypatch.setattr(api, 'current_logger', logger_mocked())
+    monkeypatch.setattr(overlaygen.mounting, 'TypedMount', TypedMountMocked)
+    monkeypatch.setenv('LEAPP_OVL_TMPFS', '1')
+    monkeypatch.setenv('LEAPP_OVL_SIZE', '1024')
+
+    with overlaygen._mount_tmpfs_upper('/mounts', MemoryInfo(mem_total=16 * 1024 * 1024)) as on_tmpfs:
+        # the upper layers fall back to the disk when tmpfs cannot be mounted
+        assert on_tmpfs != mount_fails
+        assert mounted == ([] if mount_fails else ['size=1024m,mode=0700'])
+    assert not mounted
+    assert bool(api.current_logger.warnmsg) == mount_fails
@@ -1,7 +1,7 @@
 import json
 import os
 
-from leapp.libraries.common import repofileutils
+from leapp.libraries.common import mounting, repofileutils
 
 CUR_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -12,6 +12,27 @@ def test_invert_dict():
     assert inv_dict == {'a': [1], 'b': [1, 2]}
 
 
+def test_get_parsed_repofiles(monkeypatch, tmpdir):
+    repodir = tmpdir.mkdir('etc').mkdir('yum.repos.d')
+    with open(os.path.join(CUR_DIR, 'sample_repos.txt')) as f:
+        repodir.join('sample.repo').write(f.read())
+    repodir.join('other.repo').write('[other]\nname=Other\nbaseurl=file:///srv/other\n')
+    repodir.join('readme.txt').write('[ignored]\n')
+    repodir.mkdir('dir.repo')
+    # absolute symlinks are resolved inside the context
+    tmpdir.mkdir('srv').join('linked.repo').write('[linked]\nname=Linked\n')
+    repodir.join('linked.repo').mksymlinkto('/srv/linked.repo', absolute=True)
+    repodir.join('broken.repo').mksymlinkto('/srv/missing.repo', absolute=True)
+    monkeypatch.setattr(repofileutils, 'get_repodirs', lambda: ['/etc/yum.repos.d', '/etc/yum/repos.d'])
+
+    repofiles = repofileutils.get_parsed_repofiles(mounting.NotIsolatedActions(base_dir=str(tmpdir)))
+    assert [repofile.file for repofile in repofiles] == [
+        '/etc/yum.repos.d/linked.repo', '/etc/yum.repos.d/other.repo', '/etc/yum.repos.d/sample.repo']
+    assert [repo.repoid for repo in repofiles[0].data] == ['linked']
+    assert [repo.repoid for repo in repofiles[1].data] == ['other']
+    assert 'AppStream' in [repo.repoid for repo in repofiles[2].data]
+
+
 def test_parse_repofile():
     repofile = repofileutils.parse_repofile(os.path.join(CUR_DIR, 'sample_repos.txt'))
 
@@ -0,0 +1,62 @@
+from leapp.libraries.common import repomaputils
+from leapp.libraries.common.testutils import CurrentActorMocked
+from leapp.libraries.stdlib import api
+from leapp.models import RepositoriesMap, RepositoryMap
+
+
+def _map(from_repoid, to_repoid, to_pes_repo, arch='x86_64', repo_type='rpm'):
+    return RepositoryMap(from_repoid=from_repoid, to_repoid=to_repoid, to_pes_repo=to_pes_repo,
+                         from_minor_version='all', to_minor_version='all', arch=arch, repo_type=repo_type)
+
+
+MAPPING = [
+    _map('rhel-7-server-rpms', 'rhel-8-for-x86_64-baseos-rpms', 'rhel8-BaseOS'),
+    _map('rhel-7-server-rpms', 'rhel-8-for-x86_64-appstream-rpms', 'rhel8-AppStream'),
+    _map('rhel-7-server-optional-rpms', 'codeready-builder-for-rhel-8-x86_64-rpms', 'rhel8-CRB'),
+    _map('rhel-7-server-debug-rpms', 'rhel-8-for-x86_64-baseos-debug-rpms', 'rhel8-BaseOS', repo_type='debuginfo'),
+    _map('rhel-7-for-system-z-rpms', 'rhel-8-for-s390x-baseos-rpms', 'rhel8-BaseOS', arch='s390x'),
+]
+
+
+def test_repositories_map_index_lookups():
+    index = repomaputils.RepositoriesMapIndex(MAPPING)
+    assert len(index) == 5
+
+    assert index.by_to_pes_repo('rhel8-BaseOS') == [MAPPING[0], MAPPING[3], MAPPING[4]]
+    assert index.by_to_pes_repo('rhel8-BaseOS', arch='s390x') == [MAPPING[4]]
+    assert index.by_to_pes_repo('unknown') == []
+    assert index.by_from_repoid('rhel-7-server-rpms') == MAPPING[:2]
+    assert index.by_from_repoid('rhel-7-server-rpms', arch='s390x') == []
+    assert index.by_arch('x86_64') == MAPPING[:4]
+    assert index.by_arch('x86_64', repo_type='debuginfo') == [MAPPING[3]]
+    assert index.from_repoids('x86_64') == {
+        'rhel-7-server-rpms', 'rhel-7-server-optional-rpms', 'rhel-7-server-debug-rpms'}
+
+    # the debuginfo record is the last one for rhel8-BaseOS on x86_64
+    assert index.pes_repo_mapping('x86_64') == {
+        'rhel8-BaseOS': 'rhel-8-for-x86_64-baseos-debug-rpms',
+        'rhel8-AppStream': 'rhel-8-for-x86_64-appstream-rpms',
+        'rhel8-CRB': 'codeready-builder-for-rhel-8-x86_64-rpms',
+    }
+    assert index.pes_repo_mapping('s390x') == {'rhel8-BaseOS': 'rhel-8-for-s390x-baseos-rpms'}
+
+
+class CountingActorMocked(CurrentActorMocked):
+    consumed = 0
+
+    def consume(self, model):
+        self.consumed += 1
+        return super(CountingActorMocked, self).consume(model)
+
+
+def test_repositories_map_index_is_built_once(monkeypatch):
+    actor = CountingActorMocked(msgs=[RepositoriesMap(repositories=MAPPING)])
+    monkeypatch.setattr(api, 'current_actor', actor)
+
+    index = repomaputils.get_repositories_map_index()
+    assert len(index) == 5
+    assert repomaputils.get_repositories_map_index() is index
+    assert actor.consumed == 1
+
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked())
+    assert repomaputils.get_repositories_map_index() is None
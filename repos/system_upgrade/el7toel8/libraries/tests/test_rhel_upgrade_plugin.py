@@ -0,0 +1,301 @@
+import os
+import sys
+import types
+
+import pytest
+
+PLUGIN_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'files', 'rhel_upgrade.py')
+
+PKG_INSTALL, PKG_UPGRADE, PKG_UPGRADED, PKG_REMOVE = range(4)
+REASON_DEPENDENCY, REASON_USER = 1, 2
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3,), reason='the DNF plugin requires Python 3')
+
+
+class DepsolveError(Exception):
+    pass
+
+
+class MarkingError(Exception):
+    pass
+
+
+class PackageMocked(object):
+    def __init__(self, nevra, reponame, obsoletes=()):
+        self.name = nevra.rsplit('-', 2)[0]
+        self.nevra = nevra
+        self.reponame = reponame
+        self.obsoletes = obsoletes
+
+    def __str__(self):
+        return self.nevra
+
+
+class QueryMocked(object):
+    def __init__(self, packages):
+        self.packages = list(packages)
+
+    def __iter__(self):
+        return iter(self.packages)
+
+    def __len__(self):
+        return len(self.packages)
+
+    def filter(self, name=None, obsoletes=None):
+        packages = self.packages
+        if name is not None:
+            packages = [pkg for pkg in packages if pkg.name in name]
+        if obsoletes is not None:
+            obsoleted = {pkg.name for pkg in obsoletes}
+            packages = [pkg for pkg in packages if obsoleted.intersection(pkg.obsoletes)]
+        return QueryMocked(packages)
+
+    def installed(self):
+        return QueryMocked(pkg for pkg in self.packages if pkg.reponame == '@System')
+
+    def available(self):
+        return QueryMocked(pkg for pkg in self.packages if pkg.reponame != '@System')
+
+    def run(self):
+        return list(self.packages)
+
+
+class SelectorMocked(object):
+    def __init__(self, sack):
+        self.packages = None
+
+    def set(self, pkg):
+        self.packages = [str(p) for p in pkg]
+        return self
+
+
+class TransactionItemMocked(object):
+    def __init__(self, pkg, action, reason=REASON_USER):
+        self.pkg = pkg
+        self.action = action
+        self.reason = reason
+
+
+class ReadOnlyReasonItemMocked(TransactionItemMocked):
+    reason = property(lambda self: REASON_USER, lambda self, value: None)
+
+
+class GoalMocked(object):
+    def __init__(self):
+        self.installed = []
+        self.erased = []
+        self.clean_deps = []
+        self.selected = []
+
+    def install(self, pkg=None, select=None, optional=False):
+        if select is None:
+            self.installed.append(pkg)
+        else:
+            self.selected.append(('install', select.packages, optional))
+
+    def upgrade(self, select):
+        self.selected.append(('upgrade', select.packages, None))
+
+    def erase(self, pkg, clean_deps):
+        self.erased.append(pkg)
+        self.clean_deps.append(clean_deps)
+
+
+class BaseMocked(object):
+    """Resolve any goal to the given transaction items, all of them with the user reason as libdnf does"""
+
+    def __init__(self, packages, resolved=(), depsolve_error=False, item_class=TransactionItemMocked,
+                 known_specs=(), conf=None):
+        self.sack = types.SimpleNamespace(query=lambda: QueryMocked(packages))
+        self.conf = conf
+        self.known_specs = known_specs
+        self.ops = []
+        self.resolved = resolved
+        self.item_class = item_class
+        self.depsolve_error = depsolve_error
+        self.transaction = []
+        self.reset_calls = 0
+        self._goal = GoalMocked()
+
+    def resolve(self, allow_erasing):
+        if self.depsolve_error:
+            raise DepsolveError('nothing provides libfoo')
+        self.transaction = [self.item_class(tsi.pkg, tsi.action) for tsi in self.resolved]
+
+    def _op(self, kind, spec):
+        self.ops.append((kind, spec))
+        if spec not in self.known_specs:
+            raise MarkingError('No match for argument: {}'.format(spec))
+
+    def install(self, spec):
+        self._op('install', spec)
+
+    def upgrade(self, spec):
+        self._op('upgrade', spec)
+
+    def remove(self, spec):
+        self._op('remove', spec)
+
+    def reset(self, goal):
+        self.reset_calls += 1
+        self._goal = GoalMocked()
+        self.transaction = []
+
+
+@pytest.fixture
+def plugin(monkeypatch):
+    dnf = types.ModuleType('dnf')
+    dnf.Plugin = object
+    dnf.callback = types.ModuleType('dnf.callback')
+    dnf.callback.DownloadProgress = object
+    dnf.cli = types.ModuleType('dnf.cli')
+    dnf.cli.Command = object
+    dnf.exceptions = types.ModuleType('dnf.exceptions')
+    dnf.exceptions.DepsolveError = DepsolveError
+    dnf.exceptions.MarkingError = MarkingError
+    dnf.selector = types.ModuleType('dnf.selector')
+    dnf.selector.Selector = SelectorMocked
+    dnf.transaction = types.ModuleType('dnf.transaction')
+    dnf.transaction.FORWARD_ACTIONS = [PKG_INSTALL, PKG_UPGRADE]
+    dnf.transaction.PKG_REMOVE = PKG_REMOVE
+    for name in ('dnf', 'dnf.callback', 'dnf.cli', 'dnf.exceptions', 'dnf.selector', 'dnf.transaction'):
+        monkeypatch.setitem(sys.modules, name, dnf if name == 'dnf' else getattr(dnf, name.split('.')[1]))
+    import importlib.util  # pylint: disable=import-outside-toplevel
+    spec = importlib.util.spec_from_file_location('rhel_upgrade', PLUGIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _command(plugin, base):
+    command = plugin.RhelUpgradeCommand.__new__(plugin.RhelUpgradeCommand)
+    command.base = base
+    command.cli = types.SimpleNamespace(demands=types.SimpleNamespace(allow_erasing=True))
+    return command
+
+
+INSTALLED = [PackageMocked('bash-4.2-1.x86_64', '@System'), PackageMocked('python2-2.7-1.x86_64', '@System')]
+AVAILABLE = [
+    PackageMocked('bash-4.4-1.x86_64', 'baseos'),
+    PackageMocked('bash-4.4-2.x86_64', 'baseos'),
+    PackageMocked('libfoo-1.0-1.x86_64', 'baseos'),
+]
+RESOLVED = [
+    TransactionItemMocked(AVAILABLE[1], PKG_UPGRADE),
+    TransactionItemMocked(INSTALLED[0], PKG_UPGRADED),
+    TransactionItemMocked(AVAILABLE[2], PKG_INSTALL, REASON_DEPENDENCY),
+    TransactionItemMocked(INSTALLED[1], PKG_REMOVE, REASON_DEPENDENCY),
+]
+
+
+def _save(plugin, path):
+    base = BaseMocked(INSTALLED + AVAILABLE)
+    base.transaction = RESOLVED
+    _command(plugin, base)._save_transaction(path)
+
+
+def test_transaction_round_trip(plugin, tmpdir):
+    path = str(tmpdir.join('transaction.json'))
+    _save(plugin, path)
+    base = BaseMocked(INSTALLED + AVAILABLE, resolved=RESOLVED)
+    command = _command(plugin, base)
+
+    assert command._replay_transaction(path)
+
+    # exactly the stored packages are marked, the replaced package is left to the resolution
+    assert base._goal.installed == [AVAILABLE[1], AVAILABLE[2]]
+    assert base._goal.erased == [INSTALLED[1]]
+    assert not base.reset_calls
+    # the dependencies are not recorded as installed by the user, also after dnf resolves the goal again
+    expected_reasons = [(str(tsi.pkg), tsi.reason) for tsi in RESOLVED]
+    assert [(str(tsi.pkg), tsi.reason) for tsi in base.transaction] == expected_reasons
+    base.resolve(allow_erasing=True)
+    command.run_resolved()
+    assert [(str(tsi.pkg), tsi.reason) for tsi in base.transaction] == expected_reasons
+
+
+@pytest.mark.parametrize('resolved, depsolve_error', [
+    # the resolution brings another package to the transaction
+    (RESOLVED + [TransactionItemMocked(PackageMocked('glibc-2.28-1.x86_64', 'baseos'), PKG_INSTALL)], False),
+    # another version is chosen
+    ([TransactionItemMocked(AVAILABLE[0], PKG_UPGRADE)] + RESOLVED[1:], False),
+    ((), True),
+])
+def test_transaction_replay_fallback(plugin, tmpdir, resolved, depsolve_error):
+    path = str(tmpdir.join('transaction.json'))
+    _save(plugin, path)
+    base = BaseMocked(INSTALLED + AVAILABLE, resolved=resolved, depsolve_error=depsolve_error)
+
+    assert not _command(plugin, base)._replay_transaction(path)
+
+    # the goal is reset, so the transaction is resolved again from the packages marked by leapp
+    assert base.reset_calls == 1
+    assert not base._goal.installed and not base._goal.erased
+
+
+def test_transaction_replay_reasons_not_restored(plugin, tmpdir):
+    path = str(tmpdir.join('transaction.json'))
+    _save(plugin, path)
+    base = BaseMocked(INSTALLED + AVAILABLE, resolved=RESOLVED, item_class=ReadOnlyReasonItemMocked)
+
+    assert not _command(plugin, base)._replay_transaction(path)
+    assert base.reset_calls == 1
+
+
+def test_transaction_replay_installed_changed(plugin, tmpdir):
+    path = str(tmpdir.join('transaction.json'))
+    _save(plugin, path)
+    base = BaseMocked(INSTALLED[:1] + AVAILABLE)
+
+    assert not _command(plugin, base)._replay_transaction(path)
+    assert not base._goal.installed
+
+
+OBSOLETER = PackageMocked('python3-3.6-1.x86_64', 'baseos', obsoletes=('python2',))
+# specs the fallback operations of dnf are able to mark
+KNOWN_SPECS = ('bash-4.4-2.x86_64', 'bash*', '/usr/bin/python')
+
+
+def _process(plugin, capsys, specs, kind, obsoletes=True, strict=True):
+    conf = types.SimpleNamespace(obsoletes=obsoletes, strict=strict, clean_requirements_on_remove=True)
+    base = BaseMocked(INSTALLED + AVAILABLE + [OBSOLETER], known_specs=KNOWN_SPECS, conf=conf)
+    _command(plugin, base)._process_packages(specs, kind)
+    return base, capsys.readouterr().err
+
+
+@pytest.mark.parametrize('obsoletes, strict', [(True, True), (False, True), (True, False)])
+def test_mark_install_by_name(plugin, capsys, obsoletes, strict):
+    specs = {'bash', 'libfoo', 'python2', 'missing'} | set(KNOWN_SPECS)
+    base, err = _process(plugin, capsys, specs, 'install', obsoletes=obsoletes, strict=strict)
+
+    python2_pkgs = ['python2-2.7-1.x86_64'] + (['python3-3.6-1.x86_64'] if obsoletes else [])
+    assert sorted(base._goal.selected) == [
+        ('install', ['bash-4.2-1.x86_64', 'bash-4.4-1.x86_64', 'bash-4.4-2.x86_64'], not strict),
+        ('install', ['libfoo-1.0-1.x86_64'], not strict),
+        ('install', python2_pkgs, not strict),
+    ]
+    # NEVRA, glob and provide specs and unknown names are left to dnf
+    assert sorted(base.ops) == sorted(('install', spec) for spec in KNOWN_SPECS + ('missing',))
+    assert err.endswith('Packages marked by Leapp for install not found in repositories metadata: missing\n')
+
+
+def test_mark_upgrade_by_name(plugin, capsys):
+    base, err = _process(plugin, capsys, {'bash', 'python2', 'libfoo'}, 'upgrade')
+
+    assert sorted(base._goal.selected) == [
+        ('upgrade', ['bash-4.2-1.x86_64', 'bash-4.4-1.x86_64', 'bash-4.4-2.x86_64'], None),
+        ('upgrade', ['python2-2.7-1.x86_64', 'python3-3.6-1.x86_64'], None),
+    ]
+    # the package that is not installed is not upgraded
+    assert base.ops == [('upgrade', 'libfoo')]
+    assert err.endswith('for upgrade not found in repositories metadata: libfoo\n')
+
+
+def test_mark_remove_by_name(plugin, capsys):
+    base, err = _process(plugin, capsys, {'python2', 'libfoo'}, 'remove')
+
+    assert base._goal.erased == [INSTALLED[1]]
+    assert base._goal.clean_deps == [True]
+    assert not base._goal.selected
+    assert base.ops == [('remove', 'libfoo')]
+    assert err.endswith('for remove not found in repositories metadata: libfoo\n')
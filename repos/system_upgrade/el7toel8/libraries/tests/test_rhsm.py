@@ -1,3 +1,5 @@
+import gc
+import weakref
 from collections import namedtuple
 
 import pytest
@@ -5,7 +7,7 @@ import pytest
 from leapp import reporting
 from leapp.exceptions import StopActorExecutionError
 from leapp.libraries.common import repofileutils, rhsm
-from leapp.libraries.common.testutils import create_report_mocked, logger_mocked
+from leapp.libraries.common.testutils import create_report_mocked, CurrentActorMocked, logger_mocked
 from leapp.libraries.stdlib import CalledProcessError, api
 from leapp.models import RepositoryFile, RepositoryData
 
@@ -25,6 +27,9 @@ class IsolatedActionsMocked(object):
             raise_call_error(cmd)
         return self.call_return
 
+    def is_isolated(self):
+        return True
+
 
 def raise_call_error(args=None, exit_code=1):
     raise CalledProcessError(
@@ -69,7 +74,7 @@ def test_get_available_repo_ids(monkeypatch, other_repofiles, rhsm_repofile):
     result = rhsm.get_available_repo_ids(context_mocked)
 
     rhsm_repos.sort()
-    assert context_mocked.commands_called == [['yum', 'clean', 'all']]
+    assert context_mocked.commands_called == [['yum', 'clean', 'expire-cache']]
     assert result == rhsm_repos
     if result:
         msg = (
@@ -119,3 +124,80 @@ def test_inhibit_on_duplicate_repos_no_dups(monkeypatch):
 
     assert not api.current_logger.warnmsg
     assert reporting.create_report.called == 0
+
+
+def test_set_container_mode_idempotent():
+    context_mocked = IsolatedActionsMocked()
+    rhsm.set_container_mode(context_mocked)
+    rhsm.set_container_mode(context_mocked)
+    # the existing link must be replaced, not followed, when the target userspace is reused
+    assert context_mocked.commands_called == [['ln', '-sfn', '/etc/rhsm', '/etc/rhsm-host']] * 2
+
+
+class RHSMContextMocked(object):
+    def __init__(self, outputs):
+        self.commands_called = []
+        self.outputs = outputs
+
+    def call(self, cmd, **dummy_kwargs):
+        self.commands_called.append(cmd)
+        return {'stdout': self.outputs.get(tuple(cmd[1:]), ''), 'stderr': ''}
+
+
+def test_rhsm_queries_cached(monkeypatch):
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked())
+    context = RHSMContextMocked({
+        ('release',): 'Release: 7.9',
+        ('list', '--consumed'): 'SKU: RH00001\nSKU: RH00002',
+        ('status',): SCA_STATUS,
+    })
+
+    assert rhsm.get_release(context) == '7.9'
+    assert rhsm.get_release(context) == '7.9'
+    skus = rhsm.get_attached_skus(context)
+    skus.append('modified')
+    assert rhsm.get_attached_skus(context) == ['RH00001', 'RH00002']
+    assert rhsm.get_rhsm_status(context) == SCA_STATUS
+    assert rhsm.is_manifest_sca(context)
+    assert context.commands_called == [
+        ['subscription-manager', 'release'],
+        ['subscription-manager', 'list', '--consumed'],
+        ['subscription-manager', 'status'],
+    ]
+
+    # the state is invalidated by calls changing the configuration of the subscription-manager
+    rhsm.set_release(context, '8.2')
+    context.outputs[('release',)] = 'Release: 8.2'
+    assert rhsm.get_release(context) == '8.2'
+    assert rhsm.get_attached_skus(context) == ['RH00001', 'RH00002']
+    assert context.commands_called[3:] == [
+        ['subscription-manager', 'release', '--set', '8.2'],
+        ['subscription-manager', 'release'],
+        ['subscription-manager', 'list', '--consumed'],
+    ]
+
+    # other contexts have their own state
+    other_context = RHSMContextMocked({('release',): 'Release: 7.6'})
+    assert rhsm.get_release(other_context) == '7.6'
+
+
+def test_rhsm_state_dropped_with_context(monkeypatch):
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked())
+    context = RHSMContextMocked({('release',): 'Release: 7.9'})
+    assert rhsm.get_release(context) == '7.9'
+    context_ref = weakref.ref(context)
+
+    del context
+    gc.collect()
+
+    # the cached state does not keep the container context alive
+    assert context_ref() is None
+
+
+SCA_STATUS = '''+-------------------------------------------+
+   System Status Details
++-------------------------------------------+
+Overall Status: Current
+
+{}
+'''.format(rhsm.SCA_TEXT)
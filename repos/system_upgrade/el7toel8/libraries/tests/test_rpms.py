@@ -0,0 +1,276 @@
+import json
+import time
+
+from leapp.libraries.common import rpms
+from leapp.libraries.common.testutils import CurrentActorMocked
+from leapp.libraries.stdlib import api
+from leapp.models import (
+    InstalledRedHatSignedPackedRPM,
+    InstalledRedHatSignedRPM,
+    InstalledUnsignedRPM,
+    RPM
+)
+
+RH_PACKAGER = 'Red Hat, Inc. <http://bugzilla.redhat.com/bugzilla>'
+
+
+def _rpm(name, version='0.1', release='1.el7', epoch='(none)', arch='noarch'):
+    return RPM(name=name, version=version, release=release, epoch=epoch, packager=RH_PACKAGER, arch=arch,
+               pgpsig='RSA/SHA256, Mon 01 Jan 1970 00:00:00 AM -03, Key ID 199e2f91fd431d51')
+
+
+PACKAGES = [
+    _rpm('bash', version='4.2.46', release='34.el7', arch='x86_64'),
+    _rpm('kernel', version='3.10.0', release='1127.el7', arch='x86_64'),
+    _rpm('kernel', version='3.10.0', release='1160.el7', arch='x86_64'),
+    _rpm('kernel-tools', version='3.10.0', release='1160.el7', arch='x86_64'),
+    _rpm('python-libs', version='2.7.5', release='89.el7', epoch='1', arch='x86_64'),
+]
+
+
+class CountingActorMocked(CurrentActorMocked):
+    def __init__(self, *args, **kwargs):
+        super(CountingActorMocked, self).__init__(*args, **kwargs)
+        self.consumed = 0
+
+    def consume(self, model):
+        self.consumed += 1
+        return super(CountingActorMocked, self).consume(model)
+
+
+def test_package_index_lookups():
+    index = rpms.PackageIndex(PACKAGES)
+
+    assert 'bash' in index
+    assert 'zsh' not in index
+    assert len(index) == 4
+    assert len(index.get('kernel')) == 2
+    assert index.get('zsh') == []
+    assert index.names() == ['bash', 'kernel', 'kernel-tools', 'python-libs']
+
+
+def test_package_index_nevra():
+    index = rpms.PackageIndex(PACKAGES)
+
+    assert index.get_by_nevra('bash-4.2.46-34.el7.x86_64') is PACKAGES[0]
+    assert index.get_by_nevra('bash-0:4.2.46-34.el7.x86_64') is PACKAGES[0]
+    assert index.get_by_nevra('kernel-3.10.0-1160.el7.x86_64') is PACKAGES[2]
+    assert index.get_by_nevra('python-libs-1:2.7.5-89.el7.x86_64') is PACKAGES[4]
+    assert index.get_by_nevra('python-libs-2.7.5-89.el7.x86_64') is None
+    assert index.get_by_nevra('invalid') is None
+
+
+def test_package_index_prefix_and_glob():
+    index = rpms.PackageIndex(PACKAGES)
+
+    assert index.startswith('kernel') == ['kernel', 'kernel-tools']
+    assert index.startswith('kernel-') == ['kernel-tools']
+    assert index.startswith('z') == []
+    assert index.match('kernel*') == ['kernel', 'kernel-tools']
+    assert index.match('*-libs') == ['python-libs']
+    assert index.match('bash') == ['bash']
+    assert index.match('zsh') == []
+
+
+def test_package_index_is_built_once(monkeypatch):
+    actor = CountingActorMocked(msgs=[InstalledRedHatSignedRPM(items=PACKAGES),
+                                      InstalledUnsignedRPM(items=[_rpm('custom')])])
+    monkeypatch.setattr(api, 'current_actor', actor)
+
+    assert rpms.has_package(InstalledRedHatSignedRPM, 'bash')
+    assert rpms.has_package(InstalledRedHatSignedRPM, 'kernel')
+    assert not rpms.has_package(InstalledRedHatSignedRPM, 'custom')
+    assert rpms.has_package(InstalledUnsignedRPM, 'custom')
+    assert rpms.create_lookup(InstalledRedHatSignedRPM, field='items', key='name') == {
+        'bash', 'kernel', 'kernel-tools', 'python-libs'}
+    # the packed variant is looked up first for each model
+    assert actor.consumed == 4
+
+
+def test_package_index_per_actor(monkeypatch):
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked(msgs=[InstalledRedHatSignedRPM(items=PACKAGES)]))
+    assert rpms.has_package(InstalledRedHatSignedRPM, 'bash')
+
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked(msgs=[InstalledRedHatSignedRPM(items=[])]))
+    assert not rpms.has_package(InstalledRedHatSignedRPM, 'bash')
+    assert rpms.create_lookup(InstalledRedHatSignedRPM, field='items', key='name') == {}
+
+
+def _synthetic_packages(count):
+    repos = ['rhel-7-server-rpms', 'rhel-7-server-optional-rpms', 'rhel-7-server-extras-rpms', None]
+    return [
+        RPM(name='package{}'.format(i), version='1.{}'.format(i % 50), release='{}.el7'.format(i % 7),
+            epoch='(none)' if i % 3 else '1', arch=['x86_64', 'noarch', 'i686'][i % 3], packager=RH_PACKAGER,
+            pgpsig='RSA/SHA256, Mon 01 Jan 1970 00:00:00 AM -03, Key ID {}'.format(
+                ['199e2f91fd431d51', '5326810137017186'][i % 2]),
+            repository=repos[i % len(repos)])
+        for i in range(count)
+    ]
+
+
+def test_pack_rpms_roundtrip():
+    packages = _synthetic_packages(20)
+    view = rpms.RPMListView(rpms.pack_rpms(packages))
+
+    assert len(view) == len(packages)
+    assert [pkg.dump() for pkg in view] == [pkg.dump() for pkg in packages]
+    assert view[3].repository is None
+    assert [pkg.name for pkg in view[1:3]] == ['package1', 'package2']
+
+
+def test_package_index_packed_message(monkeypatch):
+    packed = rpms.pack_rpms(PACKAGES)
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked(
+        msgs=[InstalledRedHatSignedPackedRPM(packages=packed)]))
+
+    assert rpms.has_package(InstalledRedHatSignedPackedRPM, 'bash')
+    assert not rpms.has_package(InstalledRedHatSignedPackedRPM, 'zsh')
+    index = rpms.get_package_index(InstalledRedHatSignedPackedRPM)
+    assert index.get_by_nevra('python-libs-1:2.7.5-89.el7.x86_64').dump() == PACKAGES[4].dump()
+
+
+def test_packed_message_preferred(monkeypatch):
+    packed = rpms.pack_rpms(PACKAGES[:2])
+    actor = CountingActorMocked(msgs=[InstalledRedHatSignedRPM(items=PACKAGES),
+                                      InstalledRedHatSignedPackedRPM(packages=packed)])
+    monkeypatch.setattr(api, 'current_actor', actor)
+
+    assert not rpms.has_package(InstalledRedHatSignedRPM, 'python-libs')
+    installed = rpms.get_installed_packages(InstalledRedHatSignedRPM)
+    assert isinstance(installed, rpms.RPMListView)
+    assert [pkg.name for pkg in installed] == ['bash', 'kernel']
+    # the list variant is not consumed at all
+    assert actor.consumed == 1
+
+
+def test_get_installed_packages(monkeypatch):
+    packages = [PACKAGES[4], PACKAGES[0]]
+    monkeypatch.setattr(api, 'current_actor', CurrentActorMocked(msgs=[InstalledRedHatSignedRPM(items=packages)]))
+
+    assert rpms.get_installed_packages(InstalledRedHatSignedRPM) == packages
+    assert rpms.get_installed_packages(InstalledUnsignedRPM) is None
+    assert not rpms.get_package_index(InstalledUnsignedRPM).names()
+
+
+def test_packed_rpms_benchmark():
+    packages = _synthetic_packages(5000)
+    plain = InstalledRedHatSignedRPM(items=packages)
+    packed = InstalledRedHatSignedPackedRPM(packages=rpms.pack_rpms(packages))
+
+    plain_data = json.dumps(plain.dump())
+    packed_data = json.dumps(packed.dump())
+
+    start = time.time()
+    InstalledRedHatSignedRPM.create(json.loads(plain_data))
+    plain_time = time.time() - start
+
+    start = time.time()
+    restored = InstalledRedHatSignedPackedRPM.create(json.loads(packed_data))
+    packed_time = time.time() - start
+
+    api.current_logger().info(
+        '5000 packages: plain {} B / {:.3f}s, packed {} B / {:.3f}s'.format(
+            len(plain_data), plain_time, len(packed_data), packed_time))
+
+    assert len(packed_data) < len(plain_data) / 2
+    assert 'package4999' in rpms.PackageIndex(rpms.RPMListView(restored.packages))
+
+
+def _rpm_entry(name, version, release, arch='x86_64', epoch='(none)'):
+    return '|'.join([name, version, release, epoch, RH_PACKAGER, arch, '(none)'])
+
+
+def test_rpmdb_snapshot_cache(monkeypatch, tmpdir):
+    rpmdb = tmpdir.join('Packages')
+    rpmdb.write('content')
+    calls = []
+
+    def get_installed_rpms_mocked():
+        calls.append(1)
+        return [_rpm_entry('bash', '4.2.46', '34.el7'), '']
+
+    monkeypatch.setattr(rpms, 'get_installed_rpms', get_installed_rpms_mocked)
+    monkeypatch.setattr(rpms, 'RPMDB_FILES', (str(tmpdir.join('missing')), str(rpmdb)))
+    monkeypatch.setattr(rpms, 'RPMDB_SNAPSHOT_PATH', str(tmpdir.join('snapshot.json')))
+    monkeypatch.setattr(rpms, '_snapshot_cache', {})
+
+    snapshot = rpms.get_rpmdb_snapshot()
+    assert len(snapshot) == 1
+    assert 'bash-4.2.46-34.el7.x86_64' in snapshot
+    assert rpms.get_rpmdb_snapshot() is snapshot
+    assert len(calls) == 1
+
+    rpmdb.write('modified content')
+    assert rpms.get_rpmdb_snapshot() is not snapshot
+    assert len(calls) == 2
+
+
+def test_rpmdb_snapshot_shared_by_actors(monkeypatch, tmpdir):
+    # checkleftoverpackages takes the snapshot, removeleftoverpackages takes it again before and after
+    # the removal of packages; each actor runs in its own process with an empty in-memory cache
+    rpmdb = tmpdir.join('Packages')
+    rpmdb.write('content')
+    installed = [_rpm_entry('bash', '4.2.46', '34.el7'), _rpm_entry('yum', '3.4.3', '168.el7', arch='noarch')]
+    calls = []
+
+    def get_installed_rpms_mocked():
+        calls.append(1)
+        return list(installed)
+
+    monkeypatch.setattr(rpms, 'get_installed_rpms', get_installed_rpms_mocked)
+    monkeypatch.setattr(rpms, 'RPMDB_FILES', (str(rpmdb),))
+    monkeypatch.setattr(rpms, 'RPMDB_SNAPSHOT_PATH', str(tmpdir.join('snapshot.json')))
+
+    monkeypatch.setattr(rpms, '_snapshot_cache', {})
+    checked = rpms.get_rpmdb_snapshot()
+    assert len(calls) == 1
+
+    monkeypatch.setattr(rpms, '_snapshot_cache', {})
+    before = rpms.get_rpmdb_snapshot()
+    assert len(calls) == 1
+    assert [pkg.dump() for pkg in before] == [pkg.dump() for pkg in checked]
+    assert rpms.get_rpmdb_snapshot() is before
+
+    # dnf removes a package
+    installed.pop()
+    rpmdb.write('modified content')
+    after = rpms.get_rpmdb_snapshot()
+    assert len(calls) == 2
+    assert [pkg.name for pkg in rpms.diff(before, after).removed] == ['yum']
+
+    # a later actor reuses the snapshot taken after the removal
+    monkeypatch.setattr(rpms, '_snapshot_cache', {})
+    assert len(rpms.get_rpmdb_snapshot()) == 1
+    assert len(calls) == 2
+
+
+def test_rpmdb_snapshot_without_rpmdb(monkeypatch, tmpdir):
+    monkeypatch.setattr(rpms, 'get_installed_rpms', lambda: [_rpm_entry('bash', '4.2.46', '34.el7')])
+    monkeypatch.setattr(rpms, 'RPMDB_FILES', (str(tmpdir.join('missing')),))
+    monkeypatch.setattr(rpms, '_snapshot_cache', {})
+
+    assert rpms.get_rpmdb_snapshot() is not rpms.get_rpmdb_snapshot()
+
+
+def test_rpmdb_diff():
+    def _snapshot(entries):
+        return rpms.RpmdbSnapshot(rpms.parse_installed_rpm(entry) for entry in entries)
+
+    old = _snapshot([
+        _rpm_entry('bash', '4.2.46', '34.el7'),
+        _rpm_entry('kernel', '3.10.0', '1127.el7'),
+        _rpm_entry('kernel', '3.10.0', '1160.el7'),
+        _rpm_entry('yum', '3.4.3', '168.el7', arch='noarch'),
+    ])
+    new = _snapshot([
+        _rpm_entry('bash', '4.4.19', '10.el8'),
+        _rpm_entry('kernel', '3.10.0', '1160.el7'),
+        _rpm_entry('kernel', '4.18.0', '240.el8'),
+        _rpm_entry('dnf', '4.2.23', '4.el8', arch='noarch'),
+    ])
+
+    result = rpms.diff(old, new)
+    assert [(p.name, p.release) for p in result.added] == [('dnf', '4.el8')]
+    assert [(p.name, p.release) for p in result.removed] == [('yum', '168.el7')]
+    assert [(o.release, n.release) for o, n in result.changed] == [('34.el7', '10.el8'), ('1127.el7', '240.el8')]
+    assert rpms.diff(old, old) == rpms.RpmdbDiff([], [], [])
@@ -168,3 +168,15 @@ def read_file(path):
     """
     with open(path, 'r') as f:
         return f.read()
+
+
+def get_cache_owner(context):
+    """
+    Get the object the data cached for the given context should be bound to.
+
+    In case of the stdlib API the cached data are bound to the instance of the current actor, so
+    every actor computes them just once. Other contexts (e.g. the actor test context) own
+    their cached data directly.
+    """
+    current_actor = getattr(context, 'current_actor', None)
+    return current_actor() if callable(current_actor) else context
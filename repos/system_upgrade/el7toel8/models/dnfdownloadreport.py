@@ -0,0 +1,36 @@
+from leapp.models import Model, fields
+from leapp.topics import TransactionTopic
+
+
+class DNFRepositoryDownload(Model):
+    """
+    Statistics of packages downloaded from one repository by the rhel-upgrade DNF plugin.
+
+    The seconds is the time between the start of the first and the end of the last package download
+    from the repository; downloads from different repositories run in parallel.
+    """
+    topic = TransactionTopic
+
+    repoid = fields.String()
+    packages = fields.Integer(default=0)
+    bytes = fields.Integer(default=0)
+    seconds = fields.Float(default=0.0)
+
+
+class DNFDownloadReport(Model):
+    """
+    Statistics of the download of packages in the download stage of the rhel-upgrade DNF plugin.
+
+    The packages and bytes cover only packages really downloaded, cached_packages are those
+    that have been present in the DNF cache already. The retries count downloads retried
+    on another mirror, failed count packages that could not be downloaded at all.
+    """
+    topic = TransactionTopic
+
+    packages = fields.Integer(default=0)
+    cached_packages = fields.Integer(default=0)
+    bytes = fields.Integer(default=0)
+    seconds = fields.Float(default=0.0)
+    retries = fields.Integer(default=0)
+    failed = fields.Integer(default=0)
+    repositories = fields.List(fields.Model(DNFRepositoryDownload), default=[])
@@ -0,0 +1,28 @@
+from leapp.models import Model, fields
+from leapp.topics import TransactionTopic
+
+
+class DNFPluginStepTiming(Model):
+    """
+    Time spent in one lifecycle step of the rhel-upgrade DNF plugin.
+
+    The peak_rss_kib is the maximum resident set size of the dnf process reached by the end of the step.
+    """
+    topic = TransactionTopic
+
+    name = fields.String()
+    seconds = fields.Float()
+    peak_rss_kib = fields.Integer()
+
+
+class DNFPluginTimings(Model):
+    """
+    Timings of the lifecycle steps of the rhel-upgrade DNF plugin in one stage, in the order they ended.
+
+    Steps are: pre_configure, configure, sack_activation, run, resolve, download and transaction.
+    In the check stage the run step covers also resolve and the transaction check.
+    """
+    topic = TransactionTopic
+
+    stage = fields.StringEnum(choices=['check', 'download', 'upgrade'])
+    steps = fields.List(fields.Model(DNFPluginStepTiming), default=[])
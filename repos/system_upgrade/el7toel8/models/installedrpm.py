@@ -25,3 +25,47 @@ class InstalledRedHatSignedRPM(InstalledRPM):
 
 class InstalledUnsignedRPM(InstalledRPM):
     pass
+
+
+class PackedRPMList(Model):
+    """
+    Columnar encoding of a list of RPM packages.
+
+    The n-th package is described by the n-th item of each list. Values of packager, pgpsig
+    and repository repeat a lot, so they are stored just once in the strings table and packages
+    refer to them by the index. Use the `rpms.RPMListView` library class to access the packages.
+    """
+    topic = SystemInfoTopic
+
+    names = fields.List(fields.String(), default=[])
+    epochs = fields.List(fields.String(), default=[])
+    versions = fields.List(fields.String(), default=[])
+    releases = fields.List(fields.String(), default=[])
+    arches = fields.List(fields.String(), default=[])
+    packagers = fields.List(fields.Integer(), default=[])
+    """Indexes of packagers in the strings table"""
+    pgpsigs = fields.List(fields.Integer(), default=[])
+    """Indexes of pgp signatures in the strings table"""
+    repositories = fields.List(fields.Integer(), default=[])
+    """Indexes of repositories in the strings table, -1 when the repository is not set"""
+    strings = fields.List(fields.String(), default=[])
+    """Table of the interned strings"""
+
+
+class InstalledPackedRPM(Model):
+    """
+    Installed RPM packages in the compact columnar encoding.
+
+    Holds the same data as the InstalledRPM message, but it is much cheaper to store
+    and to deserialize.
+    """
+    topic = SystemInfoTopic
+    packages = fields.Model(PackedRPMList)
+
+
+class InstalledRedHatSignedPackedRPM(InstalledPackedRPM):
+    pass
+
+
+class InstalledUnsignedPackedRPM(InstalledPackedRPM):
+    pass
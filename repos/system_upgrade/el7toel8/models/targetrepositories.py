@@ -8,7 +8,11 @@ class TargetRepositoryBase(Model):
 
 
 class UsedTargetRepository(TargetRepositoryBase):
-    pass
+    metadata_cached = fields.Boolean(default=False)
+    """
+    Metadata of the repository have been downloaded into /var/cache/dnf before the target userspace
+    has been created, so their expiration can be disabled in later dnf executions.
+    """
 
 
 class RHELTargetRepository(TargetRepositoryBase):
@@ -21,3 +21,31 @@ class UsedRepositories(Model):
     topic = SystemInfoTopic
 
     repositories = fields.List(fields.Model(UsedRepository), default=[])
+
+
+class RepositoryUsage(Model):
+    """
+    Describe a repository defined on the system and packages installed from it
+    """
+
+    topic = SystemInfoTopic
+
+    repoid = fields.String()
+    enabled = fields.Boolean(default=True)
+    """True if the repository is enabled in any repository file"""
+    url_kind = fields.StringEnum(choices=['remote', 'local', 'none'], default='none')
+    """Kind of the repository URL (mirrorlist, metalink or baseurl); local for file:// URLs"""
+    packages = fields.List(fields.String(), default=[])
+    """Names of installed Red Hat-signed packages from the repository"""
+
+
+class RepositoriesUsage(Model):
+    """
+    Describe all repositories defined on the system with packages installed from them
+
+    Use the repofileutils.RepositoriesUsageIndex library class for lookups.
+    """
+
+    topic = SystemInfoTopic
+
+    repositories = fields.List(fields.Model(RepositoryUsage), default=[])